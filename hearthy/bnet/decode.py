@@ -1,47 +1,12 @@
 import binascii
-from hearthy.proxy import pipe
-from hearthy.protocol import mtypes, serialize
+from hearthy.protocol import framing, mtypes, serialize
 from hearthy.protocol.utils import hexdump
 from hearthy.bnet import utils
 
 #
-# TODO: XXX: This file is not used anymore (expect for SplitterBuf)
+# TODO: XXX: This file is not used anymore
 #
 
-class SplitterBuf(pipe.SimpleBuf):
-    def __init__(self):
-        super().__init__()
-        self._header = None
-
-    def pull_segment(self):
-        used = self.used
-
-        # read header size
-        if used < 2:
-            return
-
-        hi, lo = self.peek(2)
-        header_size = (hi << 8) | lo
-
-        header = self._header
-        if header is None:
-            # read header
-            if used < 2 + header_size:
-                return
-            header = self._header = mtypes.BnetPacketHeader.decode_buf(self.peek(header_size, 2))
-
-        print(header)
-        # read body
-        if used < 2 + header_size + header.Size:
-            return
-
-        body = self.peek(header.Size, 2 + header_size)
-
-        self._header = None
-        self.consume(2 + header_size + header.Size)
-                     
-        return (header, body)
-
 class ServiceMethod:
     __slots__ = ['id', 'name', 'req', 'resp']
     def __init__(self, *args):
@@ -132,7 +97,8 @@ class Tracker:
         self._import_bindings = {}
         self._exports = {}
         self._requests = [{}, {}]
-        self._splitters = [SplitterBuf(), SplitterBuf()]
+        self._splitters = [framing.Framer(framing.BnetHeader()),
+                           framing.Framer(framing.BnetHeader())]
 
     def get_service(self, who, service_id):
         if service_id == 0:
@@ -181,14 +147,8 @@ class Tracker:
 
     def parse(self, who, buf):
         print(who)
-        splitter = self._splitters[who]
-        splitter.append(buf)
-
-        while True:
-            segment = splitter.pull_segment()
-            if segment is None:
-                break
-            self._parse(who, segment[0], segment[1])
+        for header, body in self._splitters[who].feed(buf):
+            self._parse(who, header, body)
 
     def _parse(self, who, header, body):
         print()
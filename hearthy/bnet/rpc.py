@@ -3,7 +3,7 @@ import re
 import types
 
 from hearthy.bnet import utils
-from hearthy.protocol import mtypes
+from hearthy.protocol import mtypes, serialize
 
 class ServiceMethod:
     __slots__ = ['id', 'name', 'req', 'resp']
@@ -124,6 +124,7 @@ class RpcBroker:
         self._exported_services = []
         self._pending_responses = {}
         self._hash_to_export = {}
+        self._send_pool = serialize.ScratchBuffer()
 
         # The token to be used in the next request
         self._next_token = 0
@@ -146,27 +147,33 @@ class RpcBroker:
         self.send_packet(header, req)
         
     def send_data(self, buf):
+        """
+        Sends buf to the peer. Note: buf is only valid during the call.
+        """
         raise NotImplementedError
 
     def send_packet(self, header, body):
-        buf = bytearray(1024)
         if body is not None:
-            body_size = body.encode_buf(buf)
-            body = bytes(buf[:body_size])
+            body_sizes = []
+            body_size = body._byte_size(body_sizes)
         else:
             body_size = 0
         header.Size = body_size
-        
-        header_end = header.encode_buf(buf, 2)
-        header_size = header_end - 2
-        
+
+        header_sizes = []
+        header_size = header._byte_size(header_sizes)
+        header_end = header_size + 2
+
+        buf = self._send_pool.get(header_end + body_size)
         buf[0] = (header_size >> 8) & 0xFF
         buf[1] = header_size & 0xFF
-        
+        header._encode_sized(buf, 2, header_sizes)
+
+        # body goes directly behind the header
         if body is not None:
-            buf[header_end:header_end+body_size] = body
-        
-        self.send_data(buf[:header_end+body_size])
+            body._encode_sized(buf, header_end, body_sizes)
+
+        self.send_data(buf)
 
     def handle_packet(self, header, body):
         self.logger.debug('handle_packet(%r,%r)', header, body)
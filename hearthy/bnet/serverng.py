@@ -1,9 +1,8 @@
 import logging
 import time
-from hearthy.protocol import mtypes, pegasus_util, account
+from hearthy.protocol import framing, mtypes, pegasus_util, account
 from hearthy.bnet import rpcdef, rpc, utils
 from hearthy.proxy import pipe
-from hearthy.bnet.decode import SplitterBuf
 from hearthy.protocol.utils import hexdump
 
 EPOCH = 0xAFFE
@@ -197,7 +196,7 @@ class ClientHandler(rpc.RpcBroker):
         super().__init__()
         self._server = server
         self._ep = ep
-        self._splitter = SplitterBuf()
+        self._splitter = framing.Framer(framing.BnetHeader())
         self._send_buf = pipe.SimpleBuf()
         
         ep.cb = self._ep_cb
@@ -221,12 +220,9 @@ class ClientHandler(rpc.RpcBroker):
 
     def _ep_cb(self, ep, ev_type, ev_data):
         if ev_type == 'may_pull':
-            self._ep.pull(self._splitter)
-            while True:
-                segment = self._splitter.pull_segment()
-                if segment is None:
-                    break
-                self.handle_packet(segment[0], segment[1])
+            data = self._ep.recv(pipe.DEFAULT_BUF_SIZE)
+            for header, body in self._splitter.feed(data):
+                self.handle_packet(header, body)
         elif ev_type == 'may_push':
             if self._send_buf.used > 0:
                 self._ep.push(self._send_buf)
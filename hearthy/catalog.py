@@ -0,0 +1,538 @@
+"""
+Catalog of hcapng captures in a SQLite database.
+
+Indexing reads every capture once (in parallel worker processes) and
+stores per file and per stream metadata: endpoints, start and end
+time, packet counts per packet type, the game and player entities of
+StartGameState/CreateGame and for each player the game account id,
+card back, hero and final play state. The protocol does not carry
+player names, players are identified by their game account id
+(hi, lo) and hero.
+
+Streams are numbered by seq in the order they were opened in their
+capture, as captures may reuse stream ids. Files that did not change
+since they were indexed (same size and mtime) are skipped, so indexing
+a directory again only reads new or modified captures.
+
+    python3 -m hearthy.catalog index catalog.db ~/captures
+    python3 -m hearthy.catalog games catalog.db --since 7d --account 1234 --account 5678
+"""
+
+import os
+import time
+import sqlite3
+import multiprocessing
+from collections import Counter
+from hearthy.datasource import hcapng, hindex
+from hearthy.protocol import framing, mtypes
+from hearthy.protocol.enums import GameTag, PacketType, PlayState
+from hearthy.protocol.decoder import decode_packet
+from hearthy.protocol.projection import Projection
+from hearthy.exceptions import CardNotFound
+from hearthy.db import cards
+
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id          INTEGER PRIMARY KEY,
+    path        TEXT UNIQUE NOT NULL,
+    size        INTEGER NOT NULL,
+    mtime       REAL NOT NULL,
+    ts          INTEGER,
+    start       INTEGER,
+    end         INTEGER,
+    streams     INTEGER,
+    events      INTEGER,
+    error       TEXT,
+    indexed_at  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS streams (
+    file_id     INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    seq         INTEGER NOT NULL,
+    stream_id   INTEGER NOT NULL,
+    source      TEXT,
+    dest        TEXT,
+    start       INTEGER,
+    end         INTEGER,
+    closed      INTEGER,
+    packets     INTEGER,
+    bytes       INTEGER,
+    game_entity INTEGER,
+    error       TEXT,
+    PRIMARY KEY (file_id, seq)
+);
+CREATE INDEX IF NOT EXISTS streams_start ON streams(start);
+CREATE TABLE IF NOT EXISTS packet_counts (
+    file_id     INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    seq         INTEGER NOT NULL,
+    packet_type INTEGER NOT NULL,
+    count       INTEGER NOT NULL,
+    PRIMARY KEY (file_id, seq, packet_type)
+);
+CREATE TABLE IF NOT EXISTS players (
+    file_id     INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    seq         INTEGER NOT NULL,
+    player_id   INTEGER NOT NULL,
+    entity      INTEGER,
+    account_hi  INTEGER,
+    account_lo  INTEGER,
+    card_back   INTEGER,
+    hero_card   TEXT,
+    hero_name   TEXT,
+    playstate   INTEGER,
+    PRIMARY KEY (file_id, seq, player_id)
+);
+CREATE INDEX IF NOT EXISTS players_account ON players(account_lo);
+CREATE INDEX IF NOT EXISTS players_hero ON players(hero_card);
+CREATE TABLE IF NOT EXISTS entity_tags (
+    file_id     INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    seq         INTEGER NOT NULL,
+    entity      INTEGER NOT NULL,
+    tag         INTEGER NOT NULL,
+    value       INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entity_tags_stream ON entity_tags(file_id, seq);
+'''
+
+# tables of older schema versions, dropped before creating the current ones
+_OLD_TABLES = ['entity_tags', 'players', 'packet_counts', 'streams', 'files']
+
+# only the packet parts the catalog looks at are decoded
+PROJECTION = Projection([
+    'StartGameState',
+    'PowerHistory.List.CreateGame',
+    'PowerHistory.List.FullEntity',
+    'PowerHistory.List.TagChange'
+])
+
+# results written per transaction while indexing
+COMMIT_EVERY = 64
+
+def _hero_name(card_id):
+    try:
+        return cards.get_by_id(card_id)
+    except CardNotFound:
+        return None
+
+class _Player:
+    __slots__ = ['player_id', 'entity', 'account', 'card_back', 'hero_entity',
+                 'hero_card', 'playstate']
+
+    def __init__(self, player):
+        self.player_id = player.Id
+        self.entity = player.Entity.Id
+        account = getattr(player, 'GameAccountId', None)
+        self.account = (account.Hi, account.Lo) if account is not None else (None, None)
+        self.card_back = getattr(player, 'CardBack', None)
+        self.hero_entity = None
+        self.hero_card = None
+        self.playstate = None
+
+class _Stream:
+    """ Collects the metadata of one stream, the seq-th of its capture. """
+    def __init__(self, seq, stream_id, source, dest, start):
+        self.seq = seq
+        self.stream_id = stream_id
+        self.source = '{0}:{1}'.format(*source)
+        self.dest = '{0}:{1}'.format(*dest)
+        self.start = start
+        self.end = start
+        self.closed = False
+        self.packets = 0
+        self.bytes = 0
+        self.counts = Counter()
+        self.game_entity = None
+        self.error = None
+
+        # player id -> _Player
+        self.players = {}
+        # entity id -> [(tag, value)] for the game and player entities
+        self.tags = {}
+
+        self._framers = [framing.Framer(framing.GameHeader()),
+                         framing.Framer(framing.GameHeader())]
+
+    def feed(self, who, data, ts):
+        self.end = ts
+        self.bytes += len(data)
+        if self.error is not None:
+            return
+
+        try:
+            for atype, body in self._framers[who].feed(data):
+                self.packets += 1
+                self.counts[atype] += 1
+                if atype == PacketType.START_GAME_STATE or atype == PacketType.POWER_HISTORY:
+                    self._process(decode_packet(atype, body, fields=PROJECTION))
+        except Exception as e:
+            self.error = repr(e)
+
+    def _create_game(self, what):
+        self.game_entity = what.GameEntity.Id
+        self.tags[self.game_entity] = [(t.Name, t.Value) for t in what.GameEntity.Tags]
+
+        for p in what.Players:
+            player = self.players[p.Id] = _Player(p)
+            self.tags[player.entity] = tags = [(t.Name, t.Value) for t in p.Entity.Tags]
+            for name, value in tags:
+                if name == GameTag.HERO_ENTITY:
+                    player.hero_entity = value
+                elif name == GameTag.PLAYSTATE:
+                    player.playstate = value
+
+    def _process(self, what):
+        if isinstance(what, mtypes.StartGameState):
+            self._create_game(what)
+            return
+
+        for power in what.List:
+            if hasattr(power, 'CreateGame'):
+                self._create_game(power.CreateGame)
+            elif hasattr(power, 'FullEntity'):
+                e = power.FullEntity
+                for player in self.players.values():
+                    if player.hero_entity == e.Entity and getattr(e, 'Name', None):
+                        player.hero_card = e.Name
+            elif hasattr(power, 'TagChange'):
+                change = power.TagChange
+                for player in self.players.values():
+                    if player.entity != change.Entity:
+                        continue
+                    if change.Tag == GameTag.PLAYSTATE:
+                        player.playstate = change.Value
+                    elif change.Tag == GameTag.HERO_ENTITY:
+                        player.hero_entity = change.Value
+
+    def rows(self):
+        """ Returns (stream row, packet count rows, player rows, tag rows). """
+        stream = (self.seq, self.stream_id, self.source, self.dest, self.start, self.end,
+                  int(self.closed), self.packets, self.bytes, self.game_entity, self.error)
+        counts = [(self.seq, atype, n) for atype, n in sorted(self.counts.items())]
+        players = [(self.seq, p.player_id, p.entity, p.account[0], p.account[1],
+                    p.card_back, p.hero_card,
+                    _hero_name(p.hero_card) if p.hero_card else None, p.playstate)
+                   for p in sorted(self.players.values(), key=lambda p: p.player_id)]
+        tags = [(self.seq, entity, tag, value)
+                for entity, taglist in sorted(self.tags.items())
+                for tag, value in taglist]
+        return stream, counts, players, tags
+
+def index_file(path):
+    """
+    Reads the capture at path and returns (path, size, mtime, file
+    info, stream rows) as stored by Catalog. Errors are reported in
+    the file info instead of being raised.
+    """
+    st = os.stat(path)
+    info = {'ts': None, 'start': None, 'end': None, 'streams': 0, 'events': 0, 'error': None}
+    streams = {}
+    done = []
+
+    try:
+        with open(path, 'rb') as f:
+            parser = hcapng.parse_mapped(f)
+            _, header = next(parser)
+            base = header.ts * 1000
+            info['ts'] = header.ts
+
+            for ts, event in parser:
+                ts += base
+                info['events'] += 1
+                if info['start'] is None:
+                    info['start'] = ts
+                info['end'] = ts
+
+                if isinstance(event, hcapng.EvData):
+                    stream = streams.get(event.stream_id, None)
+                    if stream is not None:
+                        stream.feed(event.who, event.data, ts)
+                elif isinstance(event, hcapng.EvNewConnection):
+                    old = streams.pop(event.stream_id, None)
+                    if old is not None:
+                        done.append(old)
+                    streams[event.stream_id] = _Stream(info['streams'], event.stream_id,
+                                                       event.source, event.dest, ts)
+                    info['streams'] += 1
+                elif isinstance(event, hcapng.EvClose):
+                    stream = streams.pop(event.stream_id, None)
+                    if stream is not None:
+                        stream.end = ts
+                        stream.closed = True
+                        done.append(stream)
+    except (hcapng.HCapException, StopIteration, OSError) as e:
+        info['error'] = repr(e) if not isinstance(e, StopIteration) else 'Empty file'
+
+    done.extend(streams.values())
+    done.sort(key=lambda s: s.seq)
+    return (path, st.st_size, st.st_mtime, info, [s.rows() for s in done])
+
+class Player:
+    __slots__ = ['player_id', 'account', 'card_back', 'hero_card', 'hero_name', 'playstate']
+
+    def __init__(self, player_id, account_hi, account_lo, card_back, hero_card, hero_name, playstate):
+        self.player_id = player_id
+        self.account = (account_hi, account_lo)
+        self.card_back = card_back
+        self.hero_card = hero_card
+        self.hero_name = hero_name
+        self.playstate = playstate
+
+    def __repr__(self):
+        return '<Player id={0} account={1[0]}:{1[1]} hero={2!r} playstate={3}>'.format(
+            self.player_id, self.account, self.hero_name or self.hero_card,
+            PlayState.reverse.get(self.playstate, self.playstate))
+
+class Game:
+    """ A stream with a game, as returned by Catalog.games(). """
+    __slots__ = ['path', 'seq', 'stream_id', 'source', 'dest', 'start', 'end', 'packets', 'players']
+
+    def __init__(self, path, seq, stream_id, source, dest, start, end, packets):
+        self.path = path
+        # number of the stream in the capture
+        self.seq = seq
+        self.stream_id = stream_id
+        self.source = source
+        self.dest = dest
+        # unix time in milliseconds
+        self.start = start
+        self.end = end
+        self.packets = packets
+        self.players = []
+
+    def __repr__(self):
+        return '<Game path={0!r} stream_id={1} start={2} players={3!r}>'.format(
+            self.path, self.stream_id, self.start, self.players)
+
+def find_captures(paths):
+    """ Yields the files in paths, directories are walked recursively. """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if not name.endswith(hindex.SUFFIX):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+class Catalog:
+    """ SQLite catalog of captures at path, see module docstring. """
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA foreign_keys = ON')
+
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise ValueError('Catalog {0!r} has unsupported version {1}'.format(path, version))
+        if 0 < version < SCHEMA_VERSION:
+            # older catalogs are indexed again
+            for table in _OLD_TABLES:
+                self._db.execute('DROP TABLE IF EXISTS {0}'.format(table))
+        self._db.executescript(SCHEMA)
+        self._db.execute('PRAGMA user_version = {0}'.format(SCHEMA_VERSION))
+        self._db.commit()
+
+    def _store(self, result):
+        path, size, mtime, info, streams = result
+        db = self._db
+        db.execute('DELETE FROM files WHERE path = ?', (path,))
+        cur = db.execute(
+            'INSERT INTO files (path, size, mtime, ts, start, end, streams, events, error, indexed_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (path, size, mtime, info['ts'], info['start'], info['end'], info['streams'],
+             info['events'], info['error'], time.time()))
+        file_id = cur.lastrowid
+
+        for stream, counts, players, tags in streams:
+            db.execute('INSERT INTO streams VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (file_id,) + stream)
+            db.executemany('INSERT INTO packet_counts VALUES (?, ?, ?, ?)',
+                           [(file_id,) + row for row in counts])
+            db.executemany('INSERT INTO players VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           [(file_id,) + row for row in players])
+            db.executemany('INSERT INTO entity_tags VALUES (?, ?, ?, ?, ?)',
+                           [(file_id,) + row for row in tags])
+
+    def pending(self, paths):
+        """ Returns the files in paths that are new or changed since indexed. """
+        known = dict((row[0], (row[1], row[2])) for row in
+                     self._db.execute('SELECT path, size, mtime FROM files'))
+        ret = []
+        for path in find_captures(paths):
+            path = os.path.abspath(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if known.get(path, None) != (st.st_size, st.st_mtime):
+                ret.append(path)
+        return ret
+
+    def prune(self, paths):
+        """ Removes files below paths that no longer exist, returns their number. """
+        removed = []
+        for path in paths:
+            prefix = os.path.join(os.path.abspath(path), '')
+            for (fpath,) in self._db.execute('SELECT path FROM files WHERE substr(path, 1, ?) = ?',
+                                             (len(prefix), prefix)):
+                if not os.path.exists(fpath):
+                    removed.append((fpath,))
+        self._db.executemany('DELETE FROM files WHERE path = ?', removed)
+        self._db.commit()
+        return len(removed)
+
+    def index(self, paths, jobs=None, progress=None):
+        """
+        Indexes the new or changed captures in paths (files or
+        directories) with jobs worker processes, os.cpu_count() if not
+        given. progress is called with each indexed path. Returns the
+        number of files indexed.
+        """
+        todo = self.pending(paths)
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        jobs = max(1, min(jobs, len(todo)))
+
+        if jobs > 1:
+            pool = multiprocessing.get_context().Pool(jobs)
+            results = pool.imap_unordered(index_file, todo)
+        else:
+            pool = None
+            results = map(index_file, todo)
+
+        n = 0
+        try:
+            for result in results:
+                self._store(result)
+                n += 1
+                if n % COMMIT_EVERY == 0:
+                    self._db.commit()
+                if progress is not None:
+                    progress(result[0])
+        finally:
+            self._db.commit()
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return n
+
+    def files(self):
+        """ Returns (path, ts, streams, events, error) of all indexed files. """
+        return self._db.execute(
+            'SELECT path, ts, streams, events, error FROM files ORDER BY path').fetchall()
+
+    def packet_counts(self, path, seq):
+        """ Returns {packet type name: count} of the seq-th stream of a capture (see Game.seq). """
+        rows = self._db.execute(
+            'SELECT c.packet_type, c.count FROM packet_counts c JOIN files f ON f.id = c.file_id '
+            'WHERE f.path = ? AND c.seq = ?', (os.path.abspath(path), seq))
+        return dict((PacketType.reverse.get(atype, atype), n) for atype, n in rows)
+
+    def games(self, since=None, until=None, accounts=(), heroes=()):
+        """
+        Returns the Games started between since and until (unix time
+        in ms) in which all given accounts (game account lo ids) and
+        heroes (card ids or names) took part, ordered by start.
+        """
+        where = ['s.game_entity IS NOT NULL']
+        args = []
+        if since is not None:
+            where.append('s.start >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('s.start < ?')
+            args.append(until)
+
+        exists = ('EXISTS (SELECT 1 FROM players p WHERE p.file_id = s.file_id '
+                  'AND p.seq = s.seq AND {0})')
+        for account in accounts:
+            where.append(exists.format('p.account_lo = ?'))
+            args.append(account)
+        for hero in heroes:
+            where.append(exists.format('(p.hero_card = ? OR p.hero_name = ? COLLATE NOCASE)'))
+            args.extend((hero, hero))
+
+        db = self._db
+        rows = db.execute(
+            'SELECT s.file_id, f.path, s.seq, s.stream_id, s.source, s.dest, s.start, s.end, s.packets '
+            'FROM streams s JOIN files f ON f.id = s.file_id '
+            'WHERE ' + ' AND '.join(where) + ' ORDER BY s.start, f.path, s.seq', args)
+
+        games = []
+        for row in rows.fetchall():
+            game = Game(*row[1:])
+            for p in db.execute(
+                    'SELECT player_id, account_hi, account_lo, card_back, hero_card, hero_name, '
+                    'playstate FROM players WHERE file_id = ? AND seq = ? ORDER BY player_id',
+                    (row[0], row[2])):
+                game.players.append(Player(*p))
+            games.append(game)
+        return games
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _parse_time(value):
+    """ Parses an ISO date/time or a number of days ago (e.g. 7d) into unix ms. """
+    from datetime import datetime
+    if value.endswith('d') and value[:-1].isdigit():
+        return int((time.time() - int(value[:-1]) * 86400) * 1000)
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    from datetime import datetime
+
+    parser = argparse.ArgumentParser(description='Index and query capture archives')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('index', help='Index new and changed captures')
+    p.add_argument('catalog', help='SQLite database')
+    p.add_argument('paths', nargs='+', help='Capture files or directories')
+    p.add_argument('--jobs', type=int, help='Number of worker processes')
+    p.add_argument('--prune', action='store_const', default=False, const=True,
+                   help='Forget captures below paths that were deleted')
+
+    p = sub.add_parser('games', help='List games')
+    p.add_argument('catalog', help='SQLite database')
+    p.add_argument('--since', type=_parse_time, help='ISO date or Nd for N days ago')
+    p.add_argument('--until', type=_parse_time, help='ISO date or Nd for N days ago')
+    p.add_argument('--account', type=int, action='append', default=[],
+                   help='Game account id (lo) that took part, may be repeated')
+    p.add_argument('--hero', action='append', default=[],
+                   help='Hero card id or name that was played, may be repeated')
+
+    p = sub.add_parser('files', help='List indexed captures')
+    p.add_argument('catalog', help='SQLite database')
+
+    args = parser.parse_args()
+
+    with Catalog(args.catalog) as catalog:
+        if args.command == 'index':
+            if args.prune:
+                print('Removed {0} files'.format(catalog.prune(args.paths)))
+            n = catalog.index(args.paths, jobs=args.jobs,
+                              progress=lambda path: print(path, file=sys.stderr))
+            print('Indexed {0} files'.format(n))
+        elif args.command == 'games':
+            for game in catalog.games(args.since, args.until, args.account, args.hero):
+                print('{0} {1}#{2} {3}'.format(
+                    datetime.fromtimestamp(game.start / 1000).isoformat(sep=' ', timespec='seconds'),
+                    game.path, game.stream_id,
+                    ' vs '.join('{0}:{1} {2} ({3})'.format(
+                        p.account[0], p.account[1], p.hero_name or p.hero_card or '?',
+                        PlayState.reverse.get(p.playstate, '?'))
+                        for p in game.players)))
+        elif args.command == 'files':
+            for path, ts, streams, events, error in catalog.files():
+                print('{0}: {1} streams, {2} events{3}'.format(
+                    path, streams, events, ', ' + error if error else ''))
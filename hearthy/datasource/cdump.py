@@ -1,59 +1,67 @@
-import re
-from ..protocol.decoder import decode_packet
-from ..protocol.utils import hexdump, Splitter
-from ..protocol.enums import PacketType
+"""
+Parser for the C arrays dump of wireshark's "Follow TCP Stream".
 
-READ_BUFSIZE = 16 * 1024
+The dump consists of blocks like
 
-def tokenizer(f):
-    leftover = ''
-    in_comment = False
-    while True:
-        buf = f.read(READ_BUFSIZE)
-        if not buf:
-            break
+    char peer0_0[] = { /* Packet 4 */
+    0x01, 0x02, ... };
 
-        fields = re.split('[\n\r, ]', leftover + buf)
-        for field in filter(None, fields[:-1]):
-            if field == '/*':
-                in_comment = True
-            elif field == '*/':
-                in_comment = False
-            else:
-                if not in_comment:
-                    yield field
-        leftover = fields[-1]
+parse_cdump() reads them one at a time and yields (peer, number, data).
+"""
 
-    if leftover:
-        yield leftover
+import re
+from ..exceptions import DecodeError
+from ..protocol.decoder import decode_packet
+from ..protocol.utils import hexdump, Splitter
+from ..protocol.enums import PacketType
 
-def parse_cdump(f):
-    t = tokenizer(f)
+READ_BUFSIZE = 256 * 1024
 
-    header = next(t, None)
-    ret = []
+_header = re.compile(r'char\s+peer(\d+)_(\d+)\s*\[\d*\]\s*=\s*\{')
+_comment = re.compile(r'/\*.*?\*/', re.S)
 
-    while header != None:
-        assert(header == 'char')
+def _decode_body(body):
+    if '/*' in body:
+        body = _comment.sub(' ', body)
+    try:
+        return bytes.fromhex(body.replace('0x', '').replace(',', ' '))
+    except ValueError:
+        # bytes not written as two hex digits
+        try:
+            return bytes(int(x, 16) for x in body.replace(',', ' ').split())
+        except ValueError:
+            raise DecodeError('Invalid byte in block: {0!r}'.format(body[:64]))
 
-        # peerN_N[] where N is some decimal?
-        peer = next(t, None)
-        assert(peer.startswith('peer'))
-        assert(peer.endswith('[]'))
-        p,n = map(int, peer[4:-2].split('_'))
+def blocks(f):
+    """ Yields (peer, number, body text) for all blocks read from f. """
+    buf = ''
+    pos = 0
+    scan = 0
+    while True:
+        end = buf.find('};', scan)
+        if end < 0:
+            chunk = f.read(READ_BUFSIZE)
+            if not chunk:
+                break
+            # keep only the unfinished block
+            buf = buf[pos:] + chunk
+            scan = max(len(buf) - len(chunk) - 1, 0)
+            pos = 0
+            continue
 
-        assert(next(t) == '=')
-        assert(next(t) == '{')
+        m = _header.search(buf, pos, end)
+        if m is None:
+            raise DecodeError('Expected block header before {0!r}'.format(buf[pos:end][-64:]))
+        yield (int(m.group(1)), int(m.group(2)), buf[m.end():end])
+        pos = scan = end + 2
 
-        l = []
-        while True:
-            a = next(t)
-            if a == '};':
-                break
-            l.append(int(a.rstrip(','), 16))
+    if buf[pos:].strip():
+        if _header.search(buf, pos):
+            raise DecodeError('Unterminated block at end of file')
 
-        yield (p, n, bytes(l))
-        header = next(t, None)
+def parse_cdump(f):
+    for p, n, body in blocks(f):
+        yield (p, n, _decode_body(body))
 
 if __name__ == '__main__':
     import sys
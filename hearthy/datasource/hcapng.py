@@ -1,4 +1,11 @@
+import os
+import mmap
+import zlib
+import lzma
+import time
 import struct
+import threading
+from array import array
 
 def _format_ipv4(ip):
     """
@@ -10,6 +17,11 @@ def _format_ipv4(ip):
                                     (ip >> 16) & 0xff,
                                     (ip >> 24) & 0xff)
 
+def _parse_ipv4(ip):
+    """ Converts an ip in dotted form to its numeric form. """
+    a, b, c, d = (int(x) for x in ip.split('.'))
+    return (a << 24) | (b << 16) | (c << 8) | d
+
 EV_NEW_CONNECTION, EV_CLOSE, EV_DATA = range(3)
 
 class HCapException(Exception):
@@ -18,6 +30,7 @@ class HCapException(Exception):
 
 class EvNewConnection:
     __slots__ = ['stream_id', 'source', 'dest']
+    evtype = EV_NEW_CONNECTION
 
     @classmethod
     def decode(cls, buf):
@@ -27,12 +40,18 @@ class EvNewConnection:
         a.dest = (_format_ipv4(daddr), dest)
         return a
 
+    def encode(self):
+        return struct.pack('<IIHIH', self.stream_id,
+                           _parse_ipv4(self.source[0]), self.source[1],
+                           _parse_ipv4(self.dest[0]), self.dest[1])
+
     def __repr__(self):
         return '<EvNewConnection stream_id={0}, source={1!r} dest={2!r}'.format(
             self.stream_id, self.source, self.dest)
 
 class EvData:
     __slots__ = ['stream_id', 'data', 'who']
+    evtype = EV_DATA
 
     @classmethod
     def decode(cls, buf):
@@ -41,12 +60,16 @@ class EvData:
         a.data = buf[5:]
         return a
 
+    def encode(self):
+        return struct.pack('<IB', self.stream_id, self.who) + bytes(self.data)
+
     def __repr__(self):
         return '<EvData stream_id={0} who={1} data=<{2} bytes>>'.format(
             self.stream_id, self.who, len(self.data))
 
 class EvClose:
     __slots__ = ['stream_id']
+    evtype = EV_CLOSE
 
     @classmethod
     def decode(cls, buf):
@@ -54,6 +77,9 @@ class EvClose:
         a.stream_id = struct.unpack('<I', buf)[0]
         return a
 
+    def encode(self):
+        return struct.pack('<I', self.stream_id)
+
     def __repr__(self):
         return '<EvClose stream_id={0}>'.format(
             self.stream_id)
@@ -66,6 +92,8 @@ class EvHeader:
         return '<EvHeader ts={0}>'.format(self.ts)
 
 EXPECTED_VERSION = b'HCaptureV0\x00'
+VERSION_V1 = b'HCaptureV1\x00'
+
 def read_header(stream):
     version = stream.read(len(EXPECTED_VERSION))
     if version != EXPECTED_VERSION:
@@ -78,7 +106,19 @@ def read_header(stream):
 MAX_EVLEN = 16*1024
 PREFIX_LEN = 13
 def parse(stream):
-    timestamp = read_header(stream)
+    """
+    Yields (ts, event) for all events of the capture read from
+    stream, starting with an EvHeader. Reads HCaptureV0 and V1.
+    """
+    version = stream.read(len(EXPECTED_VERSION))
+    if version == VERSION_V1:
+        yield from _parse_v1(stream)
+        return
+    elif version != EXPECTED_VERSION:
+        raise HCapException('Expected to read {0!r} but got {1!r}'.format(
+            EXPECTED_VERSION, version))
+
+    timestamp = struct.unpack('<q', stream.read(8))[0]
     yield (0, EvHeader(timestamp))
 
     while True:
@@ -108,25 +148,727 @@ def parse(stream):
             raise HCapException('Got unknown event type 0x{0:02x}'.format(evtype))
 
 HEADER_SIZE = len(EXPECTED_VERSION) + 8
-MAX_BUF = 64 * 1024
+
+# largest amount of data a single EvData can carry
+MAX_DATA = MAX_EVLEN - PREFIX_LEN - 5
+
+_prefix = struct.Struct('<IqB')
+_data_prefix = struct.Struct('<IB')
+
+def encode_header(ts):
+    """ Returns the HCaptureV0 header for unix timestamp ts. """
+    return EXPECTED_VERSION + struct.pack('<q', ts)
+
+def encode_event(ts, event):
+    """ Returns event in V0 form (prefix and payload). """
+    payload = event.encode()
+    return _prefix.pack(PREFIX_LEN + len(payload), ts, event.evtype) + payload
+
+# Writer defaults: bytes collected before writing, seconds between
+# writes and buffered bytes at which producers wait (background only)
+FLUSH_BYTES = 256 * 1024
+FLUSH_INTERVAL = 1.0
+MAX_BACKLOG = 16 * 1024 * 1024
+
+DURABILITY = ('buffered', 'flush', 'fsync')
+
+_data_head = struct.Struct('<IqBIB')
+_conn_event = struct.Struct('<IqBIIHIH')
+_close_event = struct.Struct('<IqBI')
+
+class Writer:
+    """
+    Writes a HCaptureV0 capture to the file f.
+
+    Events are collected and written in batches of flush_bytes, or
+    when flush_interval seconds have passed since the last write.
+    durability says what happens after each batch: 'buffered' leaves
+    it to f, 'flush' flushes f to the OS and 'fsync' also syncs it to
+    disk.
+
+    With background set, batches are written by a thread, so the
+    producer does not wait for the file. It only blocks if max_backlog
+    bytes are waiting to be written. Without a thread, flush_interval
+    is checked when events are added.
+
+    Timestamps default to the milliseconds since the writer was
+    created, ts (unix time of the header) to the current time.
+    close() has to be called to write the remaining events.
+    """
+    def __init__(self, f, ts=None, flush_bytes=FLUSH_BYTES, flush_interval=FLUSH_INTERVAL,
+                 durability='buffered', background=False, max_backlog=MAX_BACKLOG):
+        if durability not in DURABILITY:
+            raise HCapException('Unknown durability {0!r}'.format(durability))
+
+        self._f = f
+        self._flush_bytes = flush_bytes
+        self._flush_interval = flush_interval
+        self._durability = durability
+        self._max_backlog = max_backlog
+
+        self._ref = time.monotonic()
+        self._last_write = self._ref
+        self._buf = bytearray(encode_header(int(time.time()) if ts is None else ts))
+
+        self._thread = None
+        self._closed = False
+        if background:
+            self._cond = threading.Condition()
+            # bytes added, bytes written and bytes asked to be flushed
+            self._queued = len(self._buf)
+            self._written = 0
+            self._wanted = 0
+            self._error = None
+            self._thread = threading.Thread(target=self._run, name='hcapng.Writer', daemon=True)
+            self._thread.start()
+
+    def now(self):
+        """ Timestamp for an event happening now. """
+        return int((time.monotonic() - self._ref) * 1000)
+
+    def _sync(self):
+        if self._durability != 'buffered':
+            self._f.flush()
+            if self._durability == 'fsync':
+                os.fsync(self._f.fileno())
+
+    def _add(self, *parts):
+        if self._closed:
+            raise HCapException('Writer is closed')
+
+        if self._thread is None:
+            buf = self._buf
+            for part in parts:
+                buf += part
+            if len(buf) >= self._flush_bytes or (
+                    self._flush_interval is not None and
+                    time.monotonic() - self._last_write >= self._flush_interval):
+                self._write_out()
+            return
+
+        with self._cond:
+            if self._error is not None:
+                raise self._error
+            buf = self._buf
+            for part in parts:
+                buf += part
+                self._queued += len(part)
+            if len(buf) >= self._flush_bytes:
+                self._cond.notify_all()
+            while len(self._buf) >= self._max_backlog and self._error is None:
+                self._cond.wait()
+
+    def _write_out(self):
+        if self._buf:
+            self._f.write(self._buf)
+            self._buf = bytearray()
+            self._sync()
+        self._last_write = time.monotonic()
+
+    def _run(self):
+        cond = self._cond
+        closing = False
+        while not closing:
+            with cond:
+                while (not self._closed and len(self._buf) < self._flush_bytes
+                       and self._wanted <= self._written):
+                    if not cond.wait(self._flush_interval) and self._buf:
+                        break
+                batch, self._buf = self._buf, bytearray()
+                flush = self._wanted > self._written
+                closing = self._closed
+                cond.notify_all()
+
+            try:
+                if batch:
+                    self._f.write(batch)
+                    self._sync()
+                if flush:
+                    self._f.flush()
+            except Exception as e:
+                with cond:
+                    self._error = e
+                    cond.notify_all()
+                return
+
+            with cond:
+                self._written += len(batch)
+                cond.notify_all()
+
+    def write_event(self, ts, event):
+        """ Adds an event (EvNewConnection, EvData or EvClose). """
+        if ts is None:
+            ts = self.now()
+        if event.evtype == EV_DATA:
+            self.data(event.stream_id, event.who, event.data, ts)
+        else:
+            self._add(encode_event(ts, event))
+
+    def new_connection(self, stream_id, source, dest, ts=None):
+        """ Adds an EvNewConnection, source and dest are (ip, port). """
+        if ts is None:
+            ts = self.now()
+        self._add(_conn_event.pack(_conn_event.size, ts, EV_NEW_CONNECTION, stream_id,
+                                   _parse_ipv4(source[0]), source[1],
+                                   _parse_ipv4(dest[0]), dest[1]))
+
+    def data(self, stream_id, who, data, ts=None):
+        """ Adds data, split into several EvData if needed. """
+        if ts is None:
+            ts = self.now()
+        for i in range(0, len(data), MAX_DATA):
+            chunk = data[i:i + MAX_DATA]
+            self._add(_data_head.pack(_data_head.size + len(chunk), ts, EV_DATA, stream_id, who),
+                      chunk)
+
+    def close_stream(self, stream_id, ts=None):
+        """ Adds an EvClose. """
+        if ts is None:
+            ts = self.now()
+        self._add(_close_event.pack(_close_event.size, ts, EV_CLOSE, stream_id))
+
+    def flush(self):
+        """ Writes everything added so far and flushes f. """
+        if self._thread is None:
+            self._write_out()
+            self._f.flush()
+            return
+
+        with self._cond:
+            target = self._queued
+            self._wanted = max(self._wanted, target)
+            self._cond.notify_all()
+            while self._written < target and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+
+    def close(self):
+        """ Writes the remaining events. Does not close f. """
+        if self._closed:
+            return
+
+        if self._thread is not None:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            self._thread.join()
+            if self._error is not None:
+                raise self._error
+        else:
+            self._closed = True
+            self._write_out()
+
+        self._f.flush()
+        if self._durability == 'fsync':
+            os.fsync(self._f.fileno())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _event_at(view, offset, size):
+    if size - offset < PREFIX_LEN:
+        raise HCapException('Unexpected EOF!')
+
+    evlen, evtime, evtype = _prefix.unpack_from(view, offset)
+    end = offset + evlen
+    if evlen > MAX_EVLEN:
+        raise HCapException('Event length {0} exceeds maximum of {1}'.format(
+            evlen, MAX_EVLEN))
+    if end > size or evlen < PREFIX_LEN:
+        raise HCapException('Unexpected EOF!')
+
+    offset += PREFIX_LEN
+    if evtype == EV_DATA:
+        ev = EvData()
+        ev.stream_id, ev.who = _data_prefix.unpack_from(view, offset)
+        ev.data = view[offset + 5:end]
+    elif evtype == EV_NEW_CONNECTION:
+        ev = EvNewConnection.decode(view[offset:end])
+    elif evtype == EV_CLOSE:
+        ev = EvClose.decode(view[offset:end])
+    else:
+        raise HCapException('Got unknown event type 0x{0:02x}'.format(evtype))
+    return evtime, ev, end
+
+def _parse_events(view):
+    offset = 0
+    size = len(view)
+    while offset < size:
+        evtime, ev, offset = _event_at(view, offset, size)
+        yield (evtime, ev)
+
+class MappedCapture:
+    """
+    Capture file accessed through a memory map. Events are parsed in
+    place, the data of EvData events is a memoryview into the map and
+    stays valid as long as it is referenced.
+
+    Iterating yields the same (ts, event) tuples as parse(), without
+    the leading EvHeader. The recording start is available as ts.
+    """
+    def __init__(self, f):
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self._map, 'madvise'):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+        self._view = memoryview(self._map)
+        self.size = len(self._map)
+
+        try:
+            if self._view[:len(EXPECTED_VERSION)] != EXPECTED_VERSION:
+                raise HCapException('Expected to read {0!r} but got {1!r}'.format(
+                    EXPECTED_VERSION, bytes(self._view[:len(EXPECTED_VERSION)])))
+            if self.size < HEADER_SIZE:
+                raise HCapException('Unexpected EOF!')
+            self.ts = struct.unpack_from('<q', self._view, len(EXPECTED_VERSION))[0]
+        except:
+            self.close()
+            raise
+
+    def event_at(self, offset):
+        """ Returns (ts, event, offset of the next event) for the event at offset. """
+        return _event_at(self._view, offset, self.size)
+
+    def scan(self, offset=HEADER_SIZE):
+        """ Returns an EventTable of the events starting at offset. """
+        return EventTable.scan(self._view, offset, self.size)
+
+    def events(self, offset=HEADER_SIZE):
+        """ Yields (ts, event) for all events starting at offset. """
+        event_at = self.event_at
+        size = self.size
+        while offset < size:
+            evtime, ev, offset = event_at(offset)
+            yield (evtime, ev)
+
+    def __iter__(self):
+        return self.events()
+
+    def close(self):
+        try:
+            self._view.release()
+            self._map.close()
+        except BufferError:
+            # events still reference the map, it is closed once they are gone
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def parse_mapped(f):
+    """
+    Same as parse(f) but memory maps f if possible, see MappedCapture.
+    Falls back to parse() for streams that cannot be mapped (pipes).
+    """
+    try:
+        capture = MappedCapture(f)
+    except (OSError, ValueError, HCapException):
+        # parse() handles V1 captures and reports errors in V0 ones
+        yield from parse(f)
+        return
+
+    with capture:
+        yield (0, EvHeader(capture.ts))
+        yield from capture.events()
+
+_scan_prefix = struct.Struct('<IqBI')
+
+class EventTable:
+    """
+    The event prefixes of a buffer of events in columns: offset,
+    length, ts, type and stream_id are array.arrays with one entry per
+    event in capture order. Filter with select() and only decode the
+    events needed with materialize().
+    """
+    COLUMNS = ('offset', 'length', 'ts', 'type', 'stream_id')
+
+    def __init__(self, view):
+        self._view = view
+        self.offset = array('Q')
+        self.length = array('I')
+        self.ts = array('q')
+        self.type = array('B')
+        self.stream_id = array('I')
+
+    @classmethod
+    def scan(cls, view, offset=0, end=None):
+        """ Walks the event prefixes in view[offset:end]. """
+        if end is None:
+            end = len(view)
+
+        table = cls(view)
+        unpack = _scan_prefix.unpack_from
+        add_offset = table.offset.append
+        add_length = table.length.append
+        add_ts = table.ts.append
+        add_type = table.type.append
+        add_stream_id = table.stream_id.append
+
+        min_len = PREFIX_LEN + 4
+        while offset < end:
+            if end - offset < min_len:
+                raise HCapException('Unexpected EOF!')
+            evlen, evtime, evtype, stream_id = unpack(view, offset)
+            if evlen < min_len or offset + evlen > end:
+                raise HCapException('Unexpected EOF!')
+
+            add_offset(offset)
+            add_length(evlen)
+            add_ts(evtime)
+            add_type(evtype)
+            add_stream_id(stream_id)
+            offset += evlen
+
+        return table
+
+    def __len__(self):
+        return len(self.offset)
+
+    def as_numpy(self):
+        """
+        Returns a dict column name -> NumPy array sharing memory with
+        the column. Needs numpy to be installed.
+        """
+        import numpy
+        return dict((name, numpy.frombuffer(getattr(self, name), dtype=getattr(self, name).typecode))
+                    for name in self.COLUMNS)
+
+    def select(self, stream_id=None, types=None, since=None, until=None):
+        """
+        Returns the row numbers of the events matching all given
+        conditions: stream id, event type in types, since <= ts < until.
+        Uses numpy if it is installed.
+        """
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        if numpy is not None:
+            cols = self.as_numpy()
+            mask = numpy.ones(len(self), dtype=bool)
+            if stream_id is not None:
+                mask &= cols['stream_id'] == stream_id
+            if types is not None:
+                mask &= numpy.isin(cols['type'], list(types))
+            if since is not None:
+                mask &= cols['ts'] >= since
+            if until is not None:
+                mask &= cols['ts'] < until
+            return array('I', numpy.flatnonzero(mask).astype('I').tobytes())
+
+        rows = range(len(self))
+        if stream_id is not None:
+            col = self.stream_id
+            rows = [i for i in rows if col[i] == stream_id]
+        if types is not None:
+            col = self.type
+            types = frozenset(types)
+            rows = [i for i in rows if col[i] in types]
+        if since is not None:
+            col = self.ts
+            rows = [i for i in rows if col[i] >= since]
+        if until is not None:
+            col = self.ts
+            rows = [i for i in rows if col[i] < until]
+        return array('I', rows)
+
+    def materialize(self, rows=None):
+        """ Yields (ts, event) for the given rows (all if None). """
+        if rows is None:
+            rows = range(len(self))
+        view = self._view
+        size = len(view)
+        offset = self.offset
+        for i in rows:
+            evtime, ev, _ = _event_at(view, offset[i], size)
+            yield (evtime, ev)
+
+#
+# HCaptureV1: events are grouped into independently compressed blocks.
+#
+#   header      version, ts (q), compression method (B)
+#   blocks      block header (type, compressed size, size) + data,
+#               the data being V0 events (prefix + payload)
+#   index       block header of type BLOCK_INDEX, then per data block
+#               offset, first and last ts and number of events
+#   trailer     offset of the index, number of blocks, V1_END
+#
+# Readers going through the file in order stop at the index block,
+# random access starts at the trailer.
+#
+
+METHOD_NONE, METHOD_ZLIB, METHOD_LZMA = range(3)
+METHODS = {'none': METHOD_NONE, 'zlib': METHOD_ZLIB, 'lzma': METHOD_LZMA}
+
+BLOCK_DATA, BLOCK_INDEX = range(1, 3)
+
+# uncompressed size after which a block is finished
+BLOCK_SIZE = 32 * 1024
+
+V1_END = b'HCapEnd1'
+V1_HEADER_SIZE = len(VERSION_V1) + 9
+
+_block_header = struct.Struct('<BII')
+_block_entry = struct.Struct('<QqqI')
+_trailer = struct.Struct('<QI8s')
+
+def _compress(method, data):
+    if method == METHOD_ZLIB:
+        return zlib.compress(data)
+    elif method == METHOD_LZMA:
+        return lzma.compress(data)
+    return bytes(data)
+
+def _decompress(method, data, size):
+    try:
+        if method == METHOD_ZLIB:
+            data = zlib.decompress(data)
+        elif method == METHOD_LZMA:
+            data = lzma.decompress(data)
+        elif method != METHOD_NONE:
+            raise HCapException('Unknown compression method {0}'.format(method))
+    except (zlib.error, lzma.LZMAError) as e:
+        raise HCapException('Corrupt block: {0}'.format(e))
+
+    if len(data) != size:
+        raise HCapException('Corrupt block: expected {0} bytes but got {1}'.format(
+            size, len(data)))
+    return data
+
+def _parse_v1(stream):
+    timestamp, method = struct.unpack('<qB', stream.read(9))
+    yield (0, EvHeader(timestamp))
+
+    while True:
+        buf = stream.read(_block_header.size)
+        if len(buf) == 0:
+            # no index, the capture was not closed properly
+            break
+        elif len(buf) < _block_header.size:
+            raise HCapException('Unexpected EOF!')
+
+        btype, csize, size = _block_header.unpack(buf)
+        if btype == BLOCK_INDEX:
+            break
+        elif btype != BLOCK_DATA:
+            raise HCapException('Got unknown block type 0x{0:02x}'.format(btype))
+
+        buf = stream.read(csize)
+        if len(buf) < csize:
+            raise HCapException('Unexpected EOF!')
+        yield from _parse_events(memoryview(_decompress(method, buf, size)))
+
+class BlockWriter:
+    """
+    Writes a HCaptureV1 capture to f. Events are collected into blocks
+    of about block_size bytes which are compressed with method
+    ('none', 'zlib' or 'lzma'). close() has to be called to write the
+    last block and the index.
+    """
+    def __init__(self, f, ts, method='zlib', block_size=BLOCK_SIZE):
+        if method not in METHODS:
+            raise HCapException('Unknown compression method {0!r}'.format(method))
+        self._f = f
+        self._method = METHODS[method]
+        self._block_size = block_size
+
+        self._block = bytearray()
+        self._count = 0
+        self._first_ts = 0
+        self._last_ts = 0
+        self._index = bytearray()
+        self._n_blocks = 0
+
+        f.write(VERSION_V1 + struct.pack('<qB', ts, self._method))
+        self._offset = V1_HEADER_SIZE
+
+    def write_raw(self, ts, raw):
+        """ Adds an event given in V0 form (prefix and payload). """
+        if self._count == 0:
+            self._first_ts = ts
+        self._last_ts = ts
+        self._count += 1
+        self._block += raw
+
+        if len(self._block) >= self._block_size:
+            self.flush_block()
+
+    def write_event(self, ts, evtype, payload):
+        self.write_raw(ts, _prefix.pack(PREFIX_LEN + len(payload), ts, evtype) + payload)
+
+    def flush_block(self):
+        if self._count == 0:
+            return
+
+        data = _compress(self._method, self._block)
+        self._f.write(_block_header.pack(BLOCK_DATA, len(data), len(self._block)))
+        self._f.write(data)
+
+        self._index += _block_entry.pack(self._offset, self._first_ts, self._last_ts, self._count)
+        self._n_blocks += 1
+        self._offset += _block_header.size + len(data)
+
+        self._block = bytearray()
+        self._count = 0
+
+    def close(self):
+        self.flush_block()
+        index = bytes(self._index)
+        self._f.write(_block_header.pack(BLOCK_INDEX, len(index), len(index)))
+        self._f.write(index)
+        self._f.write(_trailer.pack(self._offset, self._n_blocks, V1_END))
+
+class CompressedCapture:
+    """
+    Random access to a HCaptureV1 capture in the seekable file f.
+    blocks is a list of (offset, first ts, last ts, number of events).
+    Iterating yields (ts, event) from the position set by seek() on.
+    """
+    def __init__(self, f):
+        self._f = f
+        f.seek(0)
+        buf = f.read(V1_HEADER_SIZE)
+        if buf[:len(VERSION_V1)] != VERSION_V1:
+            raise HCapException('Expected to read {0!r} but got {1!r}'.format(
+                VERSION_V1, buf[:len(VERSION_V1)]))
+        if len(buf) < V1_HEADER_SIZE:
+            raise HCapException('Unexpected EOF!')
+        self.ts, self._method = struct.unpack_from('<qB', buf, len(VERSION_V1))
+
+        self.blocks = self._read_index()
+        if self.blocks is None:
+            self.blocks = self._scan_blocks()
+
+        self._pos = (0, None)
+        self._cache = (None, None)
+
+    def _read_index(self):
+        f = self._f
+        end = f.seek(0, 2)
+        if end < V1_HEADER_SIZE + _trailer.size:
+            return None
+        f.seek(end - _trailer.size)
+        offset, n_blocks, magic = _trailer.unpack(f.read(_trailer.size))
+        if magic != V1_END:
+            return None
+
+        f.seek(offset + _block_header.size)
+        buf = f.read(n_blocks * _block_entry.size)
+        if len(buf) != n_blocks * _block_entry.size:
+            raise HCapException('Unexpected EOF!')
+        return list(_block_entry.iter_unpack(buf))
+
+    def _scan_blocks(self):
+        """ Walks the block headers, for captures without index. """
+        f = self._f
+        end = f.seek(0, 2)
+        blocks = []
+        offset = V1_HEADER_SIZE
+        while True:
+            f.seek(offset)
+            buf = f.read(_block_header.size)
+            if len(buf) < _block_header.size:
+                break
+            btype, csize, size = _block_header.unpack(buf)
+            if btype != BLOCK_DATA or offset + _block_header.size + csize > end:
+                # index or partially written block
+                break
+            events = list(self._parse_block(offset))
+            if events:
+                blocks.append((offset, events[0][0], events[-1][0], len(events)))
+            offset += _block_header.size + csize
+        return blocks
+
+    def _parse_block(self, offset):
+        f = self._f
+        f.seek(offset)
+        btype, csize, size = _block_header.unpack(f.read(_block_header.size))
+        buf = f.read(csize)
+        if len(buf) < csize:
+            raise HCapException('Unexpected EOF!')
+        return _parse_events(memoryview(_decompress(self._method, buf, size)))
+
+    def block_events(self, i):
+        """ Returns the list of (ts, event) of block number i. """
+        if self._cache[0] != i:
+            self._cache = (i, list(self._parse_block(self.blocks[i][0])))
+        return self._cache[1]
+
+    def seek(self, ts):
+        """ Moves to the first event with a timestamp >= ts. """
+        lo, hi = 0, len(self.blocks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.blocks[mid][2] < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        self._pos = (lo, ts)
+
+    def __iter__(self):
+        first, ts = self._pos
+        for i in range(first, len(self.blocks)):
+            for event in self.block_events(i):
+                if ts is None or event[0] >= ts:
+                    ts = None
+                    yield event
+
+def convert(src, dst, method='zlib', block_size=BLOCK_SIZE):
+    """ Converts the HCaptureV0 capture in file src to V1, written to dst. """
+    with MappedCapture(src) as capture:
+        writer = BlockWriter(dst, capture.ts, method, block_size)
+        offset = HEADER_SIZE
+        while offset < capture.size:
+            evtime, ev, end = capture.event_at(offset)
+            writer.write_raw(evtime, capture._view[offset:end])
+            offset = end
+        writer.close()
+
+# initial size and limit of the AsyncParser buffer
+INITIAL_BUF = 64 * 1024
+MAX_BUF = 16 * 1024 * 1024
+
 class AsyncParser:
     """
     Parser than can be used for asynchronous parsing
     (i.e. using asyncore or similar)
+
+    Data is either passed to feed_buf() or read directly into the
+    parser's memory with get_buffer() and commit(). Complete events
+    are parsed from the fed data in place, only an incomplete event at
+    the end is kept in the parser's buffer. That buffer grows up to
+    max_buf bytes.
+
+    The data of EvData events may point into the fed buffer or the
+    parser's memory, it is only valid until the next event is requested.
     """
     def __init__(self, max_buf=MAX_BUF):
-        self._buf = bytearray(max_buf)
+        self._buf = bytearray(min(INITIAL_BUF, max_buf))
         self._buf_start = 0
         self._buf_end = 0
         self._max_buf = max_buf
 
+        # data being parsed and the position in it
+        self._src = None
+        self._pos = 0
+
         self._needed = HEADER_SIZE
         self._parser = self._read_header
 
+        # events of the last V1 block
+        self._events = None
+
     def _read(self, n):
-        end = self._buf_start + n
-        buf = self._buf[self._buf_start:end]
-        self._buf_start = end
+        end = self._pos + n
+        buf = self._src[self._pos:end]
+        self._pos = end
         return buf
 
     def _read_event(self):
@@ -148,15 +890,63 @@ class AsyncParser:
             raise HCapException('Got unknown event type 0x{0:02x}'.format(evtype))
 
     def _read_prefix(self):
-        self._evlen, self._evtime, self._evtype = struct.unpack('<IqB', self._read(PREFIX_LEN))
+        self._evlen, self._evtime, self._evtype = _prefix.unpack(self._read(PREFIX_LEN))
+        if self._evlen > MAX_EVLEN:
+            raise HCapException('Event length {0} exceeds maximum of {1}'.format(
+                self._evlen, MAX_EVLEN))
+        elif self._evlen < PREFIX_LEN:
+            raise HCapException('Got invalid event length {0}'.format(self._evlen))
 
         # read event
         self._needed = self._evlen - PREFIX_LEN
         self._parser = self._read_event
 
+    def _read_v1_header(self):
+        timestamp, self._method = struct.unpack('<qB', self._read(9))
+
+        self._needed = _block_header.size
+        self._parser = self._read_block_header
+
+        return (0, EvHeader(timestamp))
+
+    def _read_block_header(self):
+        btype, csize, size = _block_header.unpack(self._read(_block_header.size))
+        if btype == BLOCK_INDEX:
+            # skip index and trailer
+            self._needed = csize + _trailer.size
+            self._parser = self._read_index
+            return
+        elif btype != BLOCK_DATA:
+            raise HCapException('Got unknown block type 0x{0:02x}'.format(btype))
+        elif csize > self._max_buf:
+            raise HCapException('Block of {0} bytes exceeds buffer size'.format(csize))
+
+        self._block_size = size
+        self._needed = csize
+        self._parser = self._read_block
+
+    def _read_block(self):
+        data = _decompress(self._method, self._read(self._needed), self._block_size)
+        self._events = _parse_events(memoryview(data))
+
+        self._needed = _block_header.size
+        self._parser = self._read_block_header
+
+    def _read_index(self):
+        self._read(self._needed)
+        self._needed = 1
+        self._parser = self._read_end
+
+    def _read_end(self):
+        raise HCapException('Got data after the end of the capture')
+
     def _read_header(self):
-        version = self._read(len(EXPECTED_VERSION))
-        if version != EXPECTED_VERSION:
+        version = bytes(self._read(len(EXPECTED_VERSION)))
+        if version == VERSION_V1:
+            self._needed = 9
+            self._parser = self._read_v1_header
+            return
+        elif version != EXPECTED_VERSION:
             raise HCapException('Expected to read {0!r} but got {1!r}'.format(
                 EXPECTED_VERSION, version))
         
@@ -166,37 +956,97 @@ class AsyncParser:
         self._parser = self._read_prefix
 
         return (0, EvHeader(timestamp))
-        
-    def feed_buf(self, buf):
-        end = self._buf_end + len(buf)
-        if end > self._max_buf:
+
+    def _reserve(self, n):
+        """ Makes room for n more bytes at the end of the buffer. """
+        used = self._buf_end - self._buf_start
+        if len(self._buf) - self._buf_end >= n:
+            return
+        if used + n > self._max_buf:
             raise HCapException('Buffer size exceeded')
 
-        # copy new data into buf
-        self._buf[self._buf_end:end] = buf
-        self._buf_end = end
+        if len(self._buf) - used >= n:
+            # compacting is enough
+            self._buf[:used] = self._buf[self._buf_start:self._buf_end]
+        else:
+            # grow geometrically, views handed out before stay valid
+            buf = bytearray(min(max(2 * len(self._buf), used + n), self._max_buf))
+            buf[:used] = self._buf[self._buf_start:self._buf_end]
+            self._buf = buf
+        self._buf_start = 0
+        self._buf_end = used
 
-        # process data
-        while end - self._buf_start >= self._needed:
+    def _parse(self, src, end):
+        self._src = src
+        while end - self._pos >= self._needed:
             data = self._parser()
             if data is not None:
                 yield data
+            elif self._events is not None:
+                events, self._events = self._events, None
+                yield from events
+
+    def get_buffer(self, n):
+        """
+        Returns a writable memoryview of n bytes of parser memory. Read
+        data into it, then call commit() with the number of bytes read.
+        """
+        self._reserve(n)
+        return memoryview(self._buf)[self._buf_end:self._buf_end + n]
+
+    def commit(self, n):
+        """ Parses n bytes written into the buffer from get_buffer(). """
+        self._buf_end += n
+        self._pos = self._buf_start
+        yield from self._parse(memoryview(self._buf), self._buf_end)
+
+        self._buf_start = self._pos
+        if self._buf_start == self._buf_end:
+            self._buf_start = self._buf_end = 0
+
+    def feed_buf(self, buf):
+        view = memoryview(buf)
+        end = len(view)
+        offset = 0
+
+        # complete the buffered event, copying only what it needs
+        while self._buf_start != self._buf_end and offset < end:
+            n = min(self._needed - (self._buf_end - self._buf_start), end - offset)
+            self.get_buffer(n)[:] = view[offset:offset + n]
+            offset += n
+            yield from self.commit(n)
+
+        # parse complete events directly from buf
+        self._pos = offset
+        yield from self._parse(view, end)
 
-        # copy to make more room
-        if end > self._max_buf // 4:
-            inbuff = end - self._buf_start
-            self._buf[:inbuff] = self._buf[self._buf_start:end]
-            self._buf_start = 0
-            self._buf_end = inbuff
+        # keep what is left
+        rest = end - self._pos
+        if rest:
+            self.get_buffer(rest)[:] = view[self._pos:end]
+            self._buf_end += rest
+        self._src = None
 
 if __name__ == '__main__':
-    import sys
+    import argparse
     from datetime import datetime
-    if len(sys.argv) < 2:
-        print('Usage: {0} <file>'.format(sys.argv[0]))
-        sys.exit(1)
 
-    with open(sys.argv[1], 'rb') as f:
+    parser = argparse.ArgumentParser(description='Print or convert captures')
+    parser.add_argument('file', help='hcapng file')
+    parser.add_argument('--convert', metavar='OUT',
+                        help='Convert the V0 capture to a compressed V1 capture')
+    parser.add_argument('--method', choices=sorted(METHODS), default='zlib',
+                        help='Compression method for --convert')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE,
+                        help='Uncompressed block size for --convert')
+    args = parser.parse_args()
+
+    if args.convert is not None:
+        with open(args.file, 'rb') as src, open(args.convert, 'wb') as dst:
+            convert(src, dst, args.method, args.block_size)
+        raise SystemExit
+
+    with open(args.file, 'rb') as f:
         gen = parse(f)
 
         _, header = next(gen)
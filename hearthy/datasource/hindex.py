@@ -0,0 +1,366 @@
+"""
+Sidecar index for hcapng captures.
+
+The index lives next to the capture (<capture>.hidx) and allows
+jumping to a point in time or reading a single stream without
+scanning the whole capture. Layout (all little endian):
+
+    header      magic, capture size, capture mtime, CRC32 of the last
+                TAIL_SIZE bytes of the capture, number of records,
+                number of streams
+    records     per event: offset, timestamp, stream id, event type
+    order       record numbers grouped by stream
+    streams     per stream: stream id, start and count in order,
+                first and last timestamp
+
+Records are fixed-width and in capture order, so they can be binary
+searched by timestamp. An index whose size, mtime or tail checksum does
+not match the capture is out of date and gets rebuilt.
+
+HCaptureV1 captures (see hcapng.convert) carry their own block index
+and get no sidecar. open_capture() returns a BlockIndexedCapture for
+them, which seeks by block and finds the blocks of a stream by reading
+all blocks once.
+"""
+
+import os
+import sys
+import zlib
+import struct
+from array import array
+from hearthy.datasource import hcapng
+
+MAGIC = b'HCapIdx1'
+SUFFIX = '.hidx'
+
+# bytes at the end of the capture covered by the checksum
+TAIL_SIZE = 4096
+
+_header = struct.Struct('<8sQqIII')
+_record = struct.Struct('<QqIB3x')
+_stream = struct.Struct('<IIIqq')
+
+class StreamEntry:
+    __slots__ = ['stream_id', 'start', 'count', 'first_ts', 'last_ts']
+
+    def __init__(self, stream_id, start, count, first_ts, last_ts):
+        self.stream_id = stream_id
+        self.start = start
+        self.count = count
+        self.first_ts = first_ts
+        self.last_ts = last_ts
+
+    def __repr__(self):
+        return '<StreamEntry stream_id={0.stream_id} events={0.count} ts={0.first_ts}..{0.last_ts}>'.format(self)
+
+class CaptureIndex:
+    """
+    Index of a capture, see module docstring. Use build() or read()
+    to create one.
+    """
+    def __init__(self, stamp, records, order, streams):
+        self.capture_size, self.capture_mtime, self.capture_crc = stamp
+        self._records = records
+        self._order = order
+        # stream id -> StreamEntry
+        self.streams = streams
+
+    def __len__(self):
+        return len(self._records) // _record.size
+
+    @property
+    def stamp(self):
+        """ (size, mtime, tail checksum) of the indexed capture, see capture_stamp(). """
+        return (self.capture_size, self.capture_mtime, self.capture_crc)
+
+    def record(self, i):
+        """ Returns (offset, ts, stream id, event type) of event number i. """
+        return _record.unpack_from(self._records, i * _record.size)
+
+    def find(self, ts):
+        """ Returns the number of the first event with a timestamp >= ts. """
+        records = self._records
+        size = _record.size
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if struct.unpack_from('<q', records, mid * size + 8)[0] < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def stream_records(self, stream_id):
+        """ Yields the record numbers of stream_id in capture order. """
+        entry = self.streams.get(stream_id, None)
+        if entry is None:
+            return iter(())
+        return iter(self._order[entry.start:entry.start + entry.count])
+
+    @classmethod
+    def build(cls, capture, stamp):
+        """
+        Builds the index of a MappedCapture by walking its event
+        prefixes. stamp is the capture_stamp() of its file.
+        """
+        table = capture.scan()
+
+        records = bytearray()
+        pack = _record.pack
+
+        # stream id -> [record numbers], [first ts, last ts]
+        streams = {}
+        for i, row in enumerate(zip(table.offset, table.ts, table.stream_id, table.type)):
+            offset, evtime, stream_id, evtype = row
+            records += pack(offset, evtime, stream_id, evtype)
+            entry = streams.get(stream_id, None)
+            if entry is None:
+                streams[stream_id] = ([i], [evtime, evtime])
+            else:
+                entry[0].append(i)
+                entry[1][1] = evtime
+
+        order = array('I')
+        entries = {}
+        for stream_id in sorted(streams):
+            numbers, (first_ts, last_ts) = streams[stream_id]
+            entries[stream_id] = StreamEntry(stream_id, len(order), len(numbers), first_ts, last_ts)
+            order.extend(numbers)
+
+        return cls(stamp, bytes(records), order, entries)
+
+    def write(self, path):
+        order = self._order
+        if sys.byteorder != 'little':
+            order = array('I', order)
+            order.byteswap()
+
+        with open(path, 'wb') as f:
+            f.write(_header.pack(MAGIC, self.capture_size, self.capture_mtime,
+                                 self.capture_crc, len(self), len(self.streams)))
+            f.write(self._records)
+            f.write(order.tobytes())
+            for entry in self.streams.values():
+                f.write(_stream.pack(entry.stream_id, entry.start, entry.count,
+                                     entry.first_ts, entry.last_ts))
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            buf = f.read()
+
+        if len(buf) < _header.size:
+            raise hcapng.HCapException('Index {0!r} is truncated'.format(path))
+        magic, capture_size, capture_mtime, capture_crc, n_records, n_streams = _header.unpack_from(buf)
+        if magic != MAGIC:
+            raise hcapng.HCapException('Expected to read {0!r} but got {1!r}'.format(MAGIC, magic))
+        if len(buf) != _header.size + n_records * (_record.size + 4) + n_streams * _stream.size:
+            raise hcapng.HCapException('Index {0!r} is truncated'.format(path))
+
+        offset = _header.size
+        records = buf[offset:offset + n_records * _record.size]
+        offset += len(records)
+
+        order = array('I')
+        order.frombytes(buf[offset:offset + n_records * 4])
+        if sys.byteorder != 'little':
+            order.byteswap()
+        offset += n_records * 4
+
+        streams = {}
+        for i in range(n_streams):
+            entry = StreamEntry(*_stream.unpack_from(buf, offset))
+            streams[entry.stream_id] = entry
+            offset += _stream.size
+
+        return cls((capture_size, capture_mtime, capture_crc), records, order, streams)
+
+def index_path(path):
+    return path + SUFFIX
+
+def capture_stamp(f):
+    """
+    Returns (size, mtime in ns, CRC32 of the last TAIL_SIZE bytes) of
+    the capture file f, used to tell whether an index is up to date.
+    """
+    st = os.fstat(f.fileno())
+    pos = f.tell()
+    f.seek(max(0, st.st_size - TAIL_SIZE))
+    crc = zlib.crc32(f.read(TAIL_SIZE))
+    f.seek(pos)
+    return (st.st_size, st.st_mtime_ns, crc)
+
+class IndexedCapture(hcapng.MappedCapture):
+    """
+    MappedCapture with an index. Iterating yields the events from
+    the position set by seek() on.
+    """
+    def __init__(self, f, index=None):
+        super().__init__(f)
+        try:
+            stamp = capture_stamp(f)
+            if index is None:
+                index = CaptureIndex.build(self, stamp)
+            elif index.stamp != stamp:
+                raise hcapng.HCapException('Index does not match capture')
+        except:
+            self.close()
+            raise
+        self.index = index
+        self._pos = hcapng.HEADER_SIZE
+
+    def seek(self, ts):
+        """
+        Moves to the first event with a timestamp >= ts. Returns the
+        number of that event.
+        """
+        i = self.index.find(ts)
+        if i < len(self.index):
+            self._pos = self.index.record(i)[0]
+        else:
+            self._pos = self.size
+        return i
+
+    @property
+    def streams(self):
+        """ stream id -> StreamEntry """
+        return self.index.streams
+
+    def iter_stream(self, stream_id):
+        """ Yields (ts, event) for all events of stream_id. """
+        record = self.index.record
+        event_at = self.event_at
+        for i in self.index.stream_records(stream_id):
+            evtime, ev, _ = event_at(record(i)[0])
+            yield (evtime, ev)
+
+    def __iter__(self):
+        return self.events(self._pos)
+
+class BlockIndexedCapture(hcapng.CompressedCapture):
+    """
+    Same interface as IndexedCapture for a HCaptureV1 capture, served
+    from its block index. seek() returns None. For a StreamEntry, start
+    is the number of the first block holding events of the stream.
+    """
+    def __init__(self, f):
+        super().__init__(f)
+        # stream id -> block numbers, filled on first use
+        self._stream_blocks = None
+        self._streams = None
+
+    def _scan_streams(self):
+        stream_blocks = {}
+        streams = {}
+        for i, block in enumerate(self.blocks):
+            for evtime, ev in self._parse_block(block[0]):
+                entry = streams.get(ev.stream_id, None)
+                if entry is None:
+                    streams[ev.stream_id] = StreamEntry(ev.stream_id, i, 1, evtime, evtime)
+                    stream_blocks[ev.stream_id] = [i]
+                else:
+                    entry.count += 1
+                    entry.last_ts = evtime
+                    if stream_blocks[ev.stream_id][-1] != i:
+                        stream_blocks[ev.stream_id].append(i)
+        self._stream_blocks = stream_blocks
+        self._streams = dict(sorted(streams.items()))
+
+    @property
+    def streams(self):
+        """ stream id -> StreamEntry """
+        if self._streams is None:
+            self._scan_streams()
+        return self._streams
+
+    def iter_stream(self, stream_id):
+        """ Yields (ts, event) for all events of stream_id. """
+        if self._stream_blocks is None:
+            self._scan_streams()
+        for i in self._stream_blocks.get(stream_id, ()):
+            for evtime, ev in self.block_events(i):
+                if ev.stream_id == stream_id:
+                    yield (evtime, ev)
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def open_capture(path, build=True):
+    """
+    Opens the capture at path with its index. If there is no up to
+    date index and build is set, it is built and written, otherwise
+    HCapException is raised. If the index can not be written (e.g. a
+    read-only directory), the capture is used with the index built in
+    memory. HCaptureV1 captures are opened as BlockIndexedCapture.
+    """
+    with open(path, 'rb') as f:
+        version = f.read(len(hcapng.VERSION_V1))
+    if version == hcapng.VERSION_V1:
+        f = open(path, 'rb')
+        try:
+            return BlockIndexedCapture(f)
+        except:
+            f.close()
+            raise
+
+    ipath = index_path(path)
+    with open(path, 'rb') as f:
+        index = None
+        if os.path.exists(ipath):
+            try:
+                index = CaptureIndex.read(ipath)
+            except (hcapng.HCapException, OSError):
+                pass
+            if index is not None and index.stamp != capture_stamp(f):
+                index = None
+
+        if index is None and not build:
+            raise hcapng.HCapException('No index for {0!r}'.format(path))
+
+        capture = IndexedCapture(f, index)
+
+    if index is None:
+        try:
+            capture.index.write(ipath)
+        except OSError:
+            # keep the index in memory only, do not leave a partial one
+            try:
+                os.unlink(ipath)
+            except OSError:
+                pass
+    return capture
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build and query capture indexes')
+    parser.add_argument('capture', help='hcapng file')
+    parser.add_argument('--rebuild', action='store_const', default=False, const=True,
+                        help='Rebuild the index even if it is up to date')
+    parser.add_argument('--stream', type=int, help='Print the events of this stream')
+    parser.add_argument('--since', type=int, help='Print the events from this timestamp on')
+
+    args = parser.parse_args()
+    if args.rebuild and os.path.exists(index_path(args.capture)):
+        os.unlink(index_path(args.capture))
+
+    with open_capture(args.capture) as capture:
+        if args.stream is not None:
+            events = capture.iter_stream(args.stream)
+        elif args.since is not None:
+            capture.seek(args.since)
+            events = iter(capture)
+        else:
+            events = None
+            for entry in capture.streams.values():
+                print(entry)
+
+        if events is not None:
+            for ts, event in events:
+                print('[{0:8}] {1!r}'.format(ts, event))
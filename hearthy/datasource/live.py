@@ -0,0 +1,238 @@
+"""
+Following hcapng captures while they are written.
+
+LiveCapture watches the capture file and parses whatever has been
+appended since the last read. On Linux the directory of the capture is
+watched with inotify, so changes are noticed right away and new files
+created under the same name (rotation) are picked up. Elsewhere, or if
+inotify is not usable, the file is polled.
+
+If the file shrinks (truncation) or is replaced, parsing restarts from
+the beginning of the new contents with a fresh parser, which yields a
+new EvHeader first.
+
+Usage from a blocking consumer:
+
+    with LiveCapture(path) as capture:
+        for ts, event in capture:
+            ...
+
+Event loops can wait on fileno() (None when polling) and call
+read_events() whenever it becomes readable or every poll_interval
+seconds.
+"""
+
+import os
+import struct
+import select
+import time
+from hearthy.datasource import hcapng
+
+# bytes read per system call
+READ_SIZE = 256 * 1024
+
+# seconds between checks when inotify is not available
+POLL_INTERVAL = 0.25
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+
+_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+               IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+_inotify_event = struct.Struct('iIII')
+
+class _Inotify:
+    """ Watches the directory of path, reports changes of path only. """
+    def __init__(self, path):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        init1 = libc.inotify_init1
+        add_watch = libc.inotify_add_watch
+        add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        fd = init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        directory, name = os.path.split(os.path.abspath(path))
+        if add_watch(fd, os.fsencode(directory), _WATCH_MASK) < 0:
+            e = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(e, os.strerror(e))
+
+        self.fd = fd
+        self._name = os.fsencode(name)
+
+    def drain(self):
+        """ Reads all pending events, returns True if one concerns path. """
+        hit = False
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return hit
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, nlen = _inotify_event.unpack_from(buf, offset)
+                offset += _inotify_event.size
+                name = buf[offset:offset + nlen].rstrip(b'\0')
+                offset += nlen
+                if name == self._name or mask & IN_Q_OVERFLOW:
+                    hit = True
+
+    def close(self):
+        os.close(self.fd)
+
+class LiveCapture:
+    """
+    Follows the hcapng capture at path, see module docstring. If
+    use_inotify is false, the file is always polled.
+
+    The data of EvData events is only valid until the next event is
+    requested.
+    """
+    def __init__(self, path, read_size=READ_SIZE, poll_interval=POLL_INTERVAL, use_inotify=True):
+        self.path = path
+        self.read_size = read_size
+        self.poll_interval = poll_interval
+
+        # number of times parsing started over because of truncation
+        # or rotation
+        self.restarts = 0
+
+        self._fd = None
+        self._stat = None
+        self._offset = 0
+        self._parser = hcapng.AsyncParser()
+
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = _Inotify(path)
+            except (OSError, AttributeError):
+                # not linux or no inotify
+                pass
+
+    def fileno(self):
+        """
+        File descriptor that becomes readable when the capture changes,
+        None if the capture is polled.
+        """
+        return self._inotify.fd if self._inotify is not None else None
+
+    def _open(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        self._fd = fd
+        self._stat = os.fstat(fd)
+        self._offset = 0
+        return True
+
+    def _restart(self):
+        self._parser = hcapng.AsyncParser()
+        self._offset = 0
+        self.restarts += 1
+
+    def _replaced(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (st.st_ino, st.st_dev) != (self._stat.st_ino, self._stat.st_dev)
+
+    def read_events(self):
+        """ Yields (ts, event) for everything appended since the last call. """
+        if self._inotify is not None:
+            self._inotify.drain()
+
+        while True:
+            if self._fd is None and not self._open():
+                return
+
+            fd = self._fd
+            if os.fstat(fd).st_size < self._offset:
+                os.lseek(fd, 0, os.SEEK_SET)
+                self._restart()
+
+            parser = self._parser
+            read_size = self.read_size
+            while True:
+                n = os.readv(fd, [parser.get_buffer(read_size)])
+                if n == 0:
+                    break
+                self._offset += n
+                yield from parser.commit(n)
+
+            # switch over once the old file has been read completely
+            if not self._replaced():
+                return
+            os.close(fd)
+            self._fd = None
+            self._restart()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the capture may have changed or timeout seconds
+        have passed.
+        """
+        if self._inotify is None:
+            interval = self.poll_interval
+            time.sleep(interval if timeout is None else min(interval, timeout))
+            return
+
+        # ignore changes of other files in the directory
+        fd = self._inotify.fd
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable or self._inotify.drain():
+                return
+
+    def __iter__(self):
+        while True:
+            yield from self.read_events()
+            self.wait()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return '<LiveCapture path={0!r} offset={1} restarts={2} inotify={3}>'.format(
+            self.path, self._offset, self.restarts, self._inotify is not None)
+
+if __name__ == '__main__':
+    import sys
+
+    with LiveCapture(sys.argv[1]) as capture:
+        try:
+            for ts, event in capture:
+                print('[{0:8}] {1!r}'.format(ts, event))
+        except KeyboardInterrupt:
+            pass
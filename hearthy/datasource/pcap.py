@@ -0,0 +1,526 @@
+"""
+Reading of pcap and pcapng captures.
+
+parse() reads a capture written by tcpdump, wireshark or similar,
+reassembles the TCP streams to or from the game and battle.net ports
+and yields the same events as hcapng.parse():
+
+    (0, EvHeader(unix time of the first packet))
+    (ts, EvNewConnection)     after the SYN/SYN-ACK exchange, or with
+                              the first data of a stream whose start
+                              was not captured
+    (ts, EvData)              reassembled data in stream order
+    (ts, EvClose)             after FIN from both sides or RST
+
+Timestamps are milliseconds since the second of the header, like the
+ones hcapture.c writes. who is 0 for data sent to the server and 1 for
+data sent to the client.
+
+The capture is read record by record, so memory use does not depend on
+its size. Out of order segments are held back per direction up to
+max_pending bytes; a stream with a larger gap cannot be decoded anymore
+and is closed. Streams without packets for FLOW_TIMEOUT seconds are
+closed as well.
+
+Streams picked up in the middle (the capture started after the
+connection was opened) may begin in the middle of a packet, so their
+start usually does not decode. Data arriving for a stream that has just
+been closed does not open a new one.
+
+Only IPv4 is supported, since hcapng stores IPv4 addresses.
+"""
+
+import struct
+from hearthy.datasource import hcapng
+
+PORTS = (1119, 3724)
+
+# bytes of out of order data held back per direction
+MAX_PENDING = 1024 * 1024
+
+# seconds of capture time after which idle streams are closed
+FLOW_TIMEOUT = 30 * 60
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BOM = 0x1a2b3c4d
+
+BLOCK_IDB = 1
+BLOCK_PB = 2
+BLOCK_SPB = 3
+BLOCK_EPB = 6
+
+OPT_END = 0
+OPT_IF_TSRESOL = 9
+OPT_IF_TSOFFSET = 14
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+# DLT values some systems use for raw ip
+_RAW_TYPES = (LINKTYPE_RAW, LINKTYPE_IPV4, 12, 14)
+
+ETHERTYPE_IPV4 = 0x0800
+_VLAN_TYPES = (0x8100, 0x88a8, 0x9100)
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+class PcapException(hcapng.HCapException):
+    pass
+
+def _read(f, n):
+    buf = f.read(n)
+    if len(buf) < n:
+        raise PcapException('Unexpected EOF!')
+    return buf
+
+def _pcap_records(f, head):
+    """ Yields (ts in us, linktype, data) of a pcap file. """
+    magic = struct.unpack('<I', head)[0]
+    if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+        order = '<'
+    else:
+        order = '>'
+        magic = struct.unpack('>I', head)[0]
+    div = 1000 if magic == PCAP_MAGIC_NS else 1
+
+    header = _read(f, 20)
+    linktype = struct.unpack(order + 'HHiIII', header)[5] & 0x03ffffff
+
+    record = struct.Struct(order + 'IIII')
+    while True:
+        buf = f.read(record.size)
+        if len(buf) < record.size:
+            # a partial record at the end of a capture still being written
+            return
+        sec, frac, caplen, origlen = record.unpack(buf)
+        data = f.read(caplen)
+        if len(data) < caplen:
+            return
+        yield (sec * 1000000 + frac // div, linktype, data)
+
+class _Interface:
+    __slots__ = ['linktype', 'snaplen', 'units', 'offset']
+
+    def __init__(self, linktype, snaplen, units, offset):
+        self.linktype = linktype
+        # 0 if not limited
+        self.snaplen = snaplen
+        # timestamp units per second
+        self.units = units
+        # seconds to add to timestamps
+        self.offset = offset
+
+def _parse_idb(order, body):
+    linktype, _, snaplen = struct.unpack_from(order + 'HHI', body)
+    units = 1000000
+    offset = 0
+
+    pos = 8
+    while pos + 4 <= len(body):
+        code, length = struct.unpack_from(order + 'HH', body, pos)
+        pos += 4
+        if code == OPT_END:
+            break
+        value = body[pos:pos + length]
+        if code == OPT_IF_TSRESOL and length == 1:
+            res = value[0]
+            units = 2 ** (res & 0x7f) if res & 0x80 else 10 ** res
+        elif code == OPT_IF_TSOFFSET and length == 8:
+            offset = struct.unpack(order + 'q', value)[0]
+        pos += (length + 3) & ~3
+
+    return _Interface(linktype, snaplen, units, offset)
+
+def _pcapng_records(f, head):
+    """ Yields (ts in us, linktype, data) of a pcapng file. """
+    interfaces = []
+    order = '<'
+    ts = 0
+
+    while True:
+        if head is None:
+            head = f.read(8)
+            if len(head) < 8:
+                return
+
+        if struct.unpack('<I', head[:4])[0] == PCAPNG_SHB:
+            # section header, sets the byte order of the section
+            bom = _read(f, 4)
+            if struct.unpack('<I', bom)[0] == PCAPNG_BOM:
+                order = '<'
+            elif struct.unpack('>I', bom)[0] == PCAPNG_BOM:
+                order = '>'
+            else:
+                raise PcapException('Bad byte order magic {0!r}'.format(bom))
+            length = struct.unpack(order + 'I', head[4:])[0]
+            f.read(length - 12)
+            interfaces = []
+            head = None
+            continue
+
+        btype, length = struct.unpack(order + 'II', head)
+        head = None
+        if length < 12:
+            raise PcapException('Got invalid block length {0}'.format(length))
+        body = f.read(length - 8)
+        if len(body) < length - 8:
+            return
+        body = memoryview(body)[:-4]
+
+        if btype == BLOCK_IDB:
+            interfaces.append(_parse_idb(order, body))
+        elif btype == BLOCK_EPB or btype == BLOCK_PB:
+            if btype == BLOCK_EPB:
+                iface, high, low, caplen = struct.unpack_from(order + 'IIII', body)
+            else:
+                iface, drops, high, low, caplen = struct.unpack_from(order + 'HHIII', body)
+            if iface >= len(interfaces):
+                raise PcapException('Packet for unknown interface {0}'.format(iface))
+            intf = interfaces[iface]
+            ts = ((high << 32) | low) * 1000000 // intf.units + intf.offset * 1000000
+            yield (ts, intf.linktype, body[20:20 + caplen])
+        elif btype == BLOCK_SPB and interfaces:
+            # no timestamp, use the one of the previous packet; the
+            # captured length is only implied, the block is padded
+            intf = interfaces[0]
+            caplen = min(struct.unpack_from(order + 'I', body)[0], len(body) - 4)
+            if intf.snaplen:
+                caplen = min(caplen, intf.snaplen)
+            yield (ts, intf.linktype, body[4:4 + caplen])
+
+def records(f):
+    """
+    Yields (ts in microseconds, linktype, data) for all packets of
+    the pcap or pcapng file f.
+    """
+    head = f.read(4)
+    if len(head) < 4:
+        raise PcapException('Unexpected EOF!')
+
+    magic = struct.unpack('<I', head)[0]
+    if magic == PCAPNG_SHB:
+        return _pcapng_records(f, head + _read(f, 4))
+    elif magic in (PCAP_MAGIC, PCAP_MAGIC_NS) or struct.unpack('>I', head)[0] in (PCAP_MAGIC, PCAP_MAGIC_NS):
+        return _pcap_records(f, head)
+    raise PcapException('Not a pcap or pcapng file, magic {0!r}'.format(head))
+
+def _ipv4(linktype, data):
+    """ Returns the IPv4 packet in the link layer frame data or None. """
+    if linktype == LINKTYPE_ETHERNET:
+        if len(data) < 14:
+            return None
+        pos = 12
+        ethertype = (data[pos] << 8) | data[pos + 1]
+        while ethertype in _VLAN_TYPES and len(data) >= pos + 6:
+            pos += 4
+            ethertype = (data[pos] << 8) | data[pos + 1]
+        if ethertype != ETHERTYPE_IPV4:
+            return None
+        return data[pos + 2:]
+    elif linktype in _RAW_TYPES:
+        return data
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if len(data) < 16 or ((data[14] << 8) | data[15]) != ETHERTYPE_IPV4:
+            return None
+        return data[16:]
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if len(data) < 20 or ((data[0] << 8) | data[1]) != ETHERTYPE_IPV4:
+            return None
+        return data[20:]
+    elif linktype == LINKTYPE_NULL or linktype == LINKTYPE_LOOP:
+        # address family in host (NULL) or network (LOOP) byte order
+        if len(data) < 4 or 2 not in (data[0], data[3]):
+            return None
+        return data[4:]
+    return None
+
+class _Half:
+    """ Reassembles one direction of a TCP stream. """
+    __slots__ = ['next_seq', 'pending', 'pending_bytes', 'fin_seq', 'closed']
+
+    def __init__(self, isn):
+        # None if the start was not captured, set by the first segment
+        self.next_seq = None if isn is None else (isn + 1) & 0xffffffff
+        # seq -> data of segments after a gap
+        self.pending = {}
+        self.pending_bytes = 0
+        self.fin_seq = None
+        self.closed = False
+
+    def _offset(self, seq):
+        off = (seq - self.next_seq) & 0xffffffff
+        return off - 0x100000000 if off & 0x80000000 else off
+
+    def add(self, seq, data):
+        """ Returns the list of data that is now in order. """
+        if self.next_seq is None:
+            self.next_seq = seq
+        ret = []
+        off = self._offset(seq)
+        if off > 0:
+            if len(data) > len(self.pending.get(seq, b'')):
+                self.pending_bytes += len(data) - len(self.pending.get(seq, b''))
+                self.pending[seq] = data
+            return ret
+
+        if -off < len(data):
+            ret.append(data[-off:])
+            self.next_seq = (self.next_seq + len(data) + off) & 0xffffffff
+
+        progress = bool(ret)
+        while progress and self.pending:
+            progress = False
+            for pseq in list(self.pending):
+                off = self._offset(pseq)
+                if off > 0:
+                    continue
+                pdata = self.pending.pop(pseq)
+                self.pending_bytes -= len(pdata)
+                if -off < len(pdata):
+                    ret.append(pdata[-off:])
+                    self.next_seq = (self.next_seq + len(pdata) + off) & 0xffffffff
+                    progress = True
+
+        if self.fin_seq is not None and self._offset(self.fin_seq) <= 0:
+            self.closed = True
+        return ret
+
+    def fin(self, seq):
+        if self.next_seq is None:
+            self.next_seq = seq
+        self.fin_seq = seq
+        if self._offset(seq) <= 0:
+            self.closed = True
+
+class _Flow:
+    __slots__ = ['stream_id', 'source', 'dest', 'halves', 'client_isn', 'last_ts']
+
+    def __init__(self, source, dest, client_isn, ts):
+        self.stream_id = None
+        self.source = source
+        self.dest = dest
+        self.halves = None
+        self.client_isn = client_isn
+        self.last_ts = ts
+
+def _new_connection(stream_id, source, dest):
+    ev = hcapng.EvNewConnection()
+    ev.stream_id = stream_id
+    ev.source = (hcapng._format_ipv4(source[0]), source[1])
+    ev.dest = (hcapng._format_ipv4(dest[0]), dest[1])
+    return ev
+
+def _close(stream_id):
+    ev = hcapng.EvClose()
+    ev.stream_id = stream_id
+    return ev
+
+def _data(stream_id, who, data):
+    ev = hcapng.EvData()
+    ev.stream_id = stream_id
+    ev.who = who
+    ev.data = data
+    return ev
+
+_ip_header = struct.Struct('!BBHHHBBHII')
+_tcp_header = struct.Struct('!HHIIBB')
+
+class Reassembler:
+    """
+    Turns IPv4 packets into hcapng events, see module docstring.
+    Streams are those with one of ports as server port.
+    """
+    def __init__(self, ports=PORTS, max_pending=MAX_PENDING, timeout=FLOW_TIMEOUT):
+        self.ports = frozenset(ports)
+        self.max_pending = max_pending
+        self.timeout = timeout * 1000
+
+        # (client ip, client port, server ip, server port) -> _Flow
+        self.flows = {}
+        # same key -> ts, flows closed within timeout
+        self._ended = {}
+        self._next_id = 0
+        self._next_expire = 0
+
+        # packets skipped because they were fragmented
+        self.fragments = 0
+        # streams closed because of a gap in the data
+        self.broken = 0
+        # streams picked up without seeing their SYN/SYN-ACK
+        self.midstream = 0
+
+    def _end(self, key, flow, ts, events):
+        del self.flows[key]
+        self._ended[key] = ts
+        if flow.stream_id is not None:
+            events.append((ts, _close(flow.stream_id)))
+
+    def _start(self, flow, server_isn, ts, events):
+        flow.halves = [_Half(flow.client_isn), _Half(server_isn)]
+        flow.stream_id = self._next_id
+        self._next_id += 1
+        flow.last_ts = ts
+        events.append((ts, _new_connection(flow.stream_id, flow.source, flow.dest)))
+
+    def expire(self, ts, events):
+        """ Closes streams idle since before ts - timeout. """
+        for key, flow in list(self.flows.items()):
+            if ts - flow.last_ts > self.timeout:
+                self._end(key, flow, ts, events)
+        for key, ended in list(self._ended.items()):
+            if ts - ended > self.timeout:
+                del self._ended[key]
+
+    def packet(self, ts, ip):
+        """
+        Processes the IPv4 packet ip captured at ts (ms). Returns a
+        list of (ts, event).
+        """
+        events = []
+        if ts >= self._next_expire:
+            self.expire(ts, events)
+            self._next_expire = ts + self.timeout // 10
+
+        if len(ip) < 20:
+            return events
+        vihl, tos, total, ident, frag, ttl, proto, csum, saddr, daddr = _ip_header.unpack_from(ip)
+        if vihl >> 4 != 4 or proto != 6:
+            return events
+        if frag & 0x3fff:
+            # more fragments or fragment offset set
+            self.fragments += 1
+            return events
+
+        ihl = (vihl & 0xf) * 4
+        tcp = ip[ihl:total] if total >= ihl else ip[ihl:]
+        if len(tcp) < 20:
+            return events
+        sport, dport, seq, ack, doff, flags = _tcp_header.unpack_from(tcp)
+        payload = tcp[(doff >> 4) * 4:]
+
+        if dport in self.ports:
+            key = (saddr, sport, daddr, dport)
+            who = 0
+        elif sport in self.ports:
+            key = (daddr, dport, saddr, sport)
+            who = 1
+        else:
+            return events
+
+        flow = self.flows.get(key, None)
+
+        if flags & TCP_SYN:
+            if who == 0 and not flags & TCP_ACK:
+                if flow is not None:
+                    if flow.client_isn == seq:
+                        # retransmitted SYN
+                        return events
+                    self._end(key, flow, ts, events)
+                self._ended.pop(key, None)
+                self.flows[key] = _Flow(key[:2], key[2:], seq, ts)
+            elif who == 1 and flow is not None and flow.halves is None:
+                self._start(flow, seq, ts, events)
+            return events
+
+        if flow is None or flow.halves is None:
+            if not payload or flags & TCP_RST or key in self._ended:
+                return events
+            # the connection was opened before the capture started (or
+            # the SYN-ACK was missed), start with this segment
+            self.midstream += 1
+            if flow is None:
+                flow = self.flows[key] = _Flow(key[:2], key[2:], None, ts)
+            self._start(flow, None, ts, events)
+        flow.last_ts = ts
+
+        if flags & TCP_RST:
+            self._end(key, flow, ts, events)
+            return events
+
+        half = flow.halves[who]
+        if payload:
+            stream_id = flow.stream_id
+            for data in half.add(seq, bytes(payload)):
+                for i in range(0, len(data), hcapng.MAX_DATA):
+                    events.append((ts, _data(stream_id, who, data[i:i + hcapng.MAX_DATA])))
+            if half.pending_bytes > self.max_pending:
+                self.broken += 1
+                self._end(key, flow, ts, events)
+                return events
+
+        if flags & TCP_FIN:
+            half.fin((seq + len(payload)) & 0xffffffff)
+
+        if flow.halves[0].closed and flow.halves[1].closed:
+            self._end(key, flow, ts, events)
+        return events
+
+def parse(f, ports=PORTS, max_pending=MAX_PENDING):
+    """
+    Yields (ts, event) for the TCP streams on ports in the pcap or
+    pcapng file f, starting with an EvHeader. See module docstring.
+    """
+    reassembler = Reassembler(ports, max_pending)
+    base = None
+
+    for ts, linktype, data in records(f):
+        if base is None:
+            base = ts // 1000000
+            yield (0, hcapng.EvHeader(base))
+            base *= 1000
+
+        ip = _ipv4(linktype, data)
+        if ip is not None:
+            yield from reassembler.packet(ts // 1000 - base, ip)
+
+    if base is None:
+        yield (0, hcapng.EvHeader(0))
+
+def convert(src, dst, method=None, ports=PORTS):
+    """
+    Converts the pcap or pcapng capture in file src to a hcapng
+    capture written to dst, compressed (HCaptureV1) if method is given.
+    """
+    events = parse(src, ports)
+    _, header = next(events)
+
+    if method is None:
+        dst.write(hcapng.encode_header(header.ts))
+        for ts, event in events:
+            dst.write(hcapng.encode_event(ts, event))
+    else:
+        writer = hcapng.BlockWriter(dst, header.ts, method)
+        for ts, event in events:
+            writer.write_raw(ts, hcapng.encode_event(ts, event))
+        writer.close()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Print or convert pcap captures')
+    parser.add_argument('file', help='pcap or pcapng file')
+    parser.add_argument('--convert', metavar='OUT', help='Write the streams to a hcapng file')
+    parser.add_argument('--method', choices=sorted(hcapng.METHODS),
+                        help='Write a compressed capture with this method')
+    parser.add_argument('--port', type=int, action='append',
+                        help='Server port to follow, may be repeated')
+    args = parser.parse_args()
+
+    ports = args.port or PORTS
+    with open(args.file, 'rb') as f:
+        if args.convert is not None:
+            with open(args.convert, 'wb') as out:
+                convert(f, out, args.method, ports)
+        else:
+            for ts, event in parse(f, ports):
+                print('[{0:8}] {1!r}'.format(ts, event))
@@ -0,0 +1,86 @@
+"""
+Compares the decoding speed of the pure-Python and the native
+protobuf backend on the PowerHistory packets of a capture.
+
+Each backend is timed once materializing the complete packets and
+once only looking at the TagChange entries, which is what the tracker
+mostly does.
+"""
+
+import time
+from hearthy.protocol import mtypes, native
+from hearthy.protocol.lazy import view
+from hearthy.protocol.projection import Projection
+from hearthy.protocol.enums import PacketType
+from hearthy.protocol.utils import Splitter
+
+def collect_packets(f):
+    from hearthy.datasource import hcapng
+
+    packets = []
+    splitters = {}
+    parser = hcapng.parse_mapped(f)
+    next(parser)
+    for ts, event in parser:
+        if isinstance(event, hcapng.EvNewConnection):
+            splitters[event.stream_id] = [Splitter(), Splitter()]
+        elif isinstance(event, hcapng.EvClose):
+            splitters.pop(event.stream_id, None)
+        elif isinstance(event, hcapng.EvData) and event.stream_id in splitters:
+            for atype, buf in splitters[event.stream_id][event.who].feed(event.data):
+                if atype == PacketType.POWER_HISTORY:
+                    packets.append(bytes(buf))
+    return packets
+
+def touch_tag_changes(packet):
+    for data in packet.List:
+        try:
+            change = data.TagChange
+        except AttributeError:
+            continue
+        change.Entity, change.Tag, change.Value
+
+def bench(decode, packets, rounds):
+    best = None
+    for i in range(rounds):
+        start = time.perf_counter()
+        for buf in packets:
+            decode(buf)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) < 2:
+        print('Usage: {0} <hcapng file> [rounds]'.format(sys.argv[0]), file=sys.stderr)
+        sys.exit(1)
+
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with open(sys.argv[1], 'rb') as f:
+        packets = collect_packets(f)
+
+    total = sum(len(x) for x in packets)
+    print('{0} PowerHistory packets, {1} bytes'.format(len(packets), total))
+
+    decode = mtypes.PowerHistory.decode_buf
+    projected = Projection(['PowerHistory.List.TagChange']).get_decoder(mtypes.PowerHistory)
+    backends = [
+        ('python', decode),
+        ('python tagchange', lambda buf: touch_tag_changes(decode(buf))),
+        ('python lazy tagchange', lambda buf: touch_tag_changes(view(mtypes.PowerHistory, buf))),
+        ('python projected tagchange', lambda buf: touch_tag_changes(projected(buf)))
+    ]
+    if native.load():
+        backends.extend([
+            ('native', lambda buf: native.decode(mtypes.PowerHistory, buf).materialize()),
+            ('native tagchange', lambda buf: touch_tag_changes(native.decode(mtypes.PowerHistory, buf)))
+        ])
+    else:
+        print('native backend not available')
+
+    for name, fn in backends:
+        elapsed = bench(fn, packets, rounds)
+        print('{0:>26}: {1:.4f}s ({2:.1f} MB/s)'.format(
+            name, elapsed, total / elapsed / 1e6 if elapsed else 0))
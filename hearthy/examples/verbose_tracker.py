@@ -11,34 +11,54 @@ class Connection:
 
     def feed(self, who, buf):
         for atype, abuf in self._s[who].feed(buf):
-            decoded = decode_packet(atype, abuf)
+            decoded = decode_packet(atype, abuf, fields=processor.PROJECTION)
             self._t.process(who, decoded)
 
     def __repr__(self):
         print('<Connection source={0!r} dest={1!r}'.format(
             self.p[0], self.p[1]))
 
-if __name__ == '__main__':
-    import sys
+def run_serial(f):
     from hearthy.datasource import hcapng
 
-    if len(sys.argv) < 2:
-        print('Usage: {0} <hcapng file>'.format(sys.argv[0]))
-        sys.exit(1)
-
     d = {}
-    with open(sys.argv[1], 'rb') as f:
-        parser = hcapng.parse(f)
-        begin = next(parser)
-        for ts, event in parser:
-            if isinstance(event, hcapng.EvClose):
-                if event.stream_id in d:
+    parser = hcapng.parse_mapped(f)
+    begin = next(parser)
+    for ts, event in parser:
+        if isinstance(event, hcapng.EvClose):
+            if event.stream_id in d:
+                del d[event.stream_id]
+        elif isinstance(event, hcapng.EvData):
+            if event.stream_id in d:
+                try:
+                    d[event.stream_id].feed(event.who, event.data)
+                except exceptions.BufferFullException:
                     del d[event.stream_id]
-            elif isinstance(event, hcapng.EvData):
-                if event.stream_id in d:
-                    try:
-                        d[event.stream_id].feed(event.who, event.data)
-                    except exceptions.BufferFullException:
-                        del d[event.stream_id]
-            elif isinstance(event, hcapng.EvNewConnection):
-                d[event.stream_id] = Connection(event.source, event.dest)
+        elif isinstance(event, hcapng.EvNewConnection):
+            d[event.stream_id] = Connection(event.source, event.dest)
+
+def run_parallel(f, jobs):
+    from hearthy.tracker import parallel
+
+    for stream_id, event in parallel.generate_logs(f, jobs=jobs, process=True, packets=False):
+        if event[0] == 'exception':
+            print('Stream {0}: {1!r}'.format(stream_id, event[1]))
+        elif event[0] == 'world':
+            print('Stream {0}: {1} entities'.format(
+                stream_id, sum(1 for e in event[1])))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Track all games in a capture')
+    parser.add_argument('file', help='hcapng file')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='Decode with this many worker processes')
+
+    args = parser.parse_args()
+
+    with open(args.file, 'rb') as f:
+        if args.jobs > 0:
+            run_parallel(f, args.jobs)
+        else:
+            run_serial(f)
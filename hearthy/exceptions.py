@@ -10,10 +10,17 @@ class CardNotFound(Exception):
 class EntityNotFound(Exception):
     def __init__(self, eid):
         super().__init__('Could not find entity with id={0}'.format(eid))
+        self.eid = eid
+
+    def __reduce__(self):
+        return (self.__class__, (self.eid,))
 
 class UnexpectedEof(Exception):
     def __init__(self):
         super().__init__('Encountered an unepxected end of file')
 
+    def __reduce__(self):
+        return (self.__class__, ())
+
 class BufferFullException(Exception):
     pass
@@ -0,0 +1,631 @@
+"""
+Generates specialized decode and encode functions for MStruct types.
+
+The generic MStruct.decode_buf looks up every field in _mfields_ and
+dispatches on the handler type at runtime. The functions generated here
+have field numbers, wire types and target slots inlined. A type's code
+is compiled the first time it decodes or encodes a message, so that
+importing many types stays cheap.
+
+Encoding works in two passes: _byte_size(sizes) computes the size of
+the message and records the sizes of all nested messages (and the
+encoded form of strings) in pre-order. _encode_into(buf, offset, nxt)
+then writes the message front to back, taking the recorded values in
+the same order, so length prefixes can be written directly.
+
+build_view generates the field access of lazy views, see
+hearthy.protocol.lazy.
+"""
+
+import struct
+from array import array
+from hearthy.protocol import mstruct, serialize
+from hearthy.exceptions import DecodeError
+
+_MISSING = object()
+
+def _decode_slow(cls, a, buf, offset):
+    """
+    Decodes a single field in the same way as the generic
+    MStruct.decode_buf does. Used for unexpected wire types.
+    Returns (field_number, value, offset).
+    """
+    field_number = a >> 3
+    wtype = a & 7
+
+    our = cls._mfields_.get(field_number, None)
+    if our is None:
+        raise DecodeError('No field definition for type {0!r} slot {1} wire type {2}'.format(cls.__name__, field_number, wtype))
+    typehandler = our[1]
+
+    if wtype == serialize.WTYPE_LEN_DELIM:
+        length, offset = serialize.read_varint(buf, offset)
+        val = typehandler.decode_buf(buf, offset, end=offset+length)
+        offset += length
+    elif wtype in (serialize.WTYPE_VARINT, serialize.WTYPE_FIXED32, serialize.WTYPE_FIXED64):
+        val, offset = typehandler.decode_buf(buf, offset)
+    else:
+        raise DecodeError('Unhandled wire type {0}'.format(wtype))
+    return (field_number, val, offset)
+
+class _Source:
+    def __init__(self):
+        self.lines = []
+        self.indent = 0
+
+    def __call__(self, line):
+        self.lines.append('    ' * self.indent + line)
+
+    def __str__(self):
+        return '\n'.join(self.lines) + '\n'
+
+def _emit_varint(src, target, signed):
+    src('{0} = buf[offset]'.format(target))
+    src('if {0} < 128:'.format(target))
+    src('    offset += 1')
+    src('else:')
+    src('    {0}, offset = read_varint(buf, offset, {1})'.format(target, signed))
+
+def _emit_len(src):
+    _emit_varint(src, 'n', True)
+    src('after = offset + n')
+
+def _emit_store(src, var, is_array, expr):
+    if is_array:
+        src('{0}.append({1})'.format(var, expr))
+    else:
+        src('if {0} is not _MISSING:'.format(var))
+        src("    raise DecodeError('Duplicated slot for non-array type')")
+        src('{0} = {1}'.format(var, expr))
+
+def _skip_slow(cls, a, buf, offset):
+    """
+    Skips a single field of any wire type. Returns the new offset.
+    """
+    wtype = a & 7
+    if wtype == serialize.WTYPE_LEN_DELIM:
+        length, offset = serialize.read_varint(buf, offset)
+        return offset + length
+    elif wtype == serialize.WTYPE_VARINT:
+        return serialize.read_varint(buf, offset)[1]
+    elif wtype == serialize.WTYPE_FIXED32:
+        return offset + 4
+    elif wtype == serialize.WTYPE_FIXED64:
+        return offset + 8
+    raise DecodeError('Unhandled wire type {0}'.format(wtype))
+
+def _emit_skip(src, cond, k, name, th, is_array):
+    """
+    Emits branches that jump over a field without decoding it.
+    """
+    wtypes = []
+    if isinstance(th, mstruct.MInteger):
+        wtypes.append(serialize.WTYPE_VARINT)
+    elif isinstance(th, mstruct.MBasicFixed):
+        wtypes.append(serialize.WTYPE_FIXED32 if th._n_bytes == 4 else serialize.WTYPE_FIXED64)
+    if is_array or not wtypes:
+        wtypes.append(serialize.WTYPE_LEN_DELIM)
+
+    for wtype in wtypes:
+        src('{0} a == {1}: # {2} (skipped)'.format(cond, k << 3 | wtype, name))
+        src.indent += 1
+        if wtype == serialize.WTYPE_LEN_DELIM:
+            _emit_len(src)
+            src('offset = after')
+        elif wtype == serialize.WTYPE_VARINT:
+            src('while buf[offset] & 0x80:')
+            src('    offset += 1')
+            src('offset += 1')
+        else:
+            src('offset += {0}'.format(th._n_bytes))
+        src.indent -= 1
+        cond = 'elif'
+    return cond
+
+def _emit_fields(src, namespace, fields, skipped=(), recorded=()):
+    """
+    Emits the if-chain dispatching on the key byte. `fields` is a
+    list of (field_number, name, typehandler, is_array, var, sub)
+    where sub is the name of a projected decoder for nested messages
+    or None. Fields in `skipped` are (field_number, name, typehandler,
+    is_array) and are jumped over. Fields in `recorded` are
+    (field_number, name, is_array, var), only the start and end
+    offsets of their (length delimited) values are kept.
+    """
+    cond = 'if'
+    for k, name, is_array, var in recorded:
+        src('{0} a == {1}: # {2} (recorded)'.format(cond, k << 3 | serialize.WTYPE_LEN_DELIM, name))
+        src.indent += 1
+        _emit_len(src)
+        if is_array:
+            src('{0}.append(offset)'.format(var))
+            src('{0}.append(after)'.format(var))
+        else:
+            src('if {0} >= 0:'.format(var))
+            src("    raise DecodeError('Duplicated slot for non-array type')")
+            src('{0} = offset'.format(var))
+            src('{0}_end = after'.format(var))
+        src('offset = after')
+        src.indent -= 1
+        cond = 'elif'
+
+    for k, name, th, is_array, var, sub in fields:
+        if isinstance(th, mstruct.MInteger):
+            src('{0} a == {1}: # {2}'.format(cond, k << 3 | serialize.WTYPE_VARINT, name))
+            src.indent += 1
+            _emit_varint(src, 'val', th._signed)
+            _emit_store(src, var, is_array, 'val')
+            src.indent -= 1
+            cond = 'elif'
+            if is_array:
+                src('elif a == {0}: # {1} (packed)'.format(k << 3 | serialize.WTYPE_LEN_DELIM, name))
+                src.indent += 1
+                _emit_len(src)
+                src('{0}.extend(read_packed_varint_array(buf, offset, after, {1}, {2!r}))'.format(var, th._signed, th.typecode))
+                src('offset = after')
+                src.indent -= 1
+        elif isinstance(th, mstruct.MBasicFixed):
+            wtype = serialize.WTYPE_FIXED32 if th._n_bytes == 4 else serialize.WTYPE_FIXED64
+            namespace['U_{0}'.format(k)] = struct.Struct('<' + th._s).unpack_from
+            src('{0} a == {1}: # {2}'.format(cond, k << 3 | wtype, name))
+            src.indent += 1
+            _emit_store(src, var, is_array, 'U_{0}(buf, offset)[0]'.format(k))
+            src('offset += {0}'.format(th._n_bytes))
+            src.indent -= 1
+            cond = 'elif'
+            if is_array:
+                namespace['T_{0}'.format(k)] = th
+                src('elif a == {0}: # {1} (packed)'.format(k << 3 | serialize.WTYPE_LEN_DELIM, name))
+                src.indent += 1
+                _emit_len(src)
+                src('{0}.extend(read_packed_fixed_array(buf, offset, after, {1!r}))'.format(var, th.typecode))
+                src('offset = after')
+                src.indent -= 1
+        else:
+            src('{0} a == {1}: # {2}'.format(cond, k << 3 | serialize.WTYPE_LEN_DELIM, name))
+            src.indent += 1
+            _emit_len(src)
+            if th is mstruct.MBytes:
+                _emit_store(src, var, is_array, 'bytes(buf[offset:after])')
+            elif th is mstruct.MString:
+                src('try:')
+                src("    val = str(buf[offset:after], 'UTF-8')")
+                src('except UnicodeDecodeError as e:')
+                src('    raise DecodeError(e.reason)')
+                _emit_store(src, var, is_array, 'val')
+            else:
+                namespace['T_{0}'.format(k)] = th
+                if sub is None:
+                    _emit_store(src, var, is_array, 'T_{0}.decode_buf(buf, offset, after)'.format(k))
+                else:
+                    _emit_store(src, var, is_array, '{0}(T_{1}, buf, offset, after)'.format(sub, k))
+            src('offset = after')
+            src.indent -= 1
+            cond = 'elif'
+
+    for k, name, th, is_array in skipped:
+        cond = _emit_skip(src, cond, k, name, th, is_array)
+
+    # anything unexpected takes the generic route
+    if cond == 'if':
+        src('if True:')
+    else:
+        src('else:')
+    src.indent += 1
+    if recorded:
+        namespace['RECORDED'] = frozenset(x[0] for x in recorded)
+        src('if a >> 3 in RECORDED:')
+        src("    raise DecodeError('Wire type {0} does not match field type'.format(a & 7))")
+    if skipped:
+        namespace['SKIPPED'] = frozenset(x[0] for x in skipped)
+        src('if a >> 3 in SKIPPED:')
+        src('    offset = _skip_slow(cls, a, buf, offset)')
+        src('    continue')
+    src('k, val, offset = _decode_slow(cls, a, buf, offset)')
+    cond = 'if'
+    for k, name, th, is_array, var, sub in fields:
+        src('{0} k == {1}:'.format(cond, k))
+        src.indent += 1
+        if is_array:
+            src('if isinstance(val, (list, array)):')
+            src('    {0}.extend(val)'.format(var))
+            src('else:')
+            src('    {0}.append(val)'.format(var))
+        else:
+            _emit_store(src, var, False, 'val')
+        src.indent -= 1
+        cond = 'elif'
+    src.indent -= 1
+
+def build_decoder(cls, projection=None):
+    """
+    Generates and compiles a decode_buf function for the given
+    MStruct subclass. Returns the plain (unbound) function.
+
+    If projection is given only the fields it contains are decoded,
+    all others are skipped and left unset. It maps field numbers to
+    None (decode the whole field) or to a projection of the nested
+    message type.
+    """
+    namespace = {
+        'read_varint': serialize.read_varint,
+        'read_packed_varint_array': serialize.read_packed_varint_array,
+        'read_packed_fixed_array': serialize.read_packed_fixed_array,
+        'array': array,
+        'DecodeError': DecodeError,
+        '_MISSING': _MISSING,
+        '_decode_slow': _decode_slow,
+        '_skip_slow': _skip_slow,
+        '_new': object.__new__
+    }
+
+    fields = []
+    skipped = []
+    for i, (k, (name, th, is_array)) in enumerate(cls._mfields_.items()):
+        sub = None
+        if projection is not None:
+            if k not in projection:
+                skipped.append((k, name, th, is_array))
+                continue
+            if projection[k] is not None:
+                sub = 'D_{0}'.format(k)
+                namespace[sub] = build_decoder(th, projection[k])
+        fields.append((k, name, th, is_array, 'v{0}'.format(i), sub))
+
+    src = _Source()
+    src('def decode_buf(cls, buf, offset=0, end=None):')
+    src.indent += 1
+    src('if end is None:')
+    src('    end = len(buf)')
+    numeric_arrays = False
+    for k, name, th, is_array, var, sub in fields:
+        if not is_array:
+            src('{0} = _MISSING'.format(var))
+        elif isinstance(th, (mstruct.MInteger, mstruct.MBasicFixed)):
+            numeric_arrays = True
+            src('{0} = array({1!r})'.format(var, th.typecode))
+        else:
+            src('{0} = []'.format(var))
+    if numeric_arrays:
+        # values not fitting into the array type
+        src('try:')
+        src.indent += 1
+    src('while offset < end:')
+    src.indent += 1
+    src('a = buf[offset]')
+    src('offset += 1')
+    _emit_fields(src, namespace, fields, skipped)
+    src.indent -= 1
+    if numeric_arrays:
+        src.indent -= 1
+        src('except OverflowError:')
+        src("    raise DecodeError('Value out of range for {0}')".format(cls.__name__))
+    src('ret = _new(cls)')
+    for k, name, th, is_array, var, sub in fields:
+        if is_array:
+            src('ret.{0} = {1}'.format(name, var))
+        else:
+            src('if {0} is not _MISSING:'.format(var))
+            src('    ret.{0} = {1}'.format(name, var))
+    src('return ret')
+
+    filename = '<generated {0}decoder for {1}.{2}>'.format(
+        'projected ' if projection is not None else '', cls.__module__, cls.__name__)
+    exec(compile(str(src), filename, 'exec'), namespace)
+    return namespace['decode_buf']
+
+def build_view(cls, view_type):
+    """
+    Generates the __getattr__ of the lazy view type of the given
+    MStruct subclass (see hearthy.protocol.lazy). view_type maps
+    message types to their view types.
+
+    On first use the message is scanned: numeric fields are decoded
+    right away, as finding their end means reading them anyway, and
+    are stored in their slots. Of all other fields only the offsets
+    are recorded, they are decoded when first accessed.
+    """
+    namespace = {
+        'read_varint': serialize.read_varint,
+        'read_packed_varint_array': serialize.read_packed_varint_array,
+        'read_packed_fixed_array': serialize.read_packed_fixed_array,
+        'array': array,
+        'DecodeError': DecodeError,
+        '_MISSING': _MISSING,
+        '_decode_slow': _decode_slow,
+        '_getattribute': object.__getattribute__,
+        'view_type': view_type,
+        'cls': cls
+    }
+
+    fields = []
+    recorded = []
+    # index of the offsets of each recorded field in the scan result
+    layout = []
+    n = 0
+    for i, (k, (name, th, is_array)) in enumerate(cls._mfields_.items()):
+        if isinstance(th, (mstruct.MInteger, mstruct.MBasicFixed)):
+            fields.append((k, name, th, is_array, 'v{0}'.format(i), None))
+        else:
+            recorded.append((k, name, is_array, 'r{0}'.format(i)))
+            layout.append((k, name, th, is_array, n))
+            n += 1 if is_array else 2
+
+    src = _Source()
+    src('def _scan(self, buf, offset, end):')
+    src.indent += 1
+    numeric_arrays = False
+    for k, name, th, is_array, var, sub in fields:
+        if not is_array:
+            src('{0} = _MISSING'.format(var))
+        else:
+            numeric_arrays = True
+            src('{0} = array({1!r})'.format(var, th.typecode))
+    for k, name, is_array, var in recorded:
+        if is_array:
+            src('{0} = []'.format(var))
+        else:
+            src('{0} = {0}_end = -1'.format(var))
+    if numeric_arrays:
+        src('try:')
+        src.indent += 1
+    src('while offset < end:')
+    src.indent += 1
+    src('a = buf[offset]')
+    src('offset += 1')
+    _emit_fields(src, namespace, fields, recorded=recorded)
+    src.indent -= 1
+    if numeric_arrays:
+        src.indent -= 1
+        src('except OverflowError:')
+        src("    raise DecodeError('Value out of range for {0}')".format(cls.__name__))
+    src('if offset != end:')
+    src("    raise DecodeError('Misaligned')")
+    for k, name, th, is_array, var, sub in fields:
+        if is_array:
+            src('self.{0} = {1}'.format(name, var))
+        else:
+            src('if {0} is not _MISSING:'.format(var))
+            src('    self.{0} = {1}'.format(name, var))
+    src('return ({0})'.format(''.join(
+        '{0}, '.format(var) if is_array else '{0}, {0}_end, '.format(var)
+        for k, name, is_array, var in recorded)))
+
+    namespace['SCANNED'] = frozenset(x[1] for x in fields)
+    src.indent = 0
+    src('def __getattr__(self, name):')
+    src.indent += 1
+    src("if name[0] == '_':")
+    src('    raise AttributeError(name)')
+    src('fields = self._fields')
+    src('if fields is None:')
+    src('    fields = self._fields = _scan(self, self._buf, self._start, self._end)')
+    src('    if name in SCANNED:')
+    src('        return _getattribute(self, name)')
+
+    cond = 'if'
+    for k, name, th, is_array, idx in layout:
+        src('{0} name == {1!r}:'.format(cond, name))
+        src.indent += 1
+        src('buf = self._buf')
+        if th is mstruct.MBytes:
+            # stays a zero-copy slice
+            expr = 'memoryview(buf)[start:end]'
+        elif th is mstruct.MString:
+            expr = "str(buf[start:end], 'UTF-8')"
+        else:
+            namespace['T_{0}'.format(k)] = th
+            namespace['V_{0}'.format(k)] = None
+            src('global V_{0}'.format(k))
+            src('if V_{0} is None:'.format(k))
+            src('    V_{0} = view_type(T_{0})'.format(k))
+            expr = 'V_{0}(buf, start, end)'.format(k)
+
+        if th is mstruct.MString:
+            src('try:')
+            src.indent += 1
+        if is_array:
+            src('r = fields[{0}]'.format(idx))
+            src('val = [{0} for start, end in zip(r[::2], r[1::2])]'.format(expr))
+        else:
+            src('start = fields[{0}]'.format(idx))
+            src('if start < 0:')
+            src('    raise AttributeError(name)')
+            src('end = fields[{0}]'.format(idx + 1))
+            src('val = {0}'.format(expr))
+        if th is mstruct.MString:
+            src.indent -= 1
+            src('except UnicodeDecodeError as e:')
+            src('    raise DecodeError(e.reason)')
+        src('self.{0} = val'.format(name))
+        src('return val')
+        src.indent -= 1
+        cond = 'elif'
+    src('raise AttributeError(name)')
+
+    filename = '<generated view for {0}.{1}>'.format(cls.__module__, cls.__name__)
+    exec(compile(str(src), filename, 'exec'), namespace)
+    return namespace['__getattr__']
+
+def _emit_write_varint(src, expr):
+    src('if 0 <= {0} < 128:'.format(expr))
+    src('    buf[offset] = {0}'.format(expr))
+    src('    offset += 1')
+    src('else:')
+    src('    offset = write_varint({0}, buf, offset)'.format(expr))
+
+def _emit_add_len(src, expr):
+    # adds key byte, length prefix and payload of length expr
+    src('size += {0} + (2 if {0} < 128 else 1 + varint_size({0}))'.format(expr))
+
+def build_encoder(cls):
+    """
+    Generates and compiles the _byte_size and _encode_into functions
+    for the given MStruct subclass.
+    """
+    namespace = {
+        'varint_size': serialize.varint_size,
+        'packed_varint_size': serialize.packed_varint_size,
+        'write_varint': serialize.write_varint,
+        'write_packed_varint': serialize.write_packed_varint,
+        '_MISSING': _MISSING
+    }
+
+    size_src = _Source()
+    size_src('def _byte_size(self, sizes):')
+    size_src.indent += 1
+    size_src('idx = len(sizes)')
+    size_src('sizes.append(0)')
+    size_src('size = 0')
+
+    enc_src = _Source()
+    enc_src('def _encode_into(self, buf, offset, nxt):')
+    enc_src.indent += 1
+
+    for k, (name, th, is_array) in cls._mfields_.items():
+        for src in (size_src, enc_src):
+            src('v = getattr(self, {0!r}, _MISSING) # [{1}]'.format(name, k))
+            if is_array:
+                # no need to encode empty arrays
+                src('if v is not _MISSING and len(v) > 0:')
+            else:
+                src('if v is not _MISSING:')
+            src.indent += 1
+
+        if isinstance(th, mstruct.MInteger):
+            if is_array:
+                # packed encoding, remember payload length
+                size_src('n = packed_varint_size(v)')
+                size_src('sizes.append(n)')
+                _emit_add_len(size_src, 'n')
+
+                enc_src('buf[offset] = {0}'.format(k << 3 | serialize.WTYPE_LEN_DELIM))
+                enc_src('offset += 1')
+                enc_src('n = nxt()')
+                _emit_write_varint(enc_src, 'n')
+                enc_src('offset = write_packed_varint(v, buf, offset)')
+            else:
+                size_src('size += 2 if 0 <= v < 128 else 1 + varint_size(v)')
+
+                enc_src('buf[offset] = {0}'.format(k << 3 | serialize.WTYPE_VARINT))
+                enc_src('if 0 <= v < 128:')
+                enc_src('    buf[offset+1] = v')
+                enc_src('    offset += 2')
+                enc_src('else:')
+                enc_src('    offset = write_varint(v, buf, offset+1)')
+        elif isinstance(th, mstruct.MBasicFixed):
+            if is_array:
+                namespace['T_{0}'.format(k)] = th
+                size_src('n = len(v) * {0}'.format(th._n_bytes))
+                _emit_add_len(size_src, 'n')
+
+                enc_src('offset = T_{0}.encode_field_arr(v, {0}, buf, offset)'.format(k))
+            else:
+                wtype = serialize.WTYPE_FIXED32 if th._n_bytes == 4 else serialize.WTYPE_FIXED64
+                namespace['P_{0}'.format(k)] = struct.Struct('<' + th._s).pack_into
+                size_src('size += {0}'.format(th._n_bytes + 1))
+
+                enc_src('buf[offset] = {0}'.format(k << 3 | wtype))
+                enc_src('P_{0}(buf, offset + 1, v)'.format(k))
+                enc_src('offset += {0}'.format(th._n_bytes + 1))
+        else:
+            key = k << 3 | serialize.WTYPE_LEN_DELIM
+            if is_array:
+                for src in (size_src, enc_src):
+                    src('for item in v:')
+                    src.indent += 1
+                item = 'item'
+            else:
+                item = 'v'
+
+            if th is mstruct.MBytes:
+                size_src('n = len({0})'.format(item))
+                _emit_add_len(size_src, 'n')
+
+                enc_src('buf[offset] = {0}'.format(key))
+                enc_src('offset += 1')
+                enc_src('n = len({0})'.format(item))
+                _emit_write_varint(enc_src, 'n')
+                enc_src('buf[offset:offset+n] = {0}'.format(item))
+                enc_src('offset += n')
+            elif th is mstruct.MString:
+                # keep the encoded string around for the second pass
+                size_src("e = {0}.encode('UTF-8')".format(item))
+                size_src('sizes.append(e)')
+                size_src('n = len(e)')
+                _emit_add_len(size_src, 'n')
+
+                enc_src('buf[offset] = {0}'.format(key))
+                enc_src('offset += 1')
+                enc_src('e = nxt()')
+                enc_src('n = len(e)')
+                _emit_write_varint(enc_src, 'n')
+                enc_src('buf[offset:offset+n] = e')
+                enc_src('offset += n')
+            else:
+                size_src('n = {0}._byte_size(sizes)'.format(item))
+                _emit_add_len(size_src, 'n')
+
+                enc_src('buf[offset] = {0}'.format(key))
+                enc_src('offset += 1')
+                enc_src('n = nxt()')
+                _emit_write_varint(enc_src, 'n')
+                enc_src('offset = {0}._encode_into(buf, offset, nxt)'.format(item))
+
+            if is_array:
+                size_src.indent -= 1
+                enc_src.indent -= 1
+
+        size_src.indent -= 1
+        enc_src.indent -= 1
+
+    size_src('sizes[idx] = size')
+    size_src('return size')
+    enc_src('return offset')
+
+    filename = '<generated encoder for {0}.{1}>'.format(cls.__module__, cls.__name__)
+    exec(compile(str(size_src) + str(enc_src), filename, 'exec'), namespace)
+    return (namespace['_byte_size'], namespace['_encode_into'])
+
+def _stub_owner(cls, attr, stub):
+    # the class in the mro that still has the stub installed
+    for klass in cls.__mro__:
+        if klass.__dict__.get(attr, None) is stub:
+            return klass
+    return None
+
+def _lazy_decode_buf(cls, buf, offset=0, end=None):
+    """ Stand-in decode_buf, compiles the real one on first use. """
+    owner = _stub_owner(cls, 'decode_buf', _LAZY_DECODE_BUF)
+    if owner is not None:
+        owner.decode_buf = classmethod(build_decoder(owner))
+    return cls.decode_buf(buf, offset, end)
+
+_LAZY_DECODE_BUF = classmethod(_lazy_decode_buf)
+
+def _compile_encoder(cls):
+    owner = _stub_owner(cls, '_byte_size', _lazy_byte_size)
+    if owner is not None:
+        owner._byte_size, owner._encode_into = build_encoder(owner)
+
+def _lazy_byte_size(self, sizes):
+    """ Stand-in _byte_size, compiles the real encoder on first use. """
+    _compile_encoder(type(self))
+    return self._byte_size(sizes)
+
+def _lazy_encode_into(self, buf, offset, nxt):
+    _compile_encoder(type(self))
+    return self._encode_into(buf, offset, nxt)
+
+def compile_types(types):
+    """
+    Replaces the generic decode_buf and encode_buf of each given
+    MStruct type by generated ones. The types need to have their
+    _mfields_ set up by the time they are first used, the code is only
+    generated then.
+    """
+    for cls in types:
+        cls.decode_buf = _LAZY_DECODE_BUF
+        cls._byte_size = _lazy_byte_size
+        cls._encode_into = _lazy_encode_into
+        cls.encode_buf = mstruct.MStruct.encode_into
@@ -1,9 +1,25 @@
 """
 Hearthstone Protocol Decoder.
+
+Packets are decoded with the generated Python decoders unless another
+backend is chosen, with the backend argument of decode_packet or
+HEARTHY_PROTOBUF in the environment:
+
+    python  generated Python decoders (default)
+    native  google.protobuf with upb (see hearthy.protocol.native)
+    auto    native if google.protobuf with upb is installed, else python
+
+The native backend is not picked automatically by default, although
+upb parses packets correctly: converting its messages into MStructs
+makes it slower than the generated decoders on real captures (see
+hearthy/examples/bench_backends.py), and its results differ in details,
+see hearthy.protocol.native.
 """
 
+import os
 import struct
-from hearthy.protocol import mtypes
+from hearthy.protocol import mtypes, native
+from hearthy.protocol.lazy import view as lazy_view
 from hearthy.protocol.enums import PacketType
 from hearthy.exceptions import DecodeError, EncodeError
 
@@ -41,25 +57,85 @@ _packet_type_map = [
     (PacketType.INVITE_TO_SPECTATE, mtypes.InviteToSpectate)
 ]
 
+# backend used by decode_packet unless one is given: 'python', 'native' or 'auto'
+BACKEND = os.environ.get('HEARTHY_PROTOBUF', 'python')
+
 _packet_type_handlers = dict(_packet_type_map)
 _packet_type_id = dict((y,x) for x,y in _packet_type_map)
 
-def encode_packet(packet, buf, offset=0):
-    end = packet.encode_buf(buf, offset + 8)
-    packet_type = _packet_type_id.get(packet.__class__, None)
-    
+def _get_packet_type(packet):
+    # lazy views are subclasses of their message type
+    packet_type = _packet_type_id.get(getattr(packet, '_mtype', packet.__class__), None)
     if packet_type is None:
         raise EncodeError('No packet type for class {0}'.format(packet.__class__))
-    
-    buf[offset:offset+8] = struct.pack('<II', packet_type, end - offset - 8)
+    return packet_type
+
+def packet_size(packet):
+    """ Returns the encoded size of packet including the 8 byte header. """
+    return packet.byte_size() + 8
+
+def encode_packet(packet, buf, offset=0):
+    packet_type = _get_packet_type(packet)
+
+    sizes = []
+    size = packet._byte_size(sizes)
+    end = offset + 8 + size
+    if end > len(buf):
+        raise EncodeError('Packet of {0} bytes does not fit into buffer'.format(size + 8))
+
+    struct.pack_into('<II', buf, offset, packet_type, size)
+    packet._encode_sized(buf, offset + 8, sizes)
     return end
 
-def decode_packet(packet_type, buf):
+def pack_packet(packet, pool=None):
+    """
+    Encodes packet including its header into a buffer of exactly the
+    right size. If pool (a serialize.ScratchBuffer) is given, its
+    memory is used instead of allocating a new buffer.
+    """
+    packet_type = _get_packet_type(packet)
+
+    sizes = []
+    size = packet._byte_size(sizes)
+    buf = bytearray(size + 8) if pool is None else pool.get(size + 8)
+
+    struct.pack_into('<II', buf, 0, packet_type, size)
+    packet._encode_sized(buf, 8, sizes)
+    return buf
+
+def decode_packet(packet_type, buf, lazy=False, fields=None, backend=None):
+    """
+    Decodes a packet of the given type. If lazy is set, a view
+    (see hearthy.protocol.lazy) backed by buf is returned instead
+    and fields are only decoded when they are accessed.
+
+    fields may be a Projection (see hearthy.protocol.projection),
+    only the fields on its paths are decoded then.
+
+    backend is 'python', 'native' or 'auto' (see above), BACKEND if
+    not given. Projected decodes always use the Python decoders.
+    """
     handler = _packet_type_handlers.get(packet_type, None)
     if handler is None:
-        import pdb; pdb.set_trace()
         raise DecodeError('No handler for packet type {0}'.format(packet_type))
 
+    if fields is not None:
+        if lazy:
+            raise ValueError('A projection can not be decoded lazily')
+        return fields.decode(handler, buf)
+
+    if backend is None:
+        backend = BACKEND
+    if backend == 'auto':
+        backend = 'native' if native.load() else 'python'
+    if backend == 'native':
+        view = native.decode(handler, buf)
+        return view if lazy else view.materialize()
+    elif backend != 'python':
+        raise ValueError('Unknown backend {0!r}'.format(backend))
+
+    if lazy:
+        return lazy_view(handler, buf)
     return handler.decode_buf(buf)
 
 if __name__ == '__main__':
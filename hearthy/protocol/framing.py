@@ -0,0 +1,200 @@
+"""
+Splitting of byte streams into frames.
+
+A Framer cuts a stream into frames of header and body. How the header
+looks is up to a header codec, an object with a method
+
+    parse(buf, offset, end)
+
+that looks at buf[offset:end] and either returns a tuple
+(header, header length, body length) or, if not enough data is there
+to parse the header, the number of bytes that are needed at least.
+
+GameHeader handles the 8 byte (type, length) header of the game
+protocol, BnetHeader the battle.net header (2 byte size followed by a
+BnetPacketHeader message).
+"""
+
+import struct
+from hearthy import exceptions
+from hearthy.protocol import mtypes
+
+# buffer size to start with when data needs to be buffered
+INITIAL_BUF = 16 * 1024
+
+# frames larger than this raise BufferFullException
+MAX_FRAME = 4 * 1024 * 1024
+
+_game_header = struct.Struct('<II')
+
+class GameHeader:
+    """ Game protocol header, the header is the packet type. """
+    def parse(self, buf, offset, end):
+        if end - offset < 8:
+            return 8
+        atype, alen = _game_header.unpack_from(buf, offset)
+        return (atype, 8, alen)
+
+class BnetHeader:
+    """ Battle.net header, the header is a BnetPacketHeader. """
+    def parse(self, buf, offset, end):
+        if end - offset < 2:
+            return 2
+        header_size = (buf[offset] << 8) | buf[offset + 1]
+        if end - offset < 2 + header_size:
+            return 2 + header_size
+        header = mtypes.BnetPacketHeader.decode_buf(buf, offset + 2, offset + 2 + header_size)
+        return (header, 2 + header_size, header.Size)
+
+class FrameStats:
+    __slots__ = ['feeds', 'bytes', 'frames', 'copied', 'max_frame']
+
+    def __init__(self):
+        self.feeds = 0
+        self.bytes = 0
+        self.frames = 0
+        # bytes that had to be copied into the framer's buffer
+        self.copied = 0
+        self.max_frame = 0
+
+    def __repr__(self):
+        return ('<FrameStats feeds={0.feeds} bytes={0.bytes} frames={0.frames} '
+                'copied={0.copied} max_frame={0.max_frame}>'.format(self))
+
+class Framer:
+    """
+    Splits a stream into frames using the header codec codec.
+
+    feed() returns a list of (header, body) tuples for all frames
+    completed by the fed data. Bodies are memoryview slices, either of
+    the fed data or of the framer's own buffer if a frame spans several
+    feeds. They are only valid until the next call to feed(), copy them
+    if they are needed longer.
+    """
+    def __init__(self, codec, max_frame=MAX_FRAME):
+        self.codec = codec
+        self.stats = FrameStats()
+        self._max = max_frame
+
+        # two buffers, so the data of an incomplete frame can be kept
+        # without overwriting a frame returned from the other one
+        self._buf = bytearray()
+        self._spare = bytearray()
+
+        # number of bytes of the incomplete frame in _buf
+        self._len = 0
+        # parsed header of the incomplete frame, if any
+        self._pending = None
+
+    @property
+    def buffered(self):
+        """ Number of bytes belonging to an incomplete frame. """
+        return self._len
+
+    def reset(self):
+        """ Drops any buffered data. """
+        self._len = 0
+        self._pending = None
+
+    def _reserve(self, needed):
+        if needed > self._max:
+            raise exceptions.BufferFullException(
+                'Frame of {0} bytes exceeds maximum of {1}'.format(needed, self._max))
+        if needed > len(self._buf):
+            # allocate a new buffer, views handed out before stay valid
+            size = min(max(needed, 2 * len(self._buf), INITIAL_BUF), self._max)
+            buf = bytearray(size)
+            buf[:self._len] = self._buf[:self._len]
+            self._buf = buf
+
+    def _fill(self, view, needed):
+        """ Moves up to needed bytes from view to _buf, returns the count. """
+        n = min(needed - self._len, len(view))
+        self._buf[self._len:self._len + n] = view[:n]
+        self._len += n
+        self.stats.copied += n
+        return n
+
+    def _complete(self, view):
+        """
+        Completes the buffered frame with data from view. Returns the
+        number of bytes used and the frame or None if view was too short.
+        """
+        parse = self.codec.parse
+        offset = 0
+        while self._pending is None:
+            res = parse(self._buf, 0, self._len)
+            if isinstance(res, int):
+                self._reserve(res)
+                offset += self._fill(view[offset:], res)
+                if self._len < res:
+                    return offset, None
+            else:
+                self._pending = res
+
+        header, hlen, blen = self._pending
+        needed = hlen + blen
+        self._reserve(needed)
+        offset += self._fill(view[offset:], needed)
+        if self._len < needed:
+            return offset, None
+
+        self._len = 0
+        self._pending = None
+        return offset, (header, memoryview(self._buf)[hlen:needed])
+
+    def feed(self, buf):
+        view = memoryview(buf)
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+        end = len(view)
+        offset = 0
+        frames = []
+
+        stats = self.stats
+        stats.feeds += 1
+        stats.bytes += end
+
+        own = False
+        if self._len:
+            offset, frame = self._complete(view)
+            if frame is None:
+                return frames
+            frames.append(frame)
+            own = True
+
+        # complete frames are sliced from the input without copying
+        parse = self.codec.parse
+        max_frame = self._max
+        while offset < end:
+            res = parse(view, offset, end)
+            if isinstance(res, int):
+                needed = res
+                break
+
+            header, hlen, blen = res
+            needed = hlen + blen
+            if needed > max_frame:
+                self._reserve(needed)
+            if end - offset < needed:
+                self._pending = res
+                break
+
+            frames.append((header, view[offset + hlen:offset + needed]))
+            offset += needed
+
+        if offset < end:
+            if own:
+                self._buf, self._spare = self._spare, self._buf
+            self._reserve(needed)
+            self._fill(view[offset:], needed)
+
+        stats.frames += len(frames)
+        for header, body in frames:
+            if len(body) > stats.max_frame:
+                stats.max_frame = len(body)
+        return frames
+
+    def __repr__(self):
+        return '<Framer codec={0} buffered={1}>'.format(
+            self.codec.__class__.__name__, self._len)
@@ -0,0 +1,55 @@
+"""
+Lazily decoded message views.
+
+A view wraps the buffer of an encoded message. The field offsets are
+scanned once on first access, fields (and nested messages) are only
+decoded when they are accessed and then kept. Nested messages are
+views themselves, bytes fields are returned as memoryview slices of
+the buffer.
+
+The view type of a message type is a generated subclass of it (see
+hearthy.protocol.codegen.build_view), so isinstance() holds and the
+fields are accessed with the usual attribute names. Numeric fields are
+decoded while scanning, as skipping them reads them anyway.
+
+Decoding errors only come up when the broken part is accessed. Views
+keep the underlying buffer alive and assume it does not change, so make
+sure to hand in a buffer that is not reused.
+"""
+
+from hearthy.protocol import codegen
+
+# MStruct type -> view type
+_views = {}
+
+def _init(self, buf, start=0, end=None):
+    self._buf = buf
+    self._start = start
+    self._end = len(buf) if end is None else end
+    self._fields = None
+
+def _materialize(self):
+    """ Fully decodes the message into an instance of its MStruct type. """
+    return self._mtype.decode_buf(self._buf, self._start, self._end)
+
+def _repr(self):
+    return '<{0} view of {1} bytes>'.format(self._mtype.__name__, self._end - self._start)
+
+def view_type(mtype):
+    """ Returns the view type of the MStruct type mtype. """
+    view = _views.get(mtype, None)
+    if view is None:
+        view = _views[mtype] = type(mtype.__name__, (mtype,), {
+            '__slots__': ['_buf', '_start', '_end', '_fields'],
+            '__module__': __name__,
+            '__init__': _init,
+            '__getattr__': codegen.build_view(mtype, view_type),
+            '__repr__': _repr,
+            '_mtype': mtype,
+            'materialize': _materialize
+        })
+    return view
+
+def view(mtype, buf, offset=0, end=None):
+    """ Returns a view of the message of type mtype in buf[offset:end]. """
+    return view_type(mtype)(buf, offset, end)
@@ -1,4 +1,6 @@
+import sys
 import struct
+from array import array
 from hearthy.protocol import serialize
 from hearthy.exceptions import DecodeError
 
@@ -7,6 +9,15 @@ class MInteger:
         self._nbits = nbits
         self._signed = signed
 
+        # repeated fields are kept in arrays of this type
+        if nbits == 32:
+            self.typecode = 'i' if signed else 'I'
+        else:
+            self.typecode = 'q' if signed else 'Q'
+
+    def new_array(self):
+        return array(self.typecode)
+
     def encode_buf(self, val, buf, offset=0):
         return serialize.write_varint(val, buf, offset)
 
@@ -15,7 +26,7 @@ class MInteger:
         if end is None:
             return serialize.read_varint(buf, offset, signed=self._signed)
         else:
-            return serialize.read_packed_varint(buf, offset, end, self._signed)
+            return serialize.read_packed_varint_array(buf, offset, end, self._signed, self.typecode)
 
 class MBasicFixed:
     def __init__(self, is_float, nbits, signed=True):
@@ -38,6 +49,13 @@ class MBasicFixed:
             else:
                 assert False, 'Unsupported size'
 
+        # repeated fields are kept in arrays of this type
+        self.typecode = self._s
+        assert array(self.typecode).itemsize == self._n_bytes
+
+    def new_array(self):
+        return array(self.typecode)
+
     def encode_field_val(self, val, field_number, buf, offset=0):
         buf[offset] = (serialize.WTYPE_FIXED32 if self._n_bytes == 4 else serialize.WTYPE_FIXED64) | field_number << 3
         struct.pack_into('<' + self._s, buf, offset + 1, val)
@@ -47,7 +65,11 @@ class MBasicFixed:
         buf[offset] = serialize.WTYPE_LEN_DELIM | field_number << 3
         size = len(arr) * self._n_bytes
         offset = serialize.write_varint(size, buf, offset + 1)
-        struct.pack_into('<' + str(len(arr)) + self._s, buf, offset, *arr)
+        if isinstance(arr, array) and arr.typecode == self.typecode and sys.byteorder == 'little':
+            # copy the array memory as is
+            buf[offset:offset + size] = memoryview(arr).cast('B')
+        else:
+            struct.pack_into('<' + str(len(arr)) + self._s, buf, offset, *arr)
         return offset + size
 
     def decode_buf(self, buf, offset=0, end=None):
@@ -55,11 +77,7 @@ class MBasicFixed:
             end = offset + self._n_bytes
             return (struct.unpack('<' + self._s, buf[offset:end])[0], end)
         else:
-            length = end - offset
-            if length % self._n_bytes != 0:
-                raise DecodeError('Not a valid packed fixed field')
-            n = length // self._n_bytes
-            return list(struct.unpack('<' + str(n) + self._s, buf[offset:end]))
+            return serialize.read_packed_fixed_array(buf, offset, end, self.typecode)
 
 class MBytes:
     @classmethod
@@ -70,7 +88,7 @@ class MBytes:
 
     @classmethod
     def decode_buf(cls, buf, offset, end):
-        return buf[offset:end]
+        return bytes(buf[offset:end])
 
 class MString:
     @classmethod
@@ -97,6 +115,40 @@ class MStruct:
         for k,v in kwargs.items():
             setattr(self, k, v)
 
+    def byte_size(self):
+        """ Returns the number of bytes needed to encode this message. """
+        return self._byte_size([])
+
+    def encode_into(self, buf, offset=0):
+        """
+        Encodes the message into buf at offset, writing every byte exactly
+        once. Returns the offset after the message.
+        """
+        sizes = []
+        self._byte_size(sizes)
+        return self._encode_sized(buf, offset, sizes)
+
+    def encode(self, pool=None):
+        """
+        Encodes the message into a buffer of exactly the right size.
+        If a serialize.ScratchBuffer is given as pool its memory is
+        reused, the result is then only valid until the pool is used again.
+        """
+        sizes = []
+        size = self._byte_size(sizes)
+        buf = bytearray(size) if pool is None else pool.get(size)
+        self._encode_sized(buf, 0, sizes)
+        return buf
+
+    def _encode_sized(self, buf, offset, sizes):
+        nxt = iter(sizes).__next__
+
+        # skip our own size
+        nxt()
+        return self._encode_into(buf, offset, nxt)
+
+    # Generic encoder, types built by mtypes/type_builder use
+    # encode_into with generated _byte_size/_encode_into instead.
     def encode_buf(self, buf, offset=0):
         for k, v in self._mfields_.items():
             name, typehandler, is_array = v
@@ -140,6 +192,8 @@ class MStruct:
         buf[offset:offset+length] = buf[start:after]
         return offset + length
 
+    # Generic decoder, types built by mtypes/type_builder get a
+    # generated replacement (see hearthy.protocol.codegen).
     @classmethod
     def decode_buf(cls, buf, offset=0, end=None):
         if end is None:
@@ -147,7 +201,7 @@ class MStruct:
 
         ret = cls()
         for k,v in cls._mfields_.items():
-            if v[2]: setattr(ret, v[0], [])
+            if v[2]: setattr(ret, v[0], v[1].new_array() if hasattr(v[1], 'new_array') else [])
 
         while offset < end:
             a = buf[offset]
@@ -173,7 +227,7 @@ class MStruct:
                 raise DecodeError('Unhandled wire type {0}'.format(wtype))
 
             if is_array:
-                if isinstance(val, list):
+                if isinstance(val, (list, array)):
                     getattr(ret, name).extend(val)
                 else:
                     getattr(ret, name).append(val)
@@ -3,7 +3,7 @@
 Hearthstone Message Types
 """
 
-from hearthy.protocol import mstruct
+from hearthy.protocol import mstruct, codegen
 
 _enum = mstruct.MInteger(64, True)
 _bool = mstruct.MInteger(64, True)
@@ -72,6 +72,9 @@ def _build_types():
 
         update[name]._mfields_.update(mfields)
 
+    # generate specialized decoders now that all fields are known
+    codegen.compile_types(update.values())
+
     # finally put them into the module namespace
     globals().update(update)
 
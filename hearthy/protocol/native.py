@@ -0,0 +1,243 @@
+"""
+Optional decoding backend using the google.protobuf native parser.
+
+The backend is only used when asked for, with
+decode_packet(..., backend='native') or HEARTHY_PROTOBUF=native in the
+environment, or with 'auto' if it is available (see
+hearthy.protocol.decoder). google.protobuf is not imported before that. On first use
+load() compiles the message types of mtypes, account, pegasus_util and
+game_utilities into a descriptor pool, if google.protobuf with the upb
+(or cpp) implementation is installed. decode() then parses with the
+native parser and returns a NativeView, which exposes the fields with
+the same attribute names as the MStruct type and converts them on first
+access. materialize() turns a view into the usual MStruct instance.
+
+It is not faster than the generated Python decoders for the packets
+hearthy deals with (see hearthy/examples/bench_backends.py). The
+results also differ in details: bytes fields are copies rather than
+slices of the buffer, and a repeated non-array field is accepted with
+the last value winning instead of raising DecodeError.
+"""
+
+import os
+from array import array
+from hearthy.protocol import mstruct, mtypes, account, pegasus_util, game_utilities
+from hearthy.exceptions import DecodeError
+
+MODULES = [mtypes, account, pegasus_util, game_utilities]
+
+# set by load()
+available = False
+_loaded = False
+
+# google.protobuf modules, imported by load()
+descriptor_pb2 = descriptor_pool = message_factory = None
+_PbDecodeError = None
+_FDP = None
+
+# MStruct type -> protobuf message class
+_pb_types = {}
+
+# MStruct type -> (array field names, {field number: converter info})
+_converters = {}
+
+# MStruct type -> {name: (typehandler if message else None, is_array, typecode)}
+_names = {}
+
+def _is_struct(th):
+    return isinstance(th, type) and issubclass(th, mstruct.MStruct)
+
+def _field_type(th):
+    if isinstance(th, mstruct.MInteger):
+        if th._nbits == 32:
+            return _FDP.TYPE_INT32 if th._signed else _FDP.TYPE_UINT32
+        return _FDP.TYPE_INT64 if th._signed else _FDP.TYPE_UINT64
+    elif isinstance(th, mstruct.MBasicFixed):
+        return {
+            'f': _FDP.TYPE_FLOAT,
+            'd': _FDP.TYPE_DOUBLE,
+            'i': _FDP.TYPE_SFIXED32,
+            'I': _FDP.TYPE_FIXED32,
+            'q': _FDP.TYPE_SFIXED64,
+            'Q': _FDP.TYPE_FIXED64
+        }[th._s]
+    elif th is mstruct.MBytes:
+        return _FDP.TYPE_BYTES
+    elif th is mstruct.MString:
+        return _FDP.TYPE_STRING
+    return _FDP.TYPE_MESSAGE
+
+def _module_types(module):
+    for name, value in sorted(vars(module).items()):
+        if _is_struct(value) and value.__module__ == module.__name__:
+            yield value
+
+def _build_file(module):
+    fdp = descriptor_pb2.FileDescriptorProto()
+    fdp.name = module.__name__.replace('.', '/') + '.proto'
+    fdp.package = module.__name__
+    fdp.syntax = 'proto2'
+
+    deps = set()
+    for cls in _module_types(module):
+        msg = fdp.message_type.add()
+        msg.name = cls.__name__
+        for k, (name, th, is_array) in cls._mfields_.items():
+            field = msg.field.add()
+            field.name = name
+            field.number = k
+            field.label = _FDP.LABEL_REPEATED if is_array else _FDP.LABEL_OPTIONAL
+            field.type = _field_type(th)
+            if field.type == _FDP.TYPE_MESSAGE:
+                field.type_name = '.{0}.{1}'.format(th.__module__, th.__name__)
+                if th.__module__ != module.__name__:
+                    deps.add(th.__module__.replace('.', '/') + '.proto')
+            elif is_array and not isinstance(th, type):
+                field.options.packed = True
+
+    fdp.dependency.extend(sorted(deps))
+    return fdp
+
+def _get_message_class(desc):
+    if hasattr(message_factory, 'GetMessageClass'):
+        return message_factory.GetMessageClass(desc)
+    return message_factory.MessageFactory(desc.file.pool).GetPrototype(desc)
+
+def _build():
+    pool = descriptor_pool.DescriptorPool()
+
+    # dependencies first, MODULES is ordered accordingly
+    for module in MODULES:
+        pool.AddSerializedFile(_build_file(module).SerializeToString())
+
+    for module in MODULES:
+        for cls in _module_types(module):
+            desc = pool.FindMessageTypeByName('{0}.{1}'.format(module.__name__, cls.__name__))
+            _pb_types[cls] = _get_message_class(desc)
+
+            arrays = []
+            fields = {}
+            for k, (name, th, is_array) in cls._mfields_.items():
+                if is_array:
+                    arrays.append((name, th))
+                fields[k] = (name, th if _is_struct(th) else None, is_array,
+                             getattr(th, 'typecode', None))
+            _converters[cls] = (arrays, fields)
+            _names[cls] = dict((v[0], v[1:]) for v in fields.values())
+
+def _convert(cls, msg):
+    arrays, fields = _converters[cls]
+
+    ret = object.__new__(cls)
+    for name, th in arrays:
+        setattr(ret, name, th.new_array() if hasattr(th, 'new_array') else [])
+
+    for fd, value in msg.ListFields():
+        name, sub, is_array, typecode = fields[fd.number]
+        if sub is not None:
+            if is_array:
+                value = [_convert(sub, x) for x in value]
+            else:
+                value = _convert(sub, value)
+        elif is_array:
+            value = array(typecode, value) if typecode is not None else list(value)
+        setattr(ret, name, value)
+    return ret
+
+class NativeView:
+    """
+    View of a parsed protobuf message of MStruct type mtype. Fields
+    are accessed with the same attribute names as on the MStruct type
+    and isinstance(view, mtype) holds. Nested messages are views
+    themselves.
+    """
+    __slots__ = ['_msg', '_type', '_cache']
+
+    def __init__(self, mtype, msg):
+        self._msg = msg
+        self._type = mtype
+        self._cache = {}
+
+    @property
+    def __class__(self):
+        return self._type
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        cache = self._cache
+        if name in cache:
+            return cache[name]
+
+        field = _names[self._type].get(name, None)
+        if field is None:
+            raise AttributeError('{0!r} has no field {1!r}'.format(self._type.__name__, name))
+        sub, is_array, typecode = field
+
+        msg = self._msg
+        if is_array:
+            val = getattr(msg, name)
+            if sub is not None:
+                val = [NativeView(sub, x) for x in val]
+            elif typecode is not None:
+                val = array(typecode, val)
+            else:
+                val = list(val)
+        else:
+            if not msg.HasField(name):
+                raise AttributeError(name)
+            val = getattr(msg, name)
+            if sub is not None:
+                val = NativeView(sub, val)
+
+        cache[name] = val
+        return val
+
+    def materialize(self):
+        """ Converts the message into an instance of its MStruct type. """
+        return _convert(self._type, self._msg)
+
+    def __repr__(self):
+        return '<{0} native view>'.format(self._type.__name__)
+
+def decode(cls, buf):
+    """
+    Decodes buf as message of MStruct type cls using the native parser
+    and returns a NativeView of it. The view does not reference buf.
+    """
+    if not _loaded:
+        load()
+    if not available:
+        raise RuntimeError('Native protobuf backend not available')
+    try:
+        msg = _pb_types[cls].FromString(bytes(buf))
+    except _PbDecodeError as e:
+        raise DecodeError(str(e))
+    return NativeView(cls, msg)
+
+def load():
+    """
+    Imports google.protobuf and builds the descriptor pool, once.
+    Returns whether the backend is available.
+    """
+    global available, _loaded
+    global descriptor_pb2, descriptor_pool, message_factory, _PbDecodeError, _FDP
+
+    if _loaded:
+        return available
+    _loaded = True
+
+    try:
+        from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+        from google.protobuf.message import DecodeError as _PbDecodeError
+        from google.protobuf.internal import api_implementation
+    except ImportError:
+        return False
+    if api_implementation.Type() not in ('upb', 'cpp'):
+        return False
+
+    _FDP = descriptor_pb2.FieldDescriptorProto
+    _build()
+    available = True
+    return True
@@ -34,12 +34,9 @@ SetProgress.packet_id = 230
 SetProgressResponse.packet_id = 0x128
 
 def to_client_response(packet):
-    buf = bytearray(1024)
-    end = packet.encode_buf(buf)
-
     packet_id = packet.packet_id
 
     return game_utilities.ClientResponse(attributes=[
         mtypes.Attribute(name='?',value=mtypes.BnetVariant(intval=packet_id)),
-        mtypes.Attribute(name='?',value=mtypes.BnetVariant(blobval=bytes(buf[:end])))
+        mtypes.Attribute(name='?',value=mtypes.BnetVariant(blobval=packet.encode()))
     ])
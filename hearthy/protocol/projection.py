@@ -0,0 +1,82 @@
+"""
+Field projections for decoding only parts of packets.
+
+A projection is a list of dotted paths starting with the packet type
+name, e.g.
+
+    Projection(['PowerHistory.List.TagChange', 'StartGameState'])
+
+decodes the TagChange entries of PowerHistory packets and complete
+StartGameState packets. Fields not on any path are jumped over without
+being parsed and are left unset on the decoded message. Messages of a
+type not mentioned at all come back with no fields set.
+"""
+
+from hearthy.protocol import codegen, mstruct
+
+class Projection:
+    def __init__(self, paths):
+        self.paths = tuple(paths)
+
+        # type name -> field tree, None meaning the whole message
+        self._trees = {}
+        for path in self.paths:
+            parts = path.split('.')
+            root = parts[0]
+            if len(parts) == 1:
+                self._trees[root] = None
+                continue
+
+            tree = self._trees.setdefault(root, {})
+            if tree is None:
+                # whole message requested already
+                continue
+            for part in parts[1:-1]:
+                sub = tree.setdefault(part, {})
+                if sub is None:
+                    break
+                tree = sub
+            else:
+                tree[parts[-1]] = None
+
+        self._decoders = {}
+
+    def _compile(self, mtype, tree):
+        names = dict((v[0], (k, v[1])) for k, v in mtype._mfields_.items())
+
+        ret = {}
+        for name, sub in tree.items():
+            field = names.get(name, None)
+            if field is None:
+                raise ValueError('Type {0!r} has no field {1!r}'.format(mtype.__name__, name))
+            k, th = field
+
+            if sub is None:
+                ret[k] = None
+            elif isinstance(th, type) and issubclass(th, mstruct.MStruct):
+                ret[k] = self._compile(th, sub)
+            else:
+                raise ValueError('Field {0!r} of {1!r} is not a message'.format(name, mtype.__name__))
+        return ret
+
+    def get_decoder(self, mtype):
+        """
+        Returns the decode function (same signature as decode_buf)
+        for messages of type mtype under this projection.
+        """
+        decoder = self._decoders.get(mtype, None)
+        if decoder is None:
+            tree = self._trees.get(mtype.__name__, {})
+            if tree is None:
+                decoder = mtype.decode_buf
+            else:
+                fn = codegen.build_decoder(mtype, self._compile(mtype, tree))
+                decoder = fn.__get__(mtype)
+            self._decoders[mtype] = decoder
+        return decoder
+
+    def decode(self, mtype, buf, offset=0, end=None):
+        return self.get_decoder(mtype)(buf, offset, end)
+
+    def __repr__(self):
+        return '<Projection {0!r}>'.format(list(self.paths))
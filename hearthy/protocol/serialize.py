@@ -5,6 +5,8 @@ Reference:
 https://developers.google.com/protocol-buffers/docs/encoding
 """
 
+import sys
+from array import array
 from hearthy.exceptions import DecodeError
 
 WTYPE_VARINT = 0     # int32, int64, uint32, uint64, sint32, sint64, bool, enum
@@ -72,6 +74,15 @@ def write_varint(val, buf, offset=0):
         buf[offset] = byte | 0x80
         offset += 1
 
+def varint_size(val):
+    r"""
+    Returns the number of bytes write_varint needs for val.
+
+    >>> varint_size(0), varint_size(127), varint_size(128), varint_size(-1)
+    (1, 1, 2, 10)
+    """
+    return ((val & _MASK).bit_length() + 6) // 7 or 1
+
 def read_packed_varint(buf, offset=0, end=None, signed=True):
     if end is None:
         end = len(buf)
@@ -86,11 +97,87 @@ def read_packed_varint(buf, offset=0, end=None, signed=True):
 
     return ret
 
+def read_packed_varint_array(buf, offset, end, signed, typecode):
+    r"""
+    Batch version of read_packed_varint, returns an array.array
+    of the given typecode.
+
+    >>> read_packed_varint_array(b'\x01\x96\x01\x7f', 0, 4, True, 'i')
+    array('i', [1, 150, 127])
+    """
+    chunk = bytes(buf[offset:end])
+    if chunk.isascii():
+        # every varint is a single byte
+        try:
+            return array(typecode, list(chunk))
+        except OverflowError:
+            raise DecodeError('Packed value out of range')
+
+    ret = array(typecode)
+    append = ret.append
+    val = 0
+    shift = 0
+    try:
+        for byte in chunk:
+            val |= (byte & 0x7f) << shift
+            if byte & 0x80:
+                shift += 7
+                if shift >= 64:
+                    raise DecodeError('Not a valid varint')
+                continue
+
+            val &= _MASK
+            if signed and val >> 63:
+                val = ~(val ^ _MASK)
+            append(val)
+            val = 0
+            shift = 0
+    except OverflowError:
+        raise DecodeError('Packed value out of range')
+
+    if shift != 0:
+        raise DecodeError('Misaligned')
+
+    return ret
+
+def packed_varint_size(intarr):
+    """ Returns the number of bytes write_packed_varint needs for intarr. """
+    if 0 <= min(intarr) and max(intarr) < 128:
+        return len(intarr)
+    return sum(map(varint_size, intarr))
+
 def write_packed_varint(intarr, buf, offset=0):
+    if len(intarr) > 0 and 0 <= min(intarr) and max(intarr) < 128:
+        # every varint is a single byte
+        end = offset + len(intarr)
+        buf[offset:end] = array('B', intarr)
+        return end
+
     for val in intarr:
         offset = write_varint(val, buf, offset)
     return offset
 
+def read_packed_fixed_array(buf, offset, end, typecode):
+    """
+    Reads packed little endian fixed size values into an array.array.
+    The typecode needs to match the size of the values.
+    """
+    ret = array(typecode)
+    if (end - offset) % ret.itemsize != 0:
+        raise DecodeError('Not a valid packed fixed field')
+    ret.frombytes(buf[offset:end])
+    if sys.byteorder != 'little':
+        ret.byteswap()
+    return ret
+
+def as_numpy(arr):
+    """
+    Returns a NumPy array sharing memory with a decoded packed
+    array.array. Needs numpy to be installed.
+    """
+    import numpy
+    return numpy.frombuffer(arr, dtype=arr.typecode)
+
 def read_field(buf, offset):
     a = buf[offset]
     field_number = a >> 3
@@ -132,6 +219,25 @@ def read_fields(buf, offset=0, end=None):
 
     return fields
 
+class ScratchBuffer:
+    """
+    Reusable output buffer for encoding.
+
+    get(n) returns a memoryview of exactly n bytes which stays valid
+    until the next call to get. The underlying storage only grows.
+    """
+    def __init__(self, size=1024):
+        self._buf = bytearray(size)
+
+    def get(self, n):
+        if n > len(self._buf):
+            # allocate anew, views handed out earlier may still exist
+            self._buf = bytearray(max(n, 2 * len(self._buf)))
+        return memoryview(self._buf)[:n]
+
+    def __repr__(self):
+        return '<ScratchBuffer size={0}>'.format(len(self._buf))
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
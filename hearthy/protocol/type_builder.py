@@ -1,4 +1,4 @@
-from hearthy.protocol import mstruct
+from hearthy.protocol import mstruct, codegen
 
 _enum = mstruct.MInteger(64, True)
 _bool = mstruct.MInteger(64, True)
@@ -79,4 +79,5 @@ class Builder:
 
             update[name]._mfields_.update(mfields)
 
+        codegen.compile_types(update.values())
         namespace.update(update)
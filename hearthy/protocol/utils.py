@@ -1,11 +1,9 @@
 import sys
-import struct
 
-from hearthy import exceptions
+from hearthy.protocol import framing
 from hearthy.protocol.enums import *
 
-# 16K ought to be enough for anybody :)
-MAX_BUF = 16 * 1024
+MAX_PACKET = framing.MAX_FRAME
 
 def hexdump(src, length=16, sep='.', file=sys.stdout):
     FILTER = ''.join([(len(repr(chr(x))) == 3) and chr(x) or sep for x in range(256)])
@@ -38,34 +36,13 @@ def format_tag_value(tag, value):
     else:
         return str(value)
 
-class Splitter:
-    def __init__(self, max_bufsize=MAX_BUF):
-        self._buf = bytearray(max_bufsize)
-        self._offset = 0
-        self._needed = 8
-
-        # Note atype == -1 <-> we are parsing the header
-        self._atype = -1
-
-    def feed(self, buf):
-        newoffset = self._offset + len(buf)
-        if newoffset > MAX_BUF:
-            raise exceptions.BufferFullException()
-        self._buf[self._offset:newoffset] = buf
-
-        while newoffset >= self._needed:
-            if self._atype == -1:
-                atype, alen = struct.unpack('<II', self._buf[:8])
-                self._needed = alen + 8
-                self._atype = atype
-            else:
-                yield (self._atype, self._buf[8:self._needed])
-                newoffset -= self._needed
-                self._buf[:newoffset] = self._buf[self._needed:self._needed+newoffset]
-                self._needed = 8
-                self._atype = -1
-
-        self._offset = newoffset
+class Splitter(framing.Framer):
+    """
+    Splits a stream into game packets, feed() returns a list of
+    (packet type, payload) tuples. See hearthy.protocol.framing.
+    """
+    def __init__(self, max_bufsize=MAX_PACKET):
+        super().__init__(framing.GameHeader(), max_bufsize)
 
     def __repr__(self):
-        return '<Splitter offset={0._offset} needed={0._needed}>'.format(self)
+        return '<Splitter buffered={0}>'.format(self.buffered)
@@ -1,65 +1,44 @@
-import struct
-from hearthy.proxy.pipe import SimpleBuf, SimplePipe
-from hearthy.protocol import decoder, mtypes
+from hearthy.proxy.pipe import SimplePipe
+from hearthy.protocol import decoder, framing, mtypes, serialize
+from hearthy.exceptions import BufferFullException
 
 MODE_INTERCEPT, MODE_PASSIVE, MODE_LURKING = range(3)
 INTERCEPT_REJECT, INTERCEPT_ACCEPT = range(2)
 
-class SplitterBuf(SimpleBuf):
-    """
-    In principle same functionality as hearthy.protocol.utils.Splitter.
-    This version has the benefit of correctly handling loop breaks.
-    """
-    def pull_segment(self):
-        segment = self.peek_segment()
-        if segment is not None:
-            self._start += 8 + len(segment[1])
-        return segment
-
-    def peek_segment(self):
-        used = self.used
-        if used < 8:
-            return
-        
-        atype, alen = struct.unpack('<II', self.peek(8))
-
-        if used < alen + 8:
-            return
-
-        return (atype, self.peek(alen, offset=8))
-
 class InterceptPipe(SimplePipe):
     def __init__(self, a, b, handler):
         super().__init__(a, b)
-        self._splitters = [SplitterBuf(), SplitterBuf()]
+        self._splitters = [framing.Framer(framing.GameHeader()),
+                           framing.Framer(framing.GameHeader())]
         self._mode = MODE_LURKING
-        self._encode_buf = bytearray(16 * 1024)
+        self._encode_pool = serialize.ScratchBuffer(16 * 1024)
         self._handler = handler
 
     def _on_pull_lurking(self, epid, buf, n_bytes):
         opid = 1 - epid
         splitter = self._splitters[epid]
 
-        if splitter.free < n_bytes:
+        # Check if we have a full segment
+        try:
+            segments = splitter.feed(buf.last(n_bytes))
+        except BufferFullException:
             print('WARNING: not enough buffer space, going into passive mode')
             self._mode = MODE_PASSIVE
             return
-
-        # Check if we have a full segment
-        splitter.append(buf.last(n_bytes))
-        segment = splitter.pull_segment()
-        if segment is None:
+        if not segments:
             return
 
         # Calculate how much of the n_bytes don't belong to the first segment
-        remaining = splitter.used
+        atype, body = segments[0]
+        remaining = splitter.stats.bytes - (8 + len(body))
         assert remaining < n_bytes, "We missed the pull that completed the first segment!"
 
-        # Clear splitter
-        splitter.clear()
-
         try:
-            decoded = decoder.decode_packet(*segment)
+            decoded = decoder.decode_packet(atype, body)
+
+            # Clear splitter, the remaining data is fed again below
+            splitter.reset()
+
             print('Decoded first packet, is of type {0!r}'.format(decoded.__class__))
             
             if isinstance(decoded, mtypes.AuroraHandshake):
@@ -80,16 +59,13 @@ class InterceptPipe(SimplePipe):
         handler = self._handler
 
         # steal data
-        if n_bytes > 0:
-            splitter.append(buf.last(n_bytes))
-            buf._end -= n_bytes
+        if n_bytes == 0:
+            return
+        segments = splitter.feed(buf.last(n_bytes))
+        buf._end -= n_bytes
 
         # decode and forward data
-        while True:
-            segment = splitter.pull_segment()
-            if segment is None:
-                break
-
+        for segment in segments:
             decoded = decoder.decode_packet(*segment)
             action = handler.on_packet(epid, decoded)
 
@@ -97,10 +73,8 @@ class InterceptPipe(SimplePipe):
                 # nothing to do in this case
                 pass
             elif action == INTERCEPT_ACCEPT:
-                offset = decoder.encode_packet(decoded, self._encode_buf)
-
-                # forward packet (hopefully everything fits into the buffer)
-                buf.append(self._encode_buf[:offset])
+                # forward packet
+                buf.append(decoder.pack_packet(decoded, pool=self._encode_pool))
         
     def _on_pull(self, epid, buf, n_bytes):
         if n_bytes == 0:
@@ -9,6 +9,38 @@ class BasicProxyHandler:
     def connect(self, ep0, ep1):
         pipe.SimplePipe(ep0, ep1)
 
+class RecordingPipe(pipe.SimplePipe):
+    """ Pipe that records the forwarded data with a hcapng.Writer. """
+    def __init__(self, a, b, writer, stream_id):
+        super().__init__(a, b)
+        self._writer = writer
+        self._stream_id = stream_id
+        self._closed = 0
+
+        writer.new_connection(stream_id, a.addr, b.addr)
+
+    def _on_pull(self, epid, buf, n_bytes):
+        if n_bytes:
+            # data from the client (epid 0) goes to the server
+            self._writer.data(self._stream_id, epid, buf.last(n_bytes))
+
+    def _on_endpoint_event(self, ep, ev_type, ev_data):
+        super()._on_endpoint_event(ep, ev_type, ev_data)
+        if ev_type == 'closed':
+            self._closed += 1
+            if self._closed == 2:
+                self._writer.close_stream(self._stream_id)
+
+class RecordingProxyHandler:
+    """ Records all proxied connections to the hcapng.Writer writer. """
+    def __init__(self, writer):
+        self._writer = writer
+        self._next_id = 0
+
+    def connect(self, ep0, ep1):
+        RecordingPipe(ep0, ep1, self._writer, self._next_id)
+        self._next_id += 1
+
 class Proxy:
     def __init__(self, listen, handler):
         provider = pipe.TcpEndpointProvider(listen)
@@ -24,5 +56,24 @@ class Proxy:
 
 if __name__ == '__main__':
     import asyncore
-    p = Proxy(('0.0.0.0', 5412), handler=BasicProxyHandler)
-    asyncore.loop()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Transparent tcp proxy')
+    parser.add_argument('--port', type=int, default=5412)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--record', metavar='FILE',
+                        help='Record the proxied connections to a hcapng file')
+    args = parser.parse_args()
+
+    if args.record is None:
+        p = Proxy((args.host, args.port), handler=BasicProxyHandler)
+        asyncore.loop()
+    else:
+        from hearthy.datasource import hcapng
+
+        with open(args.record, 'wb') as f, hcapng.Writer(f, durability='flush', background=True) as writer:
+            p = Proxy((args.host, args.port), handler=RecordingProxyHandler(writer))
+            try:
+                asyncore.loop()
+            except KeyboardInterrupt:
+                pass
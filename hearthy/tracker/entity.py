@@ -9,6 +9,8 @@ TAG_CUSTOM_NAME = -1
 TAG_POWER_NAME = -2
 
 class EntityBase:
+    __slots__ = ['_eid', '_tags']
+
     def __init__(self, eid, tag_list):
         self._eid = eid
         self._tags = dict(tag_list)
@@ -23,6 +25,10 @@ class EntityBase:
     def __contains__(self, tag):
         return tag in self._tags
 
+    def items(self):
+        """ Returns the (tag, value) pairs of the entity. """
+        return self._tags.items()
+
     def __str__(self):
         # TODO: find a nice representation
         custom = self[TAG_CUSTOM_NAME]
@@ -49,49 +55,47 @@ class EntityBase:
         return '[{0}: {1!r} of {2} in {3}]'.format(self.id, cardname, whom, where)
 
 class Entity(EntityBase):
-    pass
-
-class MutableEntity(EntityBase):
-    def __setitem__(self, tag, value):
-        self._tags[tag] = value
-
-    def freeze(self):
-        self.__class__ = Entity
-        return self
+    __slots__ = []
 
 class MutableView(EntityBase):
-    def __init__(self, entity):
+    """
+    Entity whose tags are set through a WorldTransaction. Reads see
+    the pending changes of the transaction.
+    """
+    __slots__ = ['_e', '_t']
+
+    def __init__(self, entity, transaction):
         self._e = entity
+        self._t = transaction
         self._eid = entity.id
-        self._tags = dict()
-
-    @property
-    def id(self):
-        return self._eid
+        self._tags = entity._tags
 
     def __getitem__(self, tag):
-        value = self._tags.get(tag, None)
-        if value is None:
-            value = self._e[tag]
-        return value
-
-    def __setitem__(self, tag, value):
-        oldvalue = self[tag]
-        if oldvalue != value:
-            self._tags[tag] = value
+        entry = self._t.tag_changes(self._eid).get(tag, None)
+        if entry is not None:
+            return entry[1]
+        return self._tags.get(tag, None)
 
     def __contains__(self, tag):
-        return tag in self._tags or tag in self._e
+        return tag in self._tags or tag in self._t.tag_changes(self._eid)
+
+    def items(self):
+        tags = dict(self._tags)
+        for tag, (oldval, val) in self._t.tag_changes(self._eid).items():
+            tags[tag] = val
+        return tags.items()
+
+    def __setitem__(self, tag, value):
+        self._t.set(self._eid, tag, value)
 
     def __str__(self):
         ret = super().__str__()
-        for key, val in self._tags.items():
-            oldval = self._e[key]
-            ret += ('\n\ttag {1}:{2} {3} -> {4}'.format(
-                            self,
+        for key, (oldval, val) in self._t.tag_changes(self._eid).items():
+            if oldval == val:
+                continue
+            ret += ('\n\ttag {0}:{1} {2} -> {3}'.format(
                             key,
                             GameTag.reverse.get(key, '?'),
                             format_tag_value(key, oldval) if oldval else '(unset)',
                             format_tag_value(key, val)))
         return ret
-
@@ -0,0 +1,302 @@
+"""
+Parallel decoding of captures.
+
+The reading process parses the hcapng events and routes them by stream
+id to a pool of worker processes. Each worker splits and decodes the
+packets of its streams and optionally tracks them with a Processor.
+
+Events are handed out in chunks. Once every worker is done with a
+chunk, the results are merged back in capture order, so the output is
+the same as that of hearthy.ui.common.hcap_generate_logs:
+
+    (stream_id, ('create', source, dest, ts))
+    (stream_id, ('packet', packet, who, ts))
+    (stream_id, ('close', ts))
+    (stream_id, ('exception', e))
+
+If the workers run a Processor, the tracked World of a stream is
+reported when the stream is closed or the capture ends:
+
+    (stream_id, ('world', world, ts))
+
+Workers do not send decoded packets back, unpickling them would take
+longer than decoding them in the first place. They send the packet type
+and body instead, which the reading process decodes when merging. So
+with packet events the workers split the streams (and track them, if
+process is set), while the packets themselves are decoded in the
+reading process.
+"""
+
+import os
+import time
+import heapq
+import queue
+import pickle
+import multiprocessing
+from hearthy.datasource import hcapng
+from hearthy.protocol import framing
+from hearthy.protocol.decoder import decode_packet
+from hearthy.tracker.processor import Processor, PROJECTION
+
+# number of capture events per chunk
+CHUNK_EVENTS = 2048
+
+# number of chunks handed out before waiting for results
+MAX_INFLIGHT = 4
+
+# seconds to wait for the workers to exit before terminating them
+CLOSE_TIMEOUT = 5
+
+EV_CREATE, EV_DATA, EV_CLOSE = range(3)
+
+def _picklable(e):
+    try:
+        pickle.loads(pickle.dumps(e))
+    except Exception:
+        return Exception(repr(e))
+    return e
+
+class _Stream:
+    __slots__ = ['framers', 'processor']
+
+    def __init__(self, process):
+        self.framers = [framing.Framer(framing.GameHeader()),
+                        framing.Framer(framing.GameHeader())]
+        self.processor = Processor() if process else None
+
+class StreamDecoder:
+    """
+    Decodes the streams routed to one worker. handle() takes a chunk
+    of (seq, ts, kind, stream_id, args) records and returns a list of
+    (seq, stream_id, log event) tuples ordered by seq.
+
+    If raw is set, packets are not decoded unless they are tracked,
+    packet events are ('raw', packet_type, body, who, ts) instead.
+    """
+    def __init__(self, process=False, packets=True, raw=False):
+        self._streams = {}
+        self._process = process
+        self._packets = packets
+        self._raw = raw
+
+        # the processor does not need the fields PROJECTION skips
+        self._fields = PROJECTION if process and not packets else None
+
+    def handle(self, chunk):
+        streams = self._streams
+        raw = self._raw
+        ret = []
+
+        for seq, ts, kind, stream_id, args in chunk:
+            if kind == EV_CREATE:
+                streams[stream_id] = _Stream(self._process)
+                ret.append((seq, stream_id, ('create', args[0], args[1], ts)))
+                continue
+
+            stream = streams.get(stream_id, None)
+            if stream is None:
+                continue
+
+            if kind == EV_CLOSE:
+                ret.append((seq, stream_id, ('close', ts)))
+                if stream.processor is not None:
+                    ret.append((seq, stream_id, ('world', stream.processor._world, ts)))
+                del streams[stream_id]
+                continue
+
+            who, data = args
+            try:
+                for atype, buf in stream.framers[who].feed(data):
+                    if stream.processor is not None:
+                        packet = decode_packet(atype, buf, fields=self._fields)
+                        stream.processor.process(who, packet, ts)
+                    elif not raw:
+                        packet = decode_packet(atype, buf, fields=self._fields)
+                    if not self._packets:
+                        continue
+                    if raw:
+                        ret.append((seq, stream_id, ('raw', atype, bytes(buf), who, ts)))
+                    else:
+                        ret.append((seq, stream_id, ('packet', packet, who, ts)))
+            except Exception as e:
+                del streams[stream_id]
+                ret.append((seq, stream_id, ('exception', _picklable(e))))
+
+        return ret
+
+    def finish(self, seq, ts):
+        """ Reports the worlds of the streams still open. """
+        ret = []
+        for stream_id, stream in sorted(self._streams.items()):
+            if stream.processor is not None:
+                ret.append((seq, stream_id, ('world', stream.processor._world, ts)))
+        self._streams.clear()
+        return ret
+
+def _worker(inq, outq, process, packets):
+    decoder = StreamDecoder(process, packets, raw=True)
+    while True:
+        chunk = inq.get()
+        if chunk is None:
+            break
+        if isinstance(chunk, tuple):
+            outq.put(decoder.finish(*chunk))
+        else:
+            outq.put(decoder.handle(chunk))
+
+class _LocalPool:
+    """ Runs the stream decoder in process, used for jobs=1. """
+    def __init__(self, process, packets):
+        self._decoder = StreamDecoder(process, packets)
+        self._results = []
+
+    def submit(self, chunks):
+        self._results.append([self._decoder.handle(chunks[0])])
+
+    def finish(self, seq, ts):
+        self._results.append([self._decoder.finish(seq, ts)])
+
+    def collect(self):
+        return self._results.pop(0)
+
+    def close(self):
+        pass
+
+class _ProcessPool:
+    def __init__(self, jobs, process, packets):
+        ctx = multiprocessing.get_context()
+        self._queues = []
+        self._procs = []
+        for i in range(jobs):
+            inq, outq = ctx.Queue(), ctx.Queue()
+            proc = ctx.Process(target=_worker, args=(inq, outq, process, packets), daemon=True)
+            proc.start()
+            self._queues.append((inq, outq))
+            self._procs.append(proc)
+
+    def submit(self, chunks):
+        for (inq, outq), chunk in zip(self._queues, chunks):
+            inq.put(chunk)
+
+    def finish(self, seq, ts):
+        for inq, outq in self._queues:
+            inq.put((seq, ts))
+
+    def collect(self):
+        return [outq.get() for inq, outq in self._queues]
+
+    def close(self):
+        for inq, outq in self._queues:
+            inq.put(None)
+
+        deadline = time.monotonic() + CLOSE_TIMEOUT
+        for proc, (inq, outq) in zip(self._procs, self._queues):
+            # results nobody collected (the consumer stopped early) keep
+            # the worker from exiting, throw them away
+            while proc.is_alive() and time.monotonic() < deadline:
+                try:
+                    outq.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+
+            # a terminated worker does not read the chunks left
+            inq.cancel_join_thread()
+            inq.close()
+            outq.close()
+
+def generate_logs(f, jobs=None, process=False, packets=True):
+    """
+    Generates log events for the hcapng capture f (see module
+    docstring) using jobs worker processes, os.cpu_count() if not
+    given. If process is set, the workers track every stream with a
+    Processor. If packets is false, no packet events are returned.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    if jobs > 1:
+        pool = _ProcessPool(jobs, process, packets)
+    else:
+        jobs = 1
+        pool = _LocalPool(process, packets)
+
+    try:
+        yield from _run(f, pool, jobs)
+    finally:
+        pool.close()
+
+def _merge(results, failed):
+    """
+    Merges worker results and decodes raw packets. failed holds the
+    streams whose packets did not decode, their events are dropped
+    until the stream id is reused.
+    """
+    for seq, stream_id, event in heapq.merge(*results, key=lambda x: x[0]):
+        if stream_id in failed:
+            if event[0] != 'create':
+                continue
+            failed.discard(stream_id)
+
+        if event[0] == 'raw':
+            try:
+                event = ('packet', decode_packet(event[1], event[2]), event[3], event[4])
+            except Exception as e:
+                failed.add(stream_id)
+                event = ('exception', e)
+        yield (stream_id, event)
+
+def _run(f, pool, jobs):
+    parser = hcapng.parse_mapped(f)
+    _, header = next(parser)
+    yield (-1, ('basets', header.ts))
+
+    # stream id -> worker
+    routes = {}
+    failed = set()
+    next_worker = 0
+
+    inflight = 0
+    chunks = [[] for i in range(jobs)]
+    n = 0
+    seq = 0
+    ts = 0
+
+    for seq, (ts, event) in enumerate(parser):
+        if isinstance(event, hcapng.EvData):
+            worker = routes.get(event.stream_id, None)
+            if worker is None:
+                continue
+            # the data is a view into the capture map, workers need a copy
+            chunks[worker].append((seq, ts, EV_DATA, event.stream_id, (event.who, bytes(event.data))))
+        elif isinstance(event, hcapng.EvNewConnection):
+            worker = routes[event.stream_id] = next_worker
+            next_worker = (next_worker + 1) % jobs
+            chunks[worker].append((seq, ts, EV_CREATE, event.stream_id, (event.source, event.dest)))
+        elif isinstance(event, hcapng.EvClose):
+            worker = routes.pop(event.stream_id, None)
+            if worker is None:
+                continue
+            chunks[worker].append((seq, ts, EV_CLOSE, event.stream_id, None))
+
+        n += 1
+        if n == CHUNK_EVENTS:
+            pool.submit(chunks)
+            chunks = [[] for i in range(jobs)]
+            n = 0
+            inflight += 1
+            if inflight == MAX_INFLIGHT:
+                yield from _merge(pool.collect(), failed)
+                inflight -= 1
+
+    if n:
+        pool.submit(chunks)
+        inflight += 1
+    pool.finish(seq + 1, ts)
+    inflight += 1
+
+    while inflight:
+        yield from _merge(pool.collect(), failed)
+        inflight -= 1
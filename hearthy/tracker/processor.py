@@ -1,19 +1,45 @@
 import logging
 from hearthy.protocol import mtypes
 from hearthy.protocol.enums import GameTag
+from hearthy.protocol.projection import Projection
 from hearthy.tracker.world import World
 from hearthy.protocol.utils import format_tag_value
 from hearthy.tracker.entity import Entity, TAG_CUSTOM_NAME, TAG_POWER_NAME
 
 logger = logging.getLogger(__name__)
 
+# Everything the processor looks at, pass as fields to decode_packet
+# to skip the rest.
+PROJECTION = Projection([
+    'StartGameState',
+    'PowerHistory.List.FullEntity',
+    'PowerHistory.List.ShowEntity',
+    'PowerHistory.List.TagChange',
+    'PowerHistory.List.CreateGame'
+])
+
 class Processor:
-    def __init__(self):
-        self._world = World()
+    """
+    Tracks the entities of a game from its packets. If history is set,
+    the World records its history (see World.at()). If columnar is
+    set, the World keeps the entity tags in a TagTable.
+
+    Log messages are only formatted if their level is enabled. For
+    tracing without formatting, set cb, it is called as
+    cb(processor, event, *args) with the events
+
+        'new_entity', eid, [(tag, value), ...]
+        'show_entity', eid, card id, [(tag, value), ...]
+        'tag_change', eid, tag, old value, new value
+        'ignored', packet
+    """
+    def __init__(self, history=False, columnar=False):
+        self._world = World(history=history, columnar=columnar)
         self.logger = logger
+        self.cb = None
 
-    def process(self, who, what):
-        with self._world.transaction() as t:
+    def process(self, who, what, ts=None):
+        with self._world.transaction(ts) as t:
             self._process(who, what, t)
 
     def _process(self, who, what, t):
@@ -23,7 +49,15 @@ class Processor:
             for power in what.List:
                 self._process_power(power, t)
         else:
-            self.logger.info('Ignoring packet of type {0}'.format(what.__class__.__name__))
+            if self.cb is not None:
+                self.cb(self, 'ignored', what)
+            if self.logger.isEnabledFor(logging.INFO):
+                self.logger.info('Ignoring packet of type {0}'.format(what.__class__.__name__))
+
+    def _new_entity(self, eid, taglist, t):
+        t.add(Entity(eid, taglist))
+        if self.cb is not None:
+            self.cb(self, 'new_entity', eid, taglist)
 
     def _process_create_game(self, what, t):
         eid, taglist = (what.GameEntity.Id,
@@ -32,55 +66,64 @@ class Processor:
             print('INFO: Game Entity already exists, ignoring "create game" event')
             return
 
-        logging.debug('Got game entity: {0!r}'.format(what.GameEntity))
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('Got game entity: {0!r}'.format(what.GameEntity))
         taglist.append((TAG_CUSTOM_NAME, 'TheGame'))
-        t.add(Entity(eid, taglist))
+        self._new_entity(eid, taglist, t)
 
         for player in what.Players:
             eid, taglist = (player.Entity.Id,
                             [(t.Name, t.Value) for t in player.Entity.Tags])
 
             # TODO: are we interested in the battlenet id?
-            logging.debug('Found Player {0}: {1!r}'.format(player.Id, player))
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug('Found Player {0}: {1!r}'.format(player.Id, player))
             taglist.append((TAG_CUSTOM_NAME, 'Player{0}'.format(player.Id)))
-            t.add(Entity(eid, taglist))
+            self._new_entity(eid, taglist, t)
 
     def _process_power(self, power, t):
         if hasattr(power, 'FullEntity'):
             e = power.FullEntity
             taglist = [(e.Name, e.Value) for e in e.Tags]
             taglist.append((TAG_POWER_NAME, e.Name))
-            new_entity = Entity(e.Entity, taglist)
-            t.add(new_entity)
+            self._new_entity(e.Entity, taglist, t)
 
             # logging
-            logger.info('Adding new entity: {0}'.format(new_entity))
-            logger.debug('With tags: \n' + '\n'.join(
-                '\ttag {0}:{1} {2}'.format(tag_id,
-                                          GameTag.reverse.get(tag_id, '?'),
-                                          format_tag_value(tag_id, tag_val))
-                for tag_id, tag_val in taglist))
+            if logger.isEnabledFor(logging.INFO):
+                logger.info('Adding new entity: {0}'.format(t[e.Entity]))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('With tags: \n' + '\n'.join(
+                    '\ttag {0}:{1} {2}'.format(tag_id,
+                                              GameTag.reverse.get(tag_id, '?'),
+                                              format_tag_value(tag_id, tag_val))
+                    for tag_id, tag_val in taglist))
         if hasattr(power, 'ShowEntity'):
             e = power.ShowEntity
-            mut = t.get_mutable(e.Entity)
-            mut[TAG_POWER_NAME] = e.Name
+            t.set(e.Entity, TAG_POWER_NAME, e.Name)
 
             for tag in e.Tags:
-                mut[tag.Name] = tag.Value
+                t.set(e.Entity, tag.Name, tag.Value)
 
-            logger.info('Revealing entity: {0}'.format(mut))
+            if self.cb is not None:
+                self.cb(self, 'show_entity', e.Entity, e.Name,
+                        [(tag.Name, tag.Value) for tag in e.Tags])
+            if logger.isEnabledFor(logging.INFO):
+                logger.info('Revealing entity: {0}'.format(t.get_mutable(e.Entity)))
         if hasattr(power, 'HideEntity'):
             pass
         if hasattr(power, 'TagChange'):
             change = power.TagChange
-            e = t.get_mutable(change.Entity)
 
-            logger.info('Tag change for {0}: {1} from {2} to {3}'.format(
-                Entity.__str__(e),
-                GameTag.reverse.get(change.Tag, change.Tag),
-                format_tag_value(change.Tag, e[change.Tag]) if e[change.Tag] is not None else '(unset)',
-                format_tag_value(change.Tag, change.Value)))
+            if logger.isEnabledFor(logging.INFO):
+                e = t[change.Entity]
+                logger.info('Tag change for {0}: {1} from {2} to {3}'.format(
+                    e,
+                    GameTag.reverse.get(change.Tag, change.Tag),
+                    format_tag_value(change.Tag, e[change.Tag]) if e[change.Tag] is not None else '(unset)',
+                    format_tag_value(change.Tag, change.Value)))
 
-            e[change.Tag] = change.Value
+            old = t.set(change.Entity, change.Tag, change.Value)
+            if self.cb is not None:
+                self.cb(self, 'tag_change', change.Entity, change.Tag, old, change.Value)
         if hasattr(power, 'CreateGame'):
             self._process_create_game(power.CreateGame, t)
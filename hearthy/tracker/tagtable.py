@@ -0,0 +1,164 @@
+"""
+Columnar storage for entity tags.
+
+A TagTable keeps the tags of all entities of a World in one int32
+array per tag (column), indexed by the row of the entity. Values that
+do not fit (card ids, custom names) are kept in a dict. Entities of a
+World created with columnar=True get a TagRow as their _tags, which
+behaves like the tag dict of the entity.
+
+Compared to a dict per entity this needs about 4 bytes per entity and
+tag in use, and no int objects for the values.
+"""
+
+from array import array
+from collections.abc import MutableMapping
+
+# marks a cell without value, or with a value kept in the dict
+UNSET = -2 ** 31
+
+_INT32_MAX = 2 ** 31 - 1
+
+class TagTable:
+    """ Tag values of many entities, one row per entity. """
+    __slots__ = ['_rows', '_columns', '_objects']
+
+    def __init__(self):
+        # entity id -> row
+        self._rows = {}
+        # tag -> array of values by row
+        self._columns = {}
+        # tag -> row -> value not stored in the column
+        self._objects = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, eid, tags=()):
+        """ Adds a row for entity eid, returns a TagRow for it. """
+        if eid in self._rows:
+            raise ValueError('Entity {0} already has a row'.format(eid))
+        row = self._rows[eid] = len(self._rows)
+        for column in self._columns.values():
+            column.append(UNSET)
+        tagrow = TagRow(self, row)
+        tagrow.update(tags)
+        return tagrow
+
+    def row(self, eid):
+        """ Returns the TagRow of entity eid. """
+        return TagRow(self, self._rows[eid])
+
+    def tags(self):
+        """ Returns the tags that have a column. """
+        return list(self._columns)
+
+    def get(self, row, tag, default=None):
+        column = self._columns.get(tag, None)
+        if column is None:
+            return default
+        value = column[row]
+        if value != UNSET:
+            return value
+        objects = self._objects.get(tag, None)
+        if objects is None:
+            return default
+        return objects.get(row, default)
+
+    def contains(self, row, tag):
+        column = self._columns.get(tag, None)
+        if column is None:
+            return False
+        if column[row] != UNSET:
+            return True
+        objects = self._objects.get(tag, None)
+        return objects is not None and row in objects
+
+    def set(self, row, tag, value):
+        column = self._columns.get(tag, None)
+        if column is None:
+            column = self._columns[tag] = array('i', [UNSET]) * len(self._rows)
+
+        objects = self._objects.get(tag, None)
+        if type(value) is int and UNSET < value <= _INT32_MAX:
+            column[row] = value
+            if objects is not None:
+                objects.pop(row, None)
+        else:
+            column[row] = UNSET
+            if objects is None:
+                objects = self._objects[tag] = {}
+            objects[row] = value
+
+    def delete(self, row, tag):
+        if not self.contains(row, tag):
+            raise KeyError(tag)
+        self._columns[tag][row] = UNSET
+        objects = self._objects.get(tag, None)
+        if objects is not None:
+            objects.pop(row, None)
+
+    def items(self, row):
+        objects = self._objects
+        for tag, column in self._columns.items():
+            value = column[row]
+            if value != UNSET:
+                yield tag, value
+            elif tag in objects and row in objects[tag]:
+                yield tag, objects[tag][row]
+
+    def nbytes(self):
+        """ Returns the size of the columns in bytes. """
+        return sum(len(c) * c.itemsize for c in self._columns.values())
+
+    def __repr__(self):
+        return '<TagTable rows={0} columns={1} objects={2}>'.format(
+            len(self._rows), len(self._columns),
+            sum(len(x) for x in self._objects.values()))
+
+class TagRow(MutableMapping):
+    """ The tags of one entity in a TagTable, used like a dict. """
+    __slots__ = ['_table', '_row']
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    def get(self, tag, default=None):
+        return self._table.get(self._row, tag, default)
+
+    def __getitem__(self, tag):
+        table = self._table
+        if not table.contains(self._row, tag):
+            raise KeyError(tag)
+        return table.get(self._row, tag)
+
+    def __contains__(self, tag):
+        return self._table.contains(self._row, tag)
+
+    def __setitem__(self, tag, value):
+        self._table.set(self._row, tag, value)
+
+    def __delitem__(self, tag):
+        self._table.delete(self._row, tag)
+
+    def update(self, tags=()):
+        table = self._table
+        row = self._row
+        if hasattr(tags, 'items'):
+            tags = tags.items()
+        for tag, value in tags:
+            table.set(row, tag, value)
+
+    def items(self):
+        return list(self._table.items(self._row))
+
+    def __iter__(self):
+        for tag, value in self._table.items(self._row):
+            yield tag
+
+    def __len__(self):
+        return sum(1 for x in self._table.items(self._row))
+
+    def __repr__(self):
+        return '<TagRow {0!r}>'.format(dict(self.items()))
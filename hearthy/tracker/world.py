@@ -1,57 +1,196 @@
 import logging
+from bisect import bisect_right
 from hearthy import exceptions
 from hearthy.protocol.enums import GameTag
 from hearthy.protocol.utils import format_tag_value
-from hearthy.tracker.entity import Entity, MutableEntity, MutableView
+from hearthy.tracker.entity import Entity, MutableView
+from hearthy.tracker.tagtable import TagTable
 
 logger = logging.getLogger(__name__)
 
+# transactions between two checkpoints of a History
+CHECKPOINT_INTERVAL = 64
+
+# tags a World keeps indexes for by default, see World.select()
+INDEX_TAGS = (GameTag.ZONE, GameTag.CONTROLLER, GameTag.CARDTYPE)
+
+class History:
+    """
+    Record of the transactions applied to a World, used to rebuild
+    past states.
+
+    Every transaction is kept as a list of (entity id, tag, old value,
+    new value) changes, an added entity as (entity id, None, None,
+    tags). Every interval transactions a checkpoint of all entity tags
+    is taken. Entities that did not change since the previous
+    checkpoint share its tag dicts, so a checkpoint costs about the
+    number of entities plus the changed tags.
+    """
+    def __init__(self, interval=CHECKPOINT_INTERVAL):
+        self.interval = interval
+        self._deltas = []
+        self._ts = []
+
+        # state after k * interval transactions: entity id -> tags,
+        # the tag dicts are never modified
+        self._checkpoints = [{}]
+        # entities changed since the last checkpoint
+        self._dirty = set()
+
+    def __len__(self):
+        return len(self._deltas)
+
+    def record(self, ts, changes, world):
+        if ts is None:
+            ts = self._ts[-1] if self._ts else 0
+        self._deltas.append(changes)
+        self._ts.append(ts)
+
+        dirty = self._dirty
+        for change in changes:
+            dirty.add(change[0])
+
+        if len(self._deltas) % self.interval == 0:
+            checkpoint = dict(self._checkpoints[-1])
+            for eid in dirty:
+                checkpoint[eid] = dict(world._e[eid]._tags)
+            self._checkpoints.append(checkpoint)
+            self._dirty = set()
+
+    def index_at(self, ts):
+        """ Returns the number of transactions with a timestamp <= ts. """
+        return bisect_right(self._ts, ts)
+
+    def changes(self, index):
+        """ Returns the changes of transaction number index. """
+        return self._deltas[index]
+
+    def state(self, index):
+        """
+        Returns {entity id: tags} after the first index transactions.
+        The dicts are new and may be modified.
+        """
+        if not 0 <= index <= len(self._deltas):
+            raise IndexError('History has no transaction {0}'.format(index))
+
+        k = index // self.interval
+        state = dict((eid, dict(tags)) for eid, tags in self._checkpoints[k].items())
+        for changes in self._deltas[k * self.interval:index]:
+            for eid, tag, old, new in changes:
+                if tag is None:
+                    state[eid] = dict(new)
+                else:
+                    state[eid][tag] = new
+        return state
+
 class WorldTransaction:
-    def __init__(self, world):
+    """
+    Changes to a World that are applied together.
+
+    Tag changes are kept until the transaction is applied and recorded
+    in changes as (entity, tag, old value, new value), an added entity
+    as (entity, None, None, None). Until then the entities of the World
+    keep their tags, so pre_apply callbacks see the old state. Added
+    entities join the World when the transaction is applied; their tags
+    are set directly and not recorded as changes. If the transaction
+    fails, nothing is applied.
+    """
+    def __init__(self, world, ts=None):
         self._world = world
-        self._e = {}
+        self._new = {}
+        # entity id -> {tag: (value before the transaction, new value)}
+        self._changed = {}
+        self.changes = []
+        self.ts = ts
 
     def add(self, entity):
-        if isinstance(entity, Entity):
-            assert entity.id not in self
+        assert entity.id not in self
+        self._new[entity.id] = entity
+        self.changes.append((entity, None, None, None))
+
+    def set(self, eid, tag, value):
+        """ Sets tag of entity eid to value, returns the old value. """
+        entity = self._new.get(eid, None)
+        if entity is not None:
+            old = entity._tags.get(tag, None)
+            entity._tags[tag] = value
+            return old
 
-            # New entities may be modified until transaction
-            # completes
-            entity.__class__ = MutableEntity
+        entity = self._world[eid]
+        changed = self._changed.get(eid, None)
+        entry = changed.get(tag, None) if changed is not None else None
+        if entry is None:
+            old = first = entity._tags.get(tag, None)
+        else:
+            first, old = entry
+        if old != value:
+            if changed is None:
+                changed = self._changed[eid] = {}
+            changed[tag] = (first, value)
+            self.changes.append((entity, tag, old, value))
+        return old
 
-        self._e[entity.id] = entity
+    def tag_changes(self, eid):
+        """ Returns {tag: (value before the transaction, new value)} of entity eid. """
+        return self._changed.get(eid, {})
 
     def __contains__(self, eid):
-        return eid in self._e or eid in self._world
+        return eid in self._new or eid in self._world
 
     def get_mutable(self, eid):
-        e = self._e.get(eid, None)
-        if e is None:
-            e = self._e[eid] = MutableView(self._world[eid])
-        return e
+        return MutableView(self[eid], self)
 
     def __getitem__(self, eid):
-        e = self._e.get(eid, None)
-        if e is None:
-            return self._world[eid]
+        """ Returns entity eid, as a MutableView if it has pending changes. """
+        e = self._new.get(eid, None)
+        if e is not None:
+            return e
+        e = self._world[eid]
+        if eid in self._changed:
+            return MutableView(e, self)
         return e
 
+    def rollback(self):
+        """ Drops the changes and the added entities. """
+        self.changes = []
+        self._changed = {}
+        self._new = {}
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type is None and exc_value is None and traceback is None:
-            # TODO: overkill checking all three?
+        if exc_type is None:
             self._world._apply(self)
+        else:
+            self.rollback()
 
 class World:
     """
     Container for all in-game entities.
+
+    If history is set, the applied transactions are recorded (see
+    History) and at() and at_time() return past states.
+
+    For every tag in index_tags an index from tag value to entity ids
+    is kept up to date, select() uses them to find entities without
+    looking at all of them.
+
+    If columnar is set, the tags of the entities are kept in a TagTable
+    instead of a dict per entity, which takes a lot less memory.
     """
-    def __init__(self):
+    def __init__(self, history=False, checkpoint_interval=CHECKPOINT_INTERVAL,
+                 index_tags=INDEX_TAGS, columnar=False):
         self._e = {}
         self._watchers = []
         self.cb = None
+        self.history = History(checkpoint_interval) if history else None
+        self._table = TagTable() if columnar else None
+
+        # tag -> value -> set of entity ids
+        self._index = {}
+        for tag in index_tags:
+            self.add_index(tag)
 
     def __contains__(self, eid):
         return eid in self._e
@@ -66,18 +205,138 @@ class World:
         for entity in self._e.values():
             yield entity
 
-    def transaction(self):
-        return WorldTransaction(self)
+    def add_index(self, tag):
+        """ Starts keeping an index for tag. """
+        if tag in self._index:
+            return
+        by_value = self._index[tag] = {}
+        for eid, entity in self._e.items():
+            value = entity._tags.get(tag, None)
+            if value is not None:
+                by_value.setdefault(value, set()).add(eid)
 
-    def _apply(self, transaction):
-        self.cb(self, 'pre_apply', transaction)
-        
-        for entity in transaction._e.values():
-            if GameTag.TURN in entity._tags:
-                logger.info('== Turn {0} =='.format(entity._tags[GameTag.TURN]))
-
-            if isinstance(entity, MutableView):
-                entity._e._tags.update(entity._tags)
+    @property
+    def index_tags(self):
+        return tuple(self._index)
+
+    def select(self, tags=None, **kwargs):
+        """
+        Returns a list of the entities whose tags have the given
+        values, in no particular order. The criteria are given as a
+        {tag: value} dict and/or as keyword arguments named after the
+        tag, e.g. select(zone=Zone.PLAY, controller=2).
+
+        Indexed tags are looked up in the indexes, the smallest
+        matching set is then checked against the other criteria.
+        Without any indexed tag all entities are scanned.
+        """
+        criteria = dict(tags) if tags else {}
+        for name, value in kwargs.items():
+            tag = getattr(GameTag, name.upper(), None)
+            if not isinstance(tag, int):
+                raise TypeError('Unknown tag {0!r}'.format(name))
+            criteria[tag] = value
+
+        sets = []
+        rest = []
+        for tag, value in criteria.items():
+            by_value = self._index.get(tag, None)
+            if by_value is None:
+                rest.append((tag, value))
             else:
-                assert entity.id not in self
-                self._e[entity.id] = entity.freeze()
+                sets.append(by_value.get(value, ()))
+
+        if not sets:
+            return [entity for entity in self._e.values()
+                    if all(entity._tags.get(tag, None) == value for tag, value in rest)]
+
+        sets.sort(key=len)
+        others = sets[1:]
+        result = []
+        for eid in sets[0]:
+            if others and not all(eid in s for s in others):
+                continue
+            entity = self._e[eid]
+            if rest and not all(entity._tags.get(tag, None) == value for tag, value in rest):
+                continue
+            result.append(entity)
+        return result
+
+    def _reindex(self, by_value, eid, old, new):
+        if old == new:
+            return
+        if old is not None:
+            eids = by_value[old]
+            eids.discard(eid)
+            if not eids:
+                del by_value[old]
+        if new is not None:
+            by_value.setdefault(new, set()).add(eid)
+
+    def transaction(self, ts=None):
+        """ Starts a transaction, ts is recorded in the history. """
+        return WorldTransaction(self, ts)
+
+    def at(self, index):
+        """
+        Returns a new World with the state after the first index
+        transactions. Needs history.
+        """
+        if self.history is None:
+            raise ValueError('World does not record its history')
+
+        world = World(index_tags=(), columnar=self._table is not None)
+        table = world._table
+        for eid, tags in self.history.state(index).items():
+            entity = Entity(eid, ())
+            entity._tags = tags if table is None else table.add(eid, tags)
+            world._e[eid] = entity
+        for tag in self._index:
+            world.add_index(tag)
+        return world
+
+    def at_time(self, ts):
+        """ Returns a new World with the state at time ts. Needs history. """
+        if self.history is None:
+            raise ValueError('World does not record its history')
+        return self.at(self.history.index_at(ts))
+
+    def _apply(self, transaction):
+        if self.cb is not None:
+            self.cb(self, 'pre_apply', transaction)
+
+        history = self.history
+        if history is not None:
+            changes = []
+        index = self._index
+        table = self._table
+
+        for entity, tag, old, new in transaction.changes:
+            eid = entity._eid
+            if tag is None:
+                assert eid not in self._e
+                tags = entity._tags
+                if GameTag.TURN in tags and logger.isEnabledFor(logging.INFO):
+                    logger.info('== Turn {0} =='.format(tags[GameTag.TURN]))
+                if history is not None:
+                    changes.append((eid, None, None, dict(tags)))
+                for itag, by_value in index.items():
+                    value = tags.get(itag, None)
+                    if value is not None:
+                        by_value.setdefault(value, set()).add(eid)
+                if table is not None:
+                    entity._tags = table.add(eid, tags)
+                self._e[eid] = entity
+                continue
+
+            entity._tags[tag] = new
+            if tag == GameTag.TURN and logger.isEnabledFor(logging.INFO):
+                logger.info('== Turn {0} =='.format(new))
+            if history is not None:
+                changes.append((eid, tag, old, new))
+            by_value = index.get(tag, None)
+            if by_value is not None:
+                self._reindex(by_value, eid, old, new)
+
+        if history is not None:
+            history.record(transaction.ts, changes, self)
@@ -2,24 +2,37 @@ import threading
 import queue
 
 from hearthy.datasource import hcapng
-from hearthy.protocol.utils import Splitter
+from hearthy.protocol import framing
 from hearthy.protocol.decoder import decode_packet
 
 MAX_QUEUE = 1000
 
 class Connection:
-    __slots__ = ['p', '_s']
+    __slots__ = ['p', '_s', '_lazy', '_fields']
     """
     Represent a connection between two endpoints source and dest.
-    Decodes packet in the connection
+    Decodes packet in the connection, as lazy views if lazy is set
+    (see hearthy.protocol.lazy) or only the fields of the projection
+    fields if given (see hearthy.protocol.projection).
     """
-    def __init__(self, source, dest):
+    def __init__(self, source, dest, lazy=False, fields=None):
         self.p = [source, dest]
-        self._s = [Splitter(), Splitter()]
+        self._s = [framing.Framer(framing.GameHeader()),
+                   framing.Framer(framing.GameHeader())]
+        self._lazy = lazy
+        self._fields = fields
+
+    @property
+    def stats(self):
+        """ Framing statistics (FrameStats) for both directions. """
+        return [s.stats for s in self._s]
 
     def feed(self, who, buf):
         for atype, abuf in self._s[who].feed(buf):
-            decoded = decode_packet(atype, abuf)
+            if self._lazy:
+                # views keep referencing the buffer, the framer reuses it
+                abuf = bytes(abuf)
+            decoded = decode_packet(atype, abuf, lazy=self._lazy, fields=self._fields)
             yield decoded
 
     def __repr__(self):
@@ -27,31 +40,80 @@ class Connection:
             self.p[0], self.p[1]))
 
 class AsyncLogGenerator:
-    def __init__(self):
+    """
+    Turns hcapng events into log events. If lazy is set, packets are
+    lazy views (see hearthy.protocol.lazy) instead of MStructs. If fields
+    is given, only the fields of that projection are decoded (see
+    hearthy.protocol.projection).
+
+    Another EvHeader means the capture started over (see
+    hearthy.datasource.live). The streams still open are reported as
+    closed, and the stream ids of the new capture are moved past all
+    ids reported so far, so they stay unique.
+
+    stats maps stream ids to the framing statistics of both directions,
+    they are kept after the stream has been closed.
+    """
+    def __init__(self, lazy=False, fields=None):
         self._conns = {}
+        self._lazy = lazy
+        self._fields = fields
+        self.stats = {}
 
-    def process_event(self, ts, event):
-        conns = self._conns
+        self._started = False
+        self._last_ts = 0
+        # added to the stream ids of the current capture
+        self._id_offset = 0
+        self._next_id = 0
+
+    def _restart(self):
+        for stream_id in sorted(self._conns):
+            yield (stream_id, ('close', self._last_ts))
+        self._conns = {}
+        self._id_offset = self._next_id
 
+    def process_event(self, ts, event):
         if isinstance(event, hcapng.EvHeader):
+            if self._started:
+                yield from self._restart()
+            self._started = True
             yield (-1, ('basets', event.ts))
-        elif isinstance(event, hcapng.EvNewConnection):
-            conns[event.stream_id] = Connection(event.source, event.dest)
-            yield (event.stream_id, ('create', event.source, event.dest, ts))
-        elif event.stream_id in conns:
+            return
+
+        conns = self._conns
+        stream_id = event.stream_id + self._id_offset
+        self._last_ts = ts
+
+        if isinstance(event, hcapng.EvNewConnection):
+            conn = conns[stream_id] = Connection(event.source, event.dest,
+                                                  lazy=self._lazy, fields=self._fields)
+            self.stats[stream_id] = conn.stats
+            self._next_id = max(self._next_id, stream_id + 1)
+            yield (stream_id, ('create', event.source, event.dest, ts))
+        elif stream_id in conns:
             if isinstance(event, hcapng.EvClose):
-                yield (event.stream_id, ('close', ts))
-                del conns[event.stream_id]
+                yield (stream_id, ('close', ts))
+                del conns[stream_id]
             elif isinstance(event, hcapng.EvData):
                 try:
-                    for packet in conns[event.stream_id].feed(event.who, event.data):
-                        yield (event.stream_id, ('packet', packet, event.who, ts))
+                    for packet in conns[stream_id].feed(event.who, event.data):
+                        yield (stream_id, ('packet', packet, event.who, ts))
                 except Exception as e:
-                    del conns[event.stream_id]
-                    yield (event.stream_id, ('exception', e))
-        
-def hcap_generate_logs(f):
-    generator = hcapng.parse(f)
+                    del conns[stream_id]
+                    yield (stream_id, ('exception', e))
+
+def hcap_generate_logs(f, jobs=1):
+    """
+    Generates log events for the hcapng capture f. With jobs other
+    than 1 the streams are split by worker processes, see
+    hearthy.tracker.parallel.
+    """
+    if jobs != 1:
+        from hearthy.tracker import parallel
+        yield from parallel.generate_logs(f, jobs=jobs)
+        return
+
+    generator = hcapng.parse_mapped(f)
     _, header = next(generator)
 
     conns = {}
@@ -74,13 +136,32 @@ def hcap_generate_logs(f):
                     del conns[event.stream_id]
                     yield (event.stream_id, ('exception', e))
 
+def live_generate_logs(path):
+    """
+    Generates log events for the capture at path while it is being
+    written, see hearthy.datasource.live. Does not return.
+    """
+    from hearthy.datasource import live
+
+    generator = AsyncLogGenerator()
+    with live.LiveCapture(path) as capture:
+        for ts, event in capture:
+            yield from generator.process_event(ts, event)
+
 class LogGenerationThread(threading.Thread):
-    def __init__(self, fn):
+    def __init__(self, fn, jobs=1, follow=False):
         super().__init__()
         self._fn = fn
+        self._jobs = jobs
+        self._follow = follow
         self.queue = queue.Queue(MAX_QUEUE)
 
     def run(self):
+        if self._follow:
+            for event in live_generate_logs(self._fn):
+                self.queue.put(event, block=True)
+            return
+
         with open(self._fn, 'rb') as f:
-            for event in hcap_generate_logs(f):
+            for event in hcap_generate_logs(f, jobs=self._jobs):
                 self.queue.put(event, block=True)
@@ -3,7 +3,6 @@ from tkinter import ttk
 
 from hearthy.protocol import utils
 from hearthy.protocol.enums import GameTag
-from hearthy.tracker.entity import MutableView
 
 ALL_TAGS = sorted([x.capitalize() for x in GameTag.reverse.values()])
 
@@ -39,7 +38,7 @@ class EntityFilter(ttk.Frame):
 
         self.cb = None
 
-    def get_filter_string(self):
+    def _parse(self):
         tag = self.tag.get()
         test = self.test.get()
         value = self.value.get()
@@ -51,10 +50,8 @@ class EntityFilter(ttk.Frame):
             print('Err: {0!r} is not numeric'.format(tag))
             return
 
-        if test == 'Exists':
-            return '(x[{0}] is not None)'.format(tag)
-        elif test == 'Not Exists':
-            return '(x[{0}] is None)'.format(tag)
+        if test in ('Exists', 'Not Exists'):
+            return tag, test, None
 
         enum = utils._gametag_to_enum.get(tag, None)
         if enum is not None:
@@ -66,11 +63,29 @@ class EntityFilter(ttk.Frame):
             print('Err: {0!r} is not numeric'.format(value))
             return
 
-        if test == 'Equals':
+        return tag, test, value
+
+    def get_filter_string(self):
+        parsed = self._parse()
+        if parsed is None:
+            return
+        tag, test, value = parsed
+
+        if test == 'Exists':
+            return '(x[{0}] is not None)'.format(tag)
+        elif test == 'Not Exists':
+            return '(x[{0}] is None)'.format(tag)
+        elif test == 'Equals':
             return '(x[{0}] == {1})'.format(tag, value)
         elif test == 'Not Equals':
             return '(x[{0}] != {1})'.format(tag, value)
 
+    def get_selection(self):
+        """ Returns (tag, value) for equality filters, else None. """
+        parsed = self._parse()
+        if parsed is not None and parsed[1] == 'Equals':
+            return parsed[0], parsed[2]
+
     def _on_remove(self):
         if self.cb is not None:
             self.cb(self, 'remove')
@@ -93,6 +108,8 @@ class EntityTree:
         self._build_widgets(container)
         self._world = None
         self._filter_fun = lambda x:True
+        # {tag: value} the filter requires, looked up with World.select()
+        self._selection = None
 
     def _build_widgets(self, container):
         tree = ttk.Treeview(container, columns=('Info','Value'))
@@ -117,34 +134,34 @@ class EntityTree:
                                  value=(str(entity), ''))
 
         pre = str(entity.id) + '.'
-        for tag, value in entity._tags.items():
+        for tag, value in entity.items():
             self._tree.insert(node, 'end', pre + str(tag),
                               text=str(tag),
                               value=(GameTag.reverse.get(tag, ''),
                                      utils.format_tag_value(tag, value)))
 
-    def _change_entity(self, eview):
-        pre = str(eview.id) + '.'
+    def _change_entity(self, entity, tags):
+        pre = str(entity.id) + '.'
         update_parent = False
 
-        
-        in_tree = self._tree.exists(str(eview.id))
-        does_pass = self._filter_fun(eview)
+        in_tree = self._tree.exists(str(entity.id))
+        does_pass = self._filter_fun(entity)
 
         if not does_pass:
             if in_tree:
-                self._tree.delete(str(eview.id))
+                self._tree.delete(str(entity.id))
+            return
+        elif not in_tree:
+            self._add_entity(entity)
             return
-        else:
-            if not in_tree:
-                self._add_entity(eview._e)
 
-        for tag, value in eview._tags.items():
+        for tag in tags:
+            value = entity[tag]
             if tag < 0 or tag == 49 or tag == 50:
                 update_parent = True
-            if eview._e[tag] is None:
+            if not self._tree.exists(pre + str(tag)):
                 # add tag
-                self._tree.insert(str(eview.id), 'end', pre + str(tag),
+                self._tree.insert(str(entity.id), 'end', pre + str(tag),
                                   text=tag,
                                   value=(GameTag.reverse.get(tag, ''),
                                          utils.format_tag_value(tag, value)))
@@ -155,11 +172,12 @@ class EntityTree:
                                        utils.format_tag_value(tag, value)))
 
         if update_parent:
-            self._tree.item(str(eview.id),
-                            value=(str(eview), ''))
+            self._tree.item(str(entity.id),
+                            value=(str(entity), ''))
 
-    def set_filter(self, fun):
+    def set_filter(self, fun, selection=None):
         self._filter_fun = fun
+        self._selection = selection
         if self._world is not None:
             self.set_world(self._world)
 
@@ -170,23 +188,34 @@ class EntityTree:
             self._tree.delete(item)
 
         # rebuild tree
-        for entity in world:
+        if self._selection:
+            entities = sorted(world.select(self._selection), key=lambda e: e.id)
+        else:
+            entities = world
+        for entity in entities:
             if self._filter_fun(entity):
                 self._add_entity(entity)
 
         self._world = world
 
     def apply_transaction(self, transaction):
-        tree = self._tree
-
-        for entity in transaction._e.values():
-            if isinstance(entity, MutableView):
-                # Entity Changes
-                self._change_entity(entity)
-            else:
+        # called before the changes are applied, so changed entities
+        # are read through the transaction
+        # entity id -> (entity, changed tags)
+        changed = {}
+        for entity, tag, old, new in transaction.changes:
+            if tag is None:
                 # New Entity
                 if self._filter_fun(entity):
                     self._add_entity(entity)
+            elif entity.id not in changed:
+                # Entity Changes
+                changed[entity.id] = (transaction.get_mutable(entity.id), [tag])
+            else:
+                changed[entity.id][1].append(tag)
+
+        for entity, tags in changed.values():
+            self._change_entity(entity, tags)
 
 class EntityBrowser:
     def __init__(self):
@@ -195,6 +224,11 @@ class EntityBrowser:
         self.cb = None
         self._f = lambda x:True
 
+        self._world = None
+        # showing the current state (not a past one)
+        self._live = True
+        self._scrubbing = False
+
     def _on_destroy(self):
         if self.cb is not None:
             self.cb(self, 'destroy')
@@ -224,9 +258,18 @@ class EntityBrowser:
         b_add = ttk.Button(button_frame, text='Add Filter', command=self._add_filter)
         b_add.pack(side='left', expand=True, fill='x')
 
+        # only shown for worlds with history
+        history_frame = ttk.Labelframe(parent, text='History')
+        self._position = tkinter.StringVar()
+        self._scale = ttk.Scale(history_frame, orient='horizontal', from_=0, to=0,
+                                command=self._on_scrub)
+        self._scale.pack(side='left', expand=True, fill='x')
+        ttk.Label(history_frame, textvariable=self._position, width=12).pack(side='left')
+
         self._tree = tree
         self._filter_frame = filter_frame
         self._button_frame = button_frame
+        self._history_frame = history_frame
 
     def _apply_filter(self):
         full = ' and '.join(filter(None, [ef.get_filter_string() for ef in self._filters]))
@@ -234,7 +277,8 @@ class EntityBrowser:
             f = eval('lambda x: ' + full)
         else:
             f = lambda x:True
-        self._tree.set_filter(f)
+        selection = dict(filter(None, [ef.get_selection() for ef in self._filters]))
+        self._tree.set_filter(f, selection)
         
     def _remove_filter(self, ef, event):
         self._filters.remove(ef)
@@ -249,8 +293,40 @@ class EntityBrowser:
         self._button_frame.pack_forget()
         self._button_frame.pack(fill='x')
 
+    def _set_position(self, n, total):
+        self._scrubbing = True
+        self._scale.configure(to=total)
+        self._scale.set(n)
+        self._scrubbing = False
+        self._position.set('{0}/{1}'.format(n, total))
+
+    def _on_scrub(self, value):
+        if self._scrubbing:
+            return
+        history = self._world.history
+        n = int(float(value))
+        self._live = n >= len(history)
+        self._tree.set_world(self._world if self._live else self._world.at(n))
+        self._position.set('{0}/{1}'.format(n, len(history)))
+
     def set_world(self, world):
+        self._world = world
+        self._live = True
         self._tree.set_world(world)
+        if world.history is not None:
+            self._history_frame.grid(row=2, column=0, sticky='nsew')
+            self._set_position(len(world.history), len(world.history))
 
     def apply_transaction(self, transaction):
-        self._tree.apply_transaction(transaction)
+        history = self._world.history if self._world is not None else None
+        if history is None:
+            self._tree.apply_transaction(transaction)
+            return
+
+        # called before the transaction is recorded
+        total = len(history) + 1
+        if self._live:
+            self._tree.apply_transaction(transaction)
+            self._set_position(total, total)
+        else:
+            self._scale.configure(to=total)
@@ -70,13 +70,13 @@ class StreamList:
         tracker = self._trackers.get(sid, None)
         if tracker is None:
             stream = self._streams[sid]
-            tracker = self._trackers[sid] = Processor()
+            tracker = self._trackers[sid] = Processor(history=True)
             
             assert tracker._world.cb is None
             tracker._world.cb = self._world_cb
 
             for packet in stream.packets:
-                tracker.process(packet[1], packet[0])
+                tracker.process(packet[1], packet[0], packet[2])
 
         world = tracker._world
         l = self._entity_browsers.get(world, None)
@@ -156,7 +156,7 @@ class StreamList:
 
         tracker = self._trackers.get(stream_id, None)
         if tracker is not None:
-            tracker.process(who, packet)
+            tracker.process(who, packet, ts)
 
     def on_close(self, stream_id, ts):
         stream = self._streams.get(stream_id, None)
@@ -1,4 +1,5 @@
 import tkinter
+from array import array
 from tkinter import ttk
 from hearthy.protocol.mstruct import MStruct
 
@@ -48,7 +49,7 @@ class StreamView:
             tree.insert(node, 'end', text=key, value=(value, ''))
         elif isinstance(value, int):
             tree.insert(node, 'end', text=key, value=(value, ''))
-        elif isinstance(value, list):
+        elif isinstance(value, (list, array)):
             subnode = tree.insert(node, 'end', text=key, value=('{0} Element{1}'.format(len(value), '' if len(value) == 1 else 's'), ''))
             for i, entry in enumerate(value):
                 self._append_node(tree, subnode, '[{0}]'.format(i), entry)
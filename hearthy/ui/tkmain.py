@@ -41,16 +41,61 @@ class Application(ttk.Frame):
         elif event[0] == 'basets':
             self._streams.on_basets(event[1]*1000)
 
+def load_stream(app, log_generator, path, stream_id):
+    """ Loads a single stream using the capture index (see datasource.hindex). """
+    from hearthy.datasource import hindex
+
+    with hindex.open_capture(path) as capture:
+        events = [(0, hcapng.EvHeader(capture.ts))]
+        events.extend(capture.iter_stream(stream_id))
+        for ts, event in events:
+            for packet_event in log_generator.process_event(ts, event):
+                app.process_event(*packet_event)
+
+def follow(root, app, log_generator, path):
+    """ Feeds the capture at path to app as it grows (see datasource.live). """
+    from hearthy.datasource import live
+
+    capture = live.LiveCapture(path)
+    fd = capture.fileno()
+
+    def update():
+        try:
+            for ts, event in capture.read_events():
+                for packet_event in log_generator.process_event(ts, event):
+                    app.process_event(*packet_event)
+        except:
+            capture.close()
+            raise
+
+    def read_cb(fd, mask):
+        update()
+
+    def poll_cb():
+        update()
+        root.after(int(capture.poll_interval * 1000), poll_cb)
+
+    update()
+    if fd is not None:
+        root.tk.createfilehandler(fd, tkinter.READABLE, read_cb)
+    else:
+        root.after(int(capture.poll_interval * 1000), poll_cb)
+
 if __name__ == '__main__':
     import sys
     import os
+    import argparse
     import logging
 
     logging.basicConfig(level=logging.DEBUG)
 
-    if len(sys.argv) < 2:
-        print('Usage: {0} <hcap file>'.format(sys.argv[0]))
-        sys.exit(1)
+    argparser = argparse.ArgumentParser(description='Hearthstone capture viewer')
+    argparser.add_argument('file', help='hcap file')
+    argparser.add_argument('--stream', type=int,
+                           help='Only load this stream, using the capture index')
+    argparser.add_argument('--follow', action='store_const', default=False, const=True,
+                           help='Keep reading the capture while it is written')
+    args = argparser.parse_args()
 
     root = tkinter.Tk()
     root.geometry('800x300')
@@ -60,19 +105,31 @@ if __name__ == '__main__':
     log_generator = AsyncLogGenerator()
     
     app = Application(master=root)
-    
-    fd = os.open(sys.argv[1], os.O_NONBLOCK | os.O_RDONLY)
+
+    if args.stream is not None:
+        load_stream(app, log_generator, args.file, args.stream)
+        root.mainloop()
+        sys.exit(0)
+
+    if args.follow:
+        follow(root, app, log_generator, args.file)
+        root.mainloop()
+        sys.exit(0)
+
+    READ_SIZE = 64 * 1024
+    fd = os.open(args.file, os.O_NONBLOCK | os.O_RDONLY)
 
     def read_cb(fd, mask):
-        buf = os.read(fd, 1024)
+        # read straight into the parser's buffer
+        n = os.readv(fd, [parser.get_buffer(READ_SIZE)])
         
-        if len(buf) == 0:
+        if n == 0:
             # end of file (hopefully)
             root.tk.deletefilehandler(fd)
             return
         
         try:
-            for ts, event in parser.feed_buf(buf):
+            for ts, event in parser.commit(n):
                 for packet_event in log_generator.process_event(ts, event):
                     app.process_event(*packet_event)
         except: